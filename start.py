@@ -18,6 +18,8 @@ import platform
 import shutil
 import webbrowser
 import threading
+import json
+import importlib.metadata
 
 # ============================================================================
 # Colores para terminal
@@ -315,16 +317,21 @@ def get_requirements():
         'openpyxl==3.1.2'
     ]
 
+def get_package_name(req):
+    return req.split('[')[0].split('==')[0].split('>=')[0].strip()
+
 def check_dependencies():
     print(f"\n{Colors.BOLD}Verificando dependencias...{Colors.END}")
     reqs = get_requirements()
     missing = []
     for req in reqs:
-        pkg = req.split('[')[0].split('==')[0].split('>=')[0].strip()
+        pkg = get_package_name(req)
         try:
-            __import__(pkg.replace('-', '_'))
-            print(f"{Colors.GREEN}  - {pkg} OK{Colors.END}")
-        except ImportError:
+            # Consultar los metadatos instalados en lugar de importar el paquete
+            # (importar pandas o Flask solo para comprobarlo cuesta cientos de ms)
+            version = importlib.metadata.version(pkg)
+            print(f"{Colors.GREEN}  - {pkg} {version} OK{Colors.END}")
+        except importlib.metadata.PackageNotFoundError:
             print(f"{Colors.YELLOW}  - {pkg} (faltante){Colors.END}")
             missing.append(req)
     return missing
@@ -436,6 +443,54 @@ def install_dependencies(missing):
     
     return success
 
+# ============================================================================
+# Huella del entorno verificado (arranque rapido)
+# ============================================================================
+ENV_FINGERPRINT_FILE = '.xonidip_env.json'
+
+def compute_env_fingerprint():
+    """Huella del entorno: interprete, version de Python y paquetes instalados"""
+    reqs = get_requirements()
+    packages = {}
+    for req in reqs:
+        pkg = get_package_name(req)
+        try:
+            packages[pkg] = importlib.metadata.version(pkg)
+        except importlib.metadata.PackageNotFoundError:
+            packages[pkg] = None
+    return {
+        'python': sys.executable,
+        'version': sys.version,
+        'system': platform.platform(),
+        'requirements': reqs,
+        'packages': packages
+    }
+
+def is_complete_env(fingerprint):
+    return all(fingerprint['packages'].values())
+
+def load_env_fingerprint():
+    try:
+        with open(ENV_FINGERPRINT_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except:
+        return None
+
+def save_env_fingerprint(fingerprint):
+    """Guarda la huella solo si todas las dependencias estan instaladas"""
+    if not is_complete_env(fingerprint):
+        return False
+    try:
+        with open(ENV_FINGERPRINT_FILE, 'w', encoding='utf-8') as f:
+            json.dump(fingerprint, f, indent=2)
+        return True
+    except:
+        return False
+
+def is_warm_start(fingerprint):
+    """El entorno coincide con uno ya verificado: se puede saltar la revision completa"""
+    return is_complete_env(fingerprint) and load_env_fingerprint() == fingerprint
+
 # ============================================================================
 # Verificar archivos necesarios
 # ============================================================================
@@ -556,7 +611,15 @@ def open_browser_later():
 # ============================================================================
 # Ejecutar servidor (xonidip.py)
 # ============================================================================
-def run_server():
+def run_server_in_process():
+    """Ejecuta xonidip.py en este mismo interprete (sin lanzar otro proceso)"""
+    import runpy
+    sys.argv = ['xonidip.py']
+    # Sin el reloader de Werkzeug: volveria a lanzar otro interprete con todo el arranque repetido
+    os.environ['XONIDIP_IN_PROCESS'] = '1'
+    runpy.run_path('xonidip.py', run_name='__main__')
+
+def run_server(in_process=False):
     print(f"\n{Colors.BOLD}Iniciando XONIDIP...{Colors.END}")
     print(f"{Colors.CYAN}Presiona Ctrl+C para detener el servidor{Colors.END}")
     print("-" * 60)
@@ -565,10 +628,13 @@ def run_server():
     browser_thread.daemon = True
     browser_thread.start()
     
-    python_cmd = get_python_command()
-    cmd = python_cmd + ['xonidip.py']
+    # Mismo interprete con el que se verificaron (o instalaron) las dependencias
+    cmd = [sys.executable, 'xonidip.py']
     try:
-        subprocess.run(cmd)
+        if in_process:
+            run_server_in_process()
+        else:
+            subprocess.run(cmd)
     except KeyboardInterrupt:
         print(f"\n{Colors.YELLOW}Servidor detenido por el usuario{Colors.END}")
         sys.exit(0)
@@ -580,6 +646,19 @@ def run_server():
 # Menu principal
 # ============================================================================
 def main():
+    force_full = '--full' in sys.argv
+    in_process = '--in-process' in sys.argv or os.environ.get('XONIDIP_IN_PROCESS') == '1'
+    
+    # Arranque rapido: entorno ya verificado con este mismo interprete y paquetes
+    fingerprint = compute_env_fingerprint()
+    if not force_full and is_warm_start(fingerprint):
+        print(f"{Colors.GREEN}Entorno ya verificado ({sys.executable}). "
+              f"Usa 'start.py --full' para revisarlo de nuevo.{Colors.END}")
+        if not check_files():
+            sys.exit(1)
+        run_server(in_process)
+        return
+    
     os.system('clear' if get_system() != 'windows' else 'cls')
     print_banner()
     
@@ -631,7 +710,11 @@ def main():
         else:
             print(f"{Colors.YELLOW}No se instalaran dependencias. Continuando de todas formas...{Colors.END}")
     
-    run_server()
+    # Recordar el entorno verificado para los siguientes arranques
+    if save_env_fingerprint(compute_env_fingerprint()):
+        print(f"{Colors.GREEN}Entorno verificado guardado en {ENV_FINGERPRINT_FILE}{Colors.END}")
+    
+    run_server(in_process)
 
 if __name__ == '__main__':
     try:
@@ -1,42 +1,224 @@
 import os
 import io
-import zipfile
 import socket
-import webbrowser
 import threading
 from flask import Flask, render_template, request, send_file, jsonify, send_from_directory, url_for
-from PIL import Image, ImageDraw, ImageFont
-import pandas as pd
+from PIL import ImageDraw
 import json
-from werkzeug.utils import secure_filename
-import tempfile
+import csv
+from werkzeug.utils import secure_filename, safe_join
+from werkzeug.wsgi import LimitedStream
 import shutil
 from datetime import datetime
 import base64
 import time
-import unicodedata
-import qrcode
+import math
+import itertools
+import functools
+import hmac
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from xonidip_core import (
+    CONFIG, ensure_folders, logger, start_job_profiler, save_job_profile, allowed_file,
+    get_font_path, load_font, parse_text_config, write_zip, save_upload_stream, create_preview,
+    memory_budget, shared_templates, MemoryBudgetTimeout, iter_rendered, render_cache,
+    render_cache_key, write_cached_diploma, storage, write_zip_parts, resolve_engine,
+    config_for_mode, draw_text_centered, encoder_stats, registry,
+    available_formats, save_rendered, encode_threads, extract_roster_from_file, group_roster,
+    Roster, save_roster, load_roster, diff_rosters, group_signature, write_job_meta,
+    load_job_outputs, imposition_settings, ImposedPDF, impose_names, JOB_ID_PATTERN, JOB_META
+)
+from xonidip_farm import open_farm, FarmTimeout, unpack_results
+from xonidip_ingest import open_batches, iter_ndjson, IngestBusy, IngestClosed
 
 app = Flask(__name__)
 
 # Configuración
 app.config['SECRET_KEY'] = 'xonidu-Darian-Alberto-Camacho-Salas'
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max
-app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['OUTPUT_FOLDER'] = 'diplomas_generados'
-app.config['FONTS_FOLDER'] = 'fonts'
-app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'txt', 'csv', 'xlsx', 'xls'}
-app.config['OUTPUT_FORMATS'] = ['PNG', 'PDF', 'JPG']
-app.config['DEFAULT_FORMAT'] = 'PNG'
+app.config.update(CONFIG)  # Carpetas y formatos compartidos con xonidip_core
+
+# Planificador de generación (peticiones concurrentes desde la red local)
+app.config['SCHED_MAX_RUNNING'] = max(2, os.cpu_count() or 1)  # trabajos simultáneos
+app.config['SCHED_MAX_QUEUE'] = 32          # trabajos en espera antes de responder 429
+app.config['SCHED_PER_CLIENT'] = 2          # trabajos (en curso + en cola) por cliente
+app.config['SCHED_SMALL_BATCH'] = 20        # lotes de hasta N nombres cuentan como interactivos
+app.config['SCHED_AGING_SECONDS'] = 30      # cada N s de espera reduce la prioridad efectiva del coste
+app.config['SCHED_WAIT_TIMEOUT'] = {'interactive': 30, 'bulk': 600}
+
+# Descargas detrás de un proxy inverso: None, 'x-accel' (nginx) o 'x-sendfile' (Apache/lighttpd)
+app.config['DOWNLOAD_OFFLOAD'] = os.environ.get('XONIDIP_DOWNLOAD_OFFLOAD') or None
+app.config['DOWNLOAD_ACCEL_PREFIX'] = '/diplomas_generados/'  # location interna de nginx
+app.config['DOWNLOAD_MAX_AGE'] = 3600
+# Con X-Sendfile, send_file solo añade la cabecera y el servidor web envía el archivo
+app.config['USE_X_SENDFILE'] = app.config['DOWNLOAD_OFFLOAD'] == 'x-sendfile'
 
 # Crear carpetas si no existen
-for folder in [app.config['UPLOAD_FOLDER'], app.config['OUTPUT_FOLDER'], app.config['FONTS_FOLDER']]:
-    if not os.path.exists(folder):
-        os.makedirs(folder)
+ensure_folders()
 
 # Variable para controlar si ya se abrió el navegador
 browser_opened = False
 
+# ===== PLANIFICADOR DE TRABAJOS (ADMISIÓN Y EQUIDAD) =====
+class SchedulerBusy(Exception):
+    """El trabajo no fue admitido (cola llena, límite por cliente o espera agotada)"""
+    
+    def __init__(self, message, retry_after, queue_position=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.queue_position = queue_position
+
+class JobScheduler:
+    """Cola acotada con prioridad: vistas previas y lotes pequeños antes que lotes masivos"""
+    
+    def __init__(self, max_running, max_queue, per_client, aging_seconds):
+        self.max_running = max_running
+        # Siempre queda al menos un hueco libre para trabajos interactivos
+        self.max_bulk = max(1, max_running - 1)
+        self.max_queue = max_queue
+        self.per_client = per_client
+        self.aging_seconds = aging_seconds
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._running = 0
+        self._running_bulk = 0
+        self._clients = {}
+        self._seq = itertools.count()
+    
+    def _priority(self, ticket):
+        # Los interactivos van primero; entre el resto, menor coste envejecido por la espera
+        waited = time.monotonic() - ticket['enqueued']
+        aged_cost = ticket['cost'] / (1 + waited / self.aging_seconds)
+        return (0 if ticket['interactive'] else 1, aged_cost, ticket['seq'])
+    
+    def _runnable(self, ticket):
+        return self._running < self.max_running and (
+            ticket['interactive'] or self._running_bulk < self.max_bulk
+        )
+    
+    def _position(self, ticket):
+        priority = self._priority(ticket)
+        return 1 + sum(1 for other in self._waiting if self._priority(other) < priority)
+    
+    def _is_next(self, ticket):
+        if not self._runnable(ticket):
+            return False
+        candidates = [t for t in self._waiting if self._runnable(t)]
+        return min(candidates, key=self._priority) is ticket
+    
+    def _enter(self, client, cost, interactive, timeout):
+        with self._cond:
+            if self._clients.get(client, 0) >= self.per_client:
+                raise SchedulerBusy('Demasiados trabajos simultáneos desde este dispositivo', retry_after=5)
+            if len(self._waiting) >= self.max_queue:
+                raise SchedulerBusy('La cola de trabajos está llena', retry_after=15,
+                                    queue_position=len(self._waiting) + 1)
+            
+            ticket = {'client': client, 'cost': max(1, cost), 'interactive': interactive,
+                      'enqueued': time.monotonic(), 'seq': next(self._seq)}
+            self._clients[client] = self._clients.get(client, 0) + 1
+            self._waiting.append(ticket)
+            
+            deadline = ticket['enqueued'] + timeout
+            try:
+                while not self._is_next(ticket):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise SchedulerBusy('Tiempo de espera agotado en la cola', retry_after=15,
+                                            queue_position=self._position(ticket))
+                    # Despertar periódicamente para que el envejecimiento reordene la cola
+                    self._cond.wait(min(remaining, self.aging_seconds))
+            except BaseException:
+                self._waiting.remove(ticket)
+                self._release_client(client)
+                self._cond.notify_all()
+                raise
+            
+            self._waiting.remove(ticket)
+            self._running += 1
+            if not interactive:
+                self._running_bulk += 1
+            ticket['started'] = time.monotonic()
+            return ticket
+    
+    def _release_client(self, client):
+        self._clients[client] -= 1
+        if not self._clients[client]:
+            del self._clients[client]
+    
+    def _leave(self, ticket):
+        with self._cond:
+            self._running -= 1
+            if not ticket['interactive']:
+                self._running_bulk -= 1
+            self._release_client(ticket['client'])
+            self._cond.notify_all()
+    
+    @contextmanager
+    def slot(self, client, cost, interactive=False, timeout=600):
+        ticket = self._enter(client, cost, interactive, timeout)
+        try:
+            yield ticket
+        finally:
+            self._leave(ticket)
+    
+    def status(self):
+        with self._cond:
+            return {
+                'running': self._running,
+                'running_bulk': self._running_bulk,
+                'queued': len(self._waiting),
+                'max_running': self.max_running,
+                'max_queue': self.max_queue
+            }
+
+scheduler = JobScheduler(
+    app.config['SCHED_MAX_RUNNING'], app.config['SCHED_MAX_QUEUE'],
+    app.config['SCHED_PER_CLIENT'], app.config['SCHED_AGING_SECONDS']
+)
+
+# Granja de render: este servidor actúa como coordinador. Se abre al primer uso y no al
+# importar, para que el proceso vigía del recargador de Flask no abra la cola
+farm_coordinator = None
+farm_lock = threading.Lock()
+
+def get_farm():
+    """Coordinador de la granja, o None si FARM_QUEUE está vacío"""
+    global farm_coordinator
+    if farm_coordinator is None and app.config['FARM_QUEUE']:
+        with farm_lock:
+            if farm_coordinator is None:
+                farm_coordinator = open_farm(app.config)
+    return farm_coordinator
+
+def scheduled(job_cost, fast_path=None):
+    """Decorador: pasa la petición por el planificador; job_cost(data) -> número de diplomas
+
+    fast_path(data) puede devolver una respuesta ya lista (p. ej. desde la caché)
+    para no hacer cola por algo que no necesita renderizar.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            data = request.get_json(silent=True) or {}
+            if fast_path:
+                response = fast_path(data)
+                if response is not None:
+                    return response
+            cost = job_cost(data)
+            interactive = cost <= app.config['SCHED_SMALL_BATCH']
+            timeout = app.config['SCHED_WAIT_TIMEOUT']['interactive' if interactive else 'bulk']
+            try:
+                with scheduler.slot(request.remote_addr, cost, interactive, timeout):
+                    return view(*args, **kwargs)
+            except SchedulerBusy as e:
+                body = {'error': str(e), 'retry_after': e.retry_after, 'queue': scheduler.status()}
+                if e.queue_position is not None:
+                    body['queue_position'] = e.queue_position
+                return jsonify(body), 429, {'Retry-After': str(e.retry_after)}
+        return wrapper
+    return decorator
+
 # ===== FUNCIÓN PARA OBTENER IP =====
 def get_server_url():
     """Obtiene la URL del servidor con IP y puerto"""
@@ -56,6 +238,7 @@ def open_browser_after_delay():
         browser_opened = True
         url = get_server_url()
         try:
+            import webbrowser
             webbrowser.open(url)
             print(f"\n🌐 Navegador abierto automáticamente en: {url}")
         except:
@@ -66,6 +249,7 @@ def open_browser_after_delay():
 def generate_qr_base64(url):
     """Genera un código QR en base64 para mostrar en HTML"""
     try:
+        import qrcode  # Importación diferida: solo se necesita al servir la página
         qr = qrcode.QRCode(
             version=1,
             error_correction=qrcode.constants.ERROR_CORRECT_L,
@@ -83,214 +267,9 @@ def generate_qr_base64(url):
         
         return img_str
     except Exception as e:
-        print(f"Error generando QR: {e}")
+        logger.error("Error generando QR: %s", e)
         return None
 
-# ===== FUNCIÓN PARA NORMALIZAR NOMBRES DE ARCHIVO =====
-def normalize_filename(name):
-    """Normaliza un nombre para uso en nombre de archivo"""
-    # Reemplazar caracteres especiales
-    replacements = {
-        'á': 'a', 'é': 'e', 'í': 'i', 'ó': 'o', 'ú': 'u',
-        'Á': 'A', 'É': 'E', 'Í': 'I', 'Ó': 'O', 'Ú': 'U',
-        'ñ': 'n', 'Ñ': 'N', 'ü': 'u', 'Ü': 'U',
-        ' ': '_', ',': '', '.': '', "'": '', '"': '',
-        '¿': '', '?': '', '¡': '', '!': '', ':': '', ';': '',
-        '/': '_', '\\': '_', '*': '', '|': '', '<': '', '>': ''
-    }
-    
-    for special, normal in replacements.items():
-        name = name.replace(special, normal)
-    
-    # Eliminar caracteres no permitidos
-    name = ''.join(c for c in name if c.isalnum() or c in ('_', '-'))
-    
-    # Limitar longitud y evitar nombres vacíos
-    name = name[:50] if name else "participante"
-    
-    return name
-
-# ===== FUNCIÓN PARA GUARDAR EN DIFERENTES FORMATOS =====
-def save_diploma(image, name, output_format='PNG'):
-    """Guarda el diploma en el formato especificado con nombre personalizado"""
-    
-    safe_name = normalize_filename(name)
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    
-    if output_format.upper() == 'PDF':
-        # Generar PDF
-        output_filename = f"diploma_{safe_name}_{timestamp}.pdf"
-        output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-        
-        # Convertir imagen a PDF
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        image.save(output_path, 'PDF', resolution=100.0)
-        
-    elif output_format.upper() == 'JPG':
-        # Generar JPG
-        output_filename = f"diploma_{safe_name}_{timestamp}.jpg"
-        output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-        
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        image.save(output_path, 'JPEG', quality=95, optimize=True)
-        
-    else:  # PNG por defecto
-        output_filename = f"diploma_{safe_name}_{timestamp}.png"
-        output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-        
-        image.save(output_path, 'PNG', optimize=True)
-    
-    return output_filename, output_path
-
-def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
-
-def extract_names_from_file(file):
-    """Extrae nombres de diferentes tipos de archivos"""
-    names = []
-    filename = file.filename.lower()
-    
-    try:
-        if filename.endswith('.txt'):
-            content = file.read().decode('utf-8', errors='ignore')
-            file.seek(0)
-            lines = content.strip().split('\n')
-            names = [line.strip() for line in lines if line.strip()]
-        
-        elif filename.endswith('.csv'):
-            content = file.read().decode('utf-8', errors='ignore')
-            file.seek(0)
-            lines = content.strip().split('\n')
-            for i, line in enumerate(lines):
-                if i == 0 and 'nombre' in line.lower():
-                    continue
-                parts = line.strip().split(',')
-                if parts and parts[0].strip():
-                    names.append(parts[0].strip())
-        
-        elif filename.endswith(('.xlsx', '.xls')):
-            df = pd.read_excel(file)
-            file.seek(0)
-            for col in df.columns:
-                if any(keyword in str(col).lower() for keyword in ['nombre', 'name', 'participante', 'alumno']):
-                    names = [str(name).strip() for name in df[col].dropna().tolist() if str(name).strip()]
-                    break
-            if not names and len(df.columns) > 0:
-                names = [str(name).strip() for name in df[df.columns[0]].dropna().tolist() if str(name).strip()]
-    
-    except Exception as e:
-        print(f"Error procesando archivo: {e}")
-        return []
-    
-    return names
-
-def get_text_dimensions(text, font, draw):
-    """Obtiene dimensiones del texto para centrado preciso"""
-    try:
-        if hasattr(draw, 'textbbox'):
-            bbox = draw.textbbox((0, 0), text, font=font)
-            return bbox[2] - bbox[0], bbox[3] - bbox[1]
-        else:
-            return font.getsize(text)
-    except:
-        return len(text) * font.size // 2, font.size
-
-def get_centered_position(x, y, text, font, draw):
-    """Calcula la posición para que (x,y) sea el CENTRO del texto"""
-    ancho, alto = get_text_dimensions(text, font, draw)
-    return x - (ancho // 2), y - (alto // 2)
-
-def get_font_path(font_name, style='normal'):
-    """Obtiene la ruta completa de una fuente con estilo"""
-    font_mappings = {
-        'arial.ttf': {
-            'normal': ['arial.ttf', 'arial.ttf', 'Arial.ttf', 'arial.ttf'],
-            'bold': ['arialbd.ttf', 'arialb.ttf', 'Arial-Bold.ttf', 'arialbd.ttf'],
-            'italic': ['ariali.ttf', 'ariali.ttf', 'Arial-Italic.ttf', 'ariali.ttf']
-        },
-        'times.ttf': {
-            'normal': ['times.ttf', 'times.ttf', 'TimesNewRoman.ttf', 'times.ttf'],
-            'bold': ['timesbd.ttf', 'timesb.ttf', 'TimesNewRomanBold.ttf', 'timesbd.ttf']
-        },
-        'cour.ttf': {
-            'normal': ['cour.ttf', 'cour.ttf', 'CourierNew.ttf', 'cour.ttf'],
-            'bold': ['courbd.ttf', 'courb.ttf', 'CourierNewBold.ttf', 'courbd.ttf']
-        }
-    }
-    
-    font_paths = [
-        app.config['FONTS_FOLDER'],
-        os.path.join(os.path.dirname(__file__), 'fonts'),
-        "fonts/",
-        "/usr/share/fonts/",
-        "/usr/local/share/fonts/",
-        "/System/Library/Fonts/",
-        "/Library/Fonts/",
-        "C:\\Windows\\Fonts\\",
-        "C:/Windows/Fonts/"
-    ]
-    
-    base_name = font_name.lower()
-    if base_name in font_mappings and style in font_mappings[base_name]:
-        font_variants = font_mappings[base_name][style]
-    else:
-        font_variants = [font_name]
-    
-    for path in font_paths:
-        if not os.path.exists(path):
-            continue
-        for variant in font_variants:
-            font_path = os.path.join(path, variant)
-            if os.path.exists(font_path):
-                print(f"✓ Encontrada fuente: {font_path}")
-                return font_path
-    
-    return None
-
-def create_fallback_font(font_size):
-    """Crea una fuente por defecto si no hay fuentes disponibles"""
-    try:
-        for path in ['/usr/share/fonts/TTF/DejaVuSans.ttf', 
-                    '/usr/share/fonts/liberation/LiberationSans-Regular.ttf',
-                    '/System/Library/Fonts/Helvetica.ttc']:
-            if os.path.exists(path):
-                return ImageFont.truetype(path, font_size)
-    except:
-        pass
-    
-    try:
-        return ImageFont.load_default().font_variant(size=font_size)
-    except:
-        return ImageFont.load_default()
-
-def load_font(font_name, font_size, font_style='normal'):
-    """Carga una fuente con estilo con manejo de errores mejorado"""
-    try:
-        font_path = get_font_path(font_name, font_style)
-        if font_path and os.path.exists(font_path):
-            return ImageFont.truetype(font_path, font_size)
-        
-        font_path = get_font_path(font_name, 'normal')
-        if font_path and os.path.exists(font_path):
-            font = ImageFont.truetype(font_path, font_size)
-            if font_style == 'bold':
-                return ImageFont.truetype(font_path, int(font_size * 1.1))
-            elif font_style == 'italic':
-                return font
-            return font
-        
-        print(f"⚠ No se encontró la fuente {font_name}. Usando fuente por defecto.")
-        return create_fallback_font(font_size)
-        
-    except Exception as e:
-        print(f"⚠ Error cargando fuente {font_name}: {e}")
-        return create_fallback_font(font_size)
-
 @app.route('/')
 def index():
     server_url = get_server_url()
@@ -327,41 +306,22 @@ def upload_template():
         
         filename = secure_filename(template_file.filename)
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        template_file.save(filepath)
+        file_hash = save_upload_stream(template_file.stream, filepath)
         
         try:
-            with Image.open(filepath) as img:
-                width, height = img.size
-                
-                # Crear miniatura para vista previa
-                preview_size = (800, 600)
-                img_copy = img.copy()
-                
-                # Compatibilidad con versiones de Pillow
-                try:
-                    img_copy.thumbnail(preview_size, Image.Resampling.LANCZOS)
-                except AttributeError:
-                    try:
-                        img_copy.thumbnail(preview_size, Image.ANTIALIAS)
-                    except AttributeError:
-                        img_copy.thumbnail(preview_size)
-                
-                preview_filename = 'preview_' + filename
-                preview_path = os.path.join(app.config['UPLOAD_FOLDER'], preview_filename)
-                
-                if img_copy.mode != 'RGB':
-                    img_copy = img_copy.convert('RGB')
-                
-                img_copy.save(preview_path, 'JPEG', quality=80)
-                
-                return jsonify({
-                    'success': True,
-                    'filename': filename,
-                    'preview_filename': preview_filename,
-                    'filepath': filepath,
-                    'dimensions': {'width': width, 'height': height},
-                    'url': url_for('uploaded_file', filename=preview_filename)
-                })
+            preview_filename = 'preview_' + filename
+            preview_path = os.path.join(app.config['UPLOAD_FOLDER'], preview_filename)
+            width, height = create_preview(filepath, preview_path)
+            
+            return jsonify({
+                'success': True,
+                'filename': filename,
+                'preview_filename': preview_filename,
+                'filepath': filepath,
+                'hash': file_hash,
+                'dimensions': {'width': width, 'height': height},
+                'url': url_for('uploaded_file', filename=preview_filename)
+            })
                 
         except Exception as e:
             return jsonify({'error': f'Error procesando imagen: {str(e)}'}), 500
@@ -374,6 +334,7 @@ def process_names():
     """Procesa los nombres desde diferentes fuentes"""
     try:
         names = []
+        roster = []
         source_type = request.form.get('source_type', 'text')
         
         if source_type == 'text':
@@ -384,23 +345,64 @@ def process_names():
         elif source_type == 'file' and 'names_file' in request.files:
             file = request.files['names_file']
             if file and allowed_file(file.filename):
-                names = extract_names_from_file(file)
+                # Listado con columna de plantilla: se conserva la clave de cada fila
+                roster = extract_roster_from_file(file)
+                names = [name for name, _ in roster]
         
         names = list(dict.fromkeys([name for name in names if name and len(name.strip()) > 0]))
         
         if not names:
             return jsonify({'error': 'No se encontraron nombres válidos'}), 400
         
-        return jsonify({
+        result = {
             'success': True,
             'names': names,
             'count': len(names)
-        })
+        }
+        
+        # Filas listas para 'names' de /generate-diplomas (con 'templates' para cada clave)
+        rows = list(dict.fromkeys(roster)) if any(key for _, key in roster) else [(name, None) for name in names]
+        if any(key for _, key in rows):
+            result['rows'] = [{'name': name, 'template': key} for name, key in rows]
+            result['templates'] = sorted({key for _, key in rows if key})
+        
+        # Cada listado queda guardado; con el id de uno anterior se devuelve qué cambió
+        result['roster_id'] = save_roster(rows)
+        previous_roster_id = request.form.get('previous_roster_id')
+        if previous_roster_id:
+            previous = load_roster(previous_roster_id)
+            if previous is None:
+                return jsonify({'error': f'Listado anterior no encontrado: {previous_roster_id}'}), 404
+            result['previous_roster_id'] = previous_roster_id
+            result['diff'] = diff_rosters(previous, rows)
+        
+        return jsonify(result)
     
     except Exception as e:
         return jsonify({'error': f'Error al procesar nombres: {str(e)}'}), 500
 
+def preview_cache_key(data):
+    """Clave de caché de una vista previa (None si la petición no es válida)"""
+    template_path = data.get('template_path')
+    if not template_path or not os.path.exists(template_path):
+        return None
+    text_config = data.get('text_config', {})
+    sample_text = text_config.get('sample_text', 'José María Rodríguez')
+    return render_cache_key('preview', template_path, parse_text_config(text_config), sample_text)
+
+def cached_preview(data):
+    """Devuelve la vista previa desde la caché sin pasar por el planificador"""
+    try:
+        key = preview_cache_key(data)
+    except Exception:
+        return None
+    cached = render_cache.get(key) if key else None
+    if cached is None:
+        return None
+    return app.response_class(cached, mimetype='application/json')
+
 @app.route('/preview-position', methods=['POST'])
+@scheduled(lambda data: 1, fast_path=cached_preview)
 def preview_position():
     """Crea una vista previa con el texto centrado en la posición indicada"""
     try:
@@ -414,37 +416,27 @@ def preview_position():
         if not template_path or not os.path.exists(template_path):
             return jsonify({'error': 'Plantilla no encontrada'}), 400
         
-        # Configuración (estos valores son el CENTRO deseado)
-        centro_x = int(text_config.get('x', 100))
-        centro_y = int(text_config.get('y', 100))
-        font_size = int(text_config.get('font_size', 40))
-        font_color = text_config.get('font_color', '#000000')
-        font_name = text_config.get('font_name', 'arial.ttf')
-        font_style = text_config.get('font_style', 'normal')
+        # Configuración (x, y son el CENTRO deseado)
+        config = parse_text_config(text_config)
+        centro_x, centro_y = config['x'], config['y']
         sample_text = text_config.get('sample_text', 'José María Rodríguez')
         
-        if font_color.startswith('#'):
-            font_color = tuple(int(font_color[i:i+2], 16) for i in (1, 3, 5))
-        else:
-            font_color = (0, 0, 0)
-        
-        with Image.open(template_path) as img:
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
+        # Copia de la plantilla compartida (decodificada una sola vez por hash)
+        timeout = app.config['MEMORY_WAIT_TIMEOUT']
+        with shared_templates.use(template_path, timeout, 'JPG') as template, \
+             memory_budget.hold(template.width * template.height * len(template.getbands()), timeout):
+            img = template.copy()
             
             draw = ImageDraw.Draw(img)
             
-            font = load_font(font_name, font_size, font_style)
-            
-            # Calcular posición de esquina para que el centro sea (centro_x, centro_y)
-            x, y = get_centered_position(centro_x, centro_y, sample_text, font, draw)
+            font = load_font(config['font_name'], config['font_size'], config['font_style'])
             
             # Dibujar un punto rojo en el centro para referencia
             radio = 3
             draw.ellipse((centro_x - radio, centro_y - radio, centro_x + radio, centro_y + radio), fill='red')
             
-            # Dibujar texto centrado
-            draw.text((x, y), sample_text, font=font, fill=font_color)
+            # Dibujar texto centrado, con shaping si el nombre de muestra lo necesita
+            draw_text_centered(img, sample_text, font, config_for_mode(config, img.mode))
             
             buffered = io.BytesIO()
             img.save(buffered, format="JPEG", quality=85)
@@ -452,20 +444,208 @@ def preview_position():
             
             img_str = base64.b64encode(buffered.read()).decode()
             
-            return jsonify({
+            body = json.dumps({
                 'success': True,
                 'preview': f'data:image/jpeg;base64,{img_str}',
                 'position': {'x': centro_x, 'y': centro_y},
                 'dimensions': {'width': img.width, 'height': img.height}
-            })
+            }).encode('utf-8')
+            render_cache.put(preview_cache_key(data), body)
+            
+            return app.response_class(body, mimetype='application/json')
     
+    except MemoryBudgetTimeout as e:
+        return jsonify({'error': f'Servidor ocupado: {str(e)}'}), 503
     except Exception as e:
-        print(f"❌ Error en vista previa: {str(e)}")
+        logger.error("Error en vista previa: %s", e)
         return jsonify({'error': f'Error en vista previa: {str(e)}'}), 500
 
+def write_manifest(job, issued, generated_files, file_mapping):
+    """Relación archivo -> id de verificación (verificacion.csv), para imprimir los QR o publicarla"""
+    manifest_path = os.path.join(job.dir, 'verificacion.csv')
+    with open(manifest_path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['archivo', 'nombre', 'id', 'verificar'])
+        for filename in generated_files:
+            issued_id = issued.ids[filename]
+            writer.writerow([filename, file_mapping[filename], issued_id,
+                             url_for('verify_diploma', issued_id=issued_id, _external=True)])
+    return manifest_path
+
+def zip_part_setting(data):
+    """Tamaño máximo de cada parte del ZIP en MB (0: un solo ZIP)
+
+    Lanza ValueError si no es un número finito mayor o igual que 0.
+    """
+    value = data.get('zip_part_mb') or app.config['ZIP_PART_MB']
+    try:
+        zip_part_mb = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'Tamaño de parte del ZIP no válido: {value!r}') from None
+    if not math.isfinite(zip_part_mb) or zip_part_mb < 0:
+        raise ValueError(f'Tamaño de parte del ZIP fuera de rango: {value!r} (0 o más MB)')
+    return zip_part_mb
+
+def package_job(job, issued, generated_files, file_mapping, zip_filename, zip_part_mb=0, folders=(),
+                signatures=None, copies=None):
+    """Escribe verificacion.csv y el ZIP (o sus partes) y deja solo el ZIP en el trabajo
+    
+    copies ({entrada: ZIP de origen}) son diplomas de un trabajo anterior que se copian sin
+    recomprimir. Devuelve las rutas de los ZIP; el trabajo y su registro de emisión quedan
+    conservados, junto con la firma de cada grupo para poder regenerar solo lo que cambie.
+    """
+    zip_path = os.path.join(job.dir, zip_filename)
+    manifest_path = write_manifest(job, issued, generated_files, file_mapping)
+    
+    # Los grupos con plantilla propia van en su carpeta dentro del ZIP
+    copies = copies or {}
+    files = [os.path.join(job.dir, filename) for filename in generated_files if filename not in copies]
+    files.append(manifest_path)
+    if zip_part_mb > 0:
+        zip_parts = write_zip_parts(zip_path, files, int(zip_part_mb * 1024 * 1024), job.dir, copies)
+    else:
+        zip_parts = [write_zip(zip_path, files, job.dir, copies)]
+    if signatures:
+        write_job_meta(job.dir, signatures)
+    job.keep = True
+    issued.keep = True
+    
+    # Limpiar archivos individuales (opcional - mantenerlos o eliminarlos)
+    for filename in generated_files + ['verificacion.csv']:
+        file_path = os.path.join(job.dir, filename)
+        if os.path.exists(file_path):
+            try:
+                os.remove(file_path)  # Eliminar individuales, solo mantener el ZIP
+            except:
+                pass
+    for folder in folders:
+        shutil.rmtree(os.path.join(job.dir, folder), ignore_errors=True)
+    
+    return zip_parts
+
+def job_result(job, issued, generated_files, zip_parts, output_format, output_profile):
+    """Respuesta de un trabajo terminado: enlaces de descarga y primeros archivos de ejemplo"""
+    result = {
+        'success': True,
+        'zip_file': os.path.basename(zip_parts[0]),
+        'job_id': job.id,
+        'count': len(generated_files),
+        'download_url': url_for('download_file', filename=job.relpath(os.path.basename(zip_parts[0]))),
+        'format': output_format,
+        'profile': output_profile,
+        'files': generated_files[:5],  # Mostrar primeros 5 como ejemplo
+        'verify_ids': {filename: issued.ids[filename] for filename in generated_files[:5]}
+    }
+    
+    if len(zip_parts) > 1:
+        result['parts'] = [{
+            'file': os.path.basename(part),
+            'size': os.path.getsize(part),
+            'download_url': url_for('download_file', filename=job.relpath(os.path.basename(part)))
+        } for part in zip_parts]
+    
+    return result
+
+class TemplateLoadError(Exception):
+    """No se pudo decodificar la plantilla de un grupo del lote"""
+
+def impose_job(groups, settings, output_profile, engine):
+    """Genera el lote como un único PDF con varios diplomas por hoja, listo para imprenta
+
+    Los grupos van uno tras otro (el PDF se escribe en orden), cada uno desde hoja nueva.
+    Cada diploma se registra como 'archivo.pdf#hoja-celda' en verificacion.csv.
+    """
+    timeout = app.config['MEMORY_WAIT_TIMEOUT']
+    job_started = time.perf_counter()
+    with storage.job([group.template_path for group in groups]) as job, \
+         registry.batch(job.id, groups[0].hash, 'PDF') as issued:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        pdf_filename = f'diplomas_{timestamp}_{settings["up"]}up_{settings["sheet"]}.pdf'
+        writer = ImposedPDF(os.path.join(job.dir, pdf_filename), settings, output_profile)
+        generated_files = []
+        file_mapping = {}
+        group_counts = []
+        scale = None
+        failed_count = 0
+        try:
+            for group in groups:
+                try:
+                    template_key, base_template = shared_templates.acquire(group.template_path, timeout, 'PDF')
+                except MemoryBudgetTimeout:
+                    raise
+                except Exception as e:
+                    raise TemplateLoadError(str(e)) from e
+                
+                try:
+                    config = group.config
+                    font = load_font(config['font_name'], config['font_size'], config['font_style'])
+                    group_engine = resolve_engine(engine, base_template, group.names, font, config)
+                    working_bytes = base_template.width * base_template.height * len(base_template.getbands())
+                    if group_engine == 'numpy':
+                        working_bytes += app.config['NUMPY_BATCH_MB'] * 1024 * 1024
+                    
+                    count = 0
+                    with memory_budget.hold(working_bytes, timeout):
+                        for name, position, error in impose_names(writer, base_template, group.names,
+                                                                  font, config, group_engine):
+                            if error:
+                                failed_count += 1
+                                logger.warning("Error con %s: %s", name, error)
+                                continue
+                            entry = f'{pdf_filename}#{position[0]}-{position[1]}'
+                            generated_files.append(entry)
+                            file_mapping[entry] = name
+                            issued.add(entry, name, group.hash)
+                            count += 1
+                    scale = writer.scale if scale is None else min(scale, writer.scale)
+                    group_counts.append({'template': group.key, 'count': count})
+                finally:
+                    shared_templates.release(template_key)
+            
+            if not generated_files:
+                writer.discard()
+                return jsonify({'error': 'No se generó ningún diploma'}), 500
+            writer.close()
+        except BaseException:
+            writer.discard()
+            raise
+        
+        write_manifest(job, issued, generated_files, file_mapping)
+        job.keep = True
+        issued.keep = True
+        
+        logger.info(
+            "Imposición completada: pdf=%s hojas=%d por_hoja=%d hoja=%s perfil=%s grupos=%d generados=%d errores=%d duracion=%.2fs",
+            pdf_filename, writer.sheets, settings['up'], settings['sheet'], output_profile, len(groups),
+            len(generated_files), failed_count, time.perf_counter() - job_started
+        )
+        
+        result = {
+            'success': True,
+            'pdf_file': pdf_filename,
+            'job_id': job.id,
+            'count': len(generated_files),
+            'sheets': writer.sheets,
+            'imposition': dict(settings, scale=round(scale, 4)),
+            'download_url': url_for('download_file', filename=job.relpath(pdf_filename)),
+            'manifest_url': url_for('download_file', filename=job.relpath('verificacion.csv')),
+            'format': 'PDF',
+            'profile': output_profile,
+            'files': generated_files[:5],
+            'verify_ids': {entry: issued.ids[entry] for entry in generated_files[:5]}
+        }
+        if len(groups) > 1 or groups[0].key is not None:
+            result['groups'] = group_counts
+        return jsonify(result)
+
 @app.route('/generate-diplomas', methods=['POST'])
+@scheduled(lambda data: len(data.get('names') or []))
 def generate_diplomas():
-    """Genera los diplomas con los nombres centrados en la posición indicada"""
+    """Genera los diplomas con los nombres centrados en la posición indicada
+    
+    Cada fila de 'names' es un nombre (plantilla del lote) o {'name', 'template'} con una
+    clave de 'templates'; las filas se generan agrupadas por plantilla en un solo ZIP.
+    """
     try:
         data = request.json
         if not data:
@@ -474,115 +654,313 @@ def generate_diplomas():
         template_path = data.get('template_path')
         names = data.get('names', [])
         text_config = data.get('text_config', {})
-        output_format = data.get('output_format', app.config['DEFAULT_FORMAT'])
+        templates = data.get('templates') or {}
+        base_job_id = data.get('base_job_id')
+        output_format = (data.get('output_format') or app.config['DEFAULT_FORMAT']).upper()
+        profile_enabled = bool(data.get('profile', False))
+        engine = (data.get('engine') or app.config['RENDER_ENGINE']).lower()
+        output_profile = (data.get('output_profile') or app.config['DEFAULT_PROFILE']).lower()
+        imposition = data.get('imposition')
         
-        if not template_path or not os.path.exists(template_path):
-            return jsonify({'error': 'Plantilla no encontrada'}), 400
+        if engine not in app.config['RENDER_ENGINES']:
+            return jsonify({'error': f'Motor de render no válido: {engine}'}), 400
         
-        if not names:
-            return jsonify({'error': 'No hay nombres para procesar'}), 400
+        if output_profile not in app.config['OUTPUT_PROFILES']:
+            return jsonify({'error': f'Perfil de salida no válido: {output_profile}'}), 400
         
-        # Configuración (estos valores son el CENTRO deseado)
-        centro_x = int(text_config.get('x', 100))
-        centro_y = int(text_config.get('y', 100))
-        font_size = int(text_config.get('font_size', 40))
-        font_color = text_config.get('font_color', '#000000')
-        font_name = text_config.get('font_name', 'arial.ttf')
-        font_style = text_config.get('font_style', 'normal')
+        if output_format not in available_formats():
+            return jsonify({'error': f'Formato de salida no disponible: {output_format}'}), 400
         
-        if font_color.startswith('#'):
-            font_color = tuple(int(font_color[i:i+2], 16) for i in (1, 3, 5))
-        else:
-            font_color = (0, 0, 0)
+        try:
+            zip_part_mb = zip_part_setting(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        temp_dir = tempfile.mkdtemp()
-        generated_files = []
-        file_mapping = {}  # Para mapear nombre original -> archivo generado
+        if not names:
+            return jsonify({'error': 'No hay nombres para procesar'}), 400
         
+        # Un grupo por plantilla, con su configuración (x, y son el CENTRO deseado)
         try:
-            base_template = Image.open(template_path)
-            if base_template.mode != 'RGB':
-                base_template = base_template.convert('RGB')
-        except Exception as e:
-            return jsonify({'error': f'Error al cargar plantilla: {str(e)}'}), 500
+            groups = group_roster(names, template_path, text_config, templates)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        if not groups:
+            return jsonify({'error': 'No hay nombres para procesar'}), 400
         
-        for i, name in enumerate(names):
+        # Imposición para imprenta: un único PDF con N diplomas por hoja en lugar del ZIP
+        if imposition:
+            if base_job_id:
+                return jsonify({'error': 'La imposición no admite base_job_id: se genera el lote completo'}), 400
+            try:
+                settings = imposition_settings(imposition)
+            except (TypeError, ValueError) as e:
+                return jsonify({'error': str(e)}), 400
             try:
-                img = base_template.copy()
-                draw = ImageDraw.Draw(img)
+                return impose_job(groups, settings, output_profile, engine)
+            except MemoryBudgetTimeout as e:
+                return jsonify({'error': f'Servidor ocupado: {str(e)}'}), 503
+            except TemplateLoadError as e:
+                return jsonify({'error': f'Error al cargar plantilla: {str(e)}'}), 500
+        
+        # Lo que define cada grupo además del nombre; con base_job_id, los diplomas de un trabajo
+        # anterior con la misma firma se copian tal cual y solo se genera lo que cambió
+        signatures = {group.folder or '': group_signature(group.hash, group.config,
+                                                          output_format, output_profile)
+                      for group in groups}
+        reused = {}  # clave del grupo -> [(entrada, nombre, id, ZIP de origen)]
+        if base_job_id:
+            base = load_job_outputs(base_job_id)
+            if base is None:
+                return jsonify({'error': f'Trabajo anterior no encontrado: {base_job_id}'}), 404
+            base_signatures, base_entries = base
+            for group in groups:
+                folder = group.folder or ''
+                if base_signatures.get(folder) != signatures[folder]:
+                    continue
+                remaining = []
+                for name in group.names:
+                    entry = base_entries.get((folder, name))
+                    if entry:
+                        reused.setdefault(group.key, []).append((entry[0], name, entry[1], entry[2]))
+                    else:
+                        remaining.append(name)
+                group.names = remaining
+        
+        # Cada trabajo escribe en su propio directorio; si falla, se elimina entero junto
+        # con su registro de emisión
+        with storage.job([group.template_path for group in groups]) as job, \
+             registry.batch(job.id, groups[0].hash, output_format) as issued:
+            generated_files = []
+            file_mapping = {}  # Para mapear nombre original -> archivo generado
+            
+            def register_output(output_filename, output_path, name, template_key=None):
+                generated_files.append(output_filename)
+                file_mapping[output_filename] = name
+                issued.add(output_filename, name, template_key)
                 
-                font = load_font(font_name, font_size, font_style)
+                logger.debug("Generado: %s", output_filename)
+            
+            timeout = app.config['MEMORY_WAIT_TIMEOUT']
+            
+            def render_group(group):
+                """Genera un grupo en su carpeta; devuelve ([(archivo, ruta, nombre)], errores, motor o None)"""
+                outputs = []
+                failed = 0
+                folder = os.path.join(job.dir, group.folder) if group.folder else job.dir
+                os.makedirs(folder, exist_ok=True)
                 
-                # Calcular posición de esquina para que el centro sea (centro_x, centro_y)
-                x, y = get_centered_position(centro_x, centro_y, name, font, draw)
+                def add_output(output_filename, output_path, name):
+                    outputs.append((os.path.relpath(output_path, job.dir), output_path, name))
                 
-                # Dibujar texto centrado
-                draw.text((x, y), name, font=font, fill=font_color)
+                # Lotes pequeños (diplomas sueltos para rezagados): reutilizar resultados ya codificados.
+                # pil y numpy pueden diferir en los bordes suavizados, así que el motor va en la clave;
+                # 'auto' con menos de NUMPY_MIN_NAMES nombres siempre compone con pil
+                pending = group.names
+                cache_keys = {}
+                cache_engine = engine
+                if engine == 'auto' and len(group.names) < app.config['NUMPY_MIN_NAMES']:
+                    cache_engine = 'pil'
+                if (len(group.names) <= app.config['RENDER_CACHE_MAX_NAMES'] and not profile_enabled
+                        and cache_engine != 'auto'):
+                    pending = []
+                    for name in group.names:
+                        key = render_cache_key('diploma', group.template_path, group.config, name,
+                                               f'{output_format}:{output_profile}:{cache_engine}')
+                        cached = render_cache.get(key)
+                        if cached is None:
+                            cache_keys[name] = key
+                            pending.append(name)
+                        else:
+                            add_output(*write_cached_diploma(cached, name, output_format, folder), name)
                 
-                # Guardar con nombre personalizado en el formato seleccionado
-                output_filename, output_path = save_diploma(img, name, output_format)
+                # Lotes grandes con la granja activa: los trabajadores generan y devuelven los archivos
+                farm = get_farm() if len(pending) >= app.config['FARM_MIN_NAMES'] else None
+                if farm:
+                    results = farm.run(group.template_path, group.config, output_format, output_profile,
+                                       engine, pending, app.config['FARM_WAIT_TIMEOUT'])
+                    for name, payload, error in results:
+                        if error:
+                            failed += 1
+                            logger.warning("Error con %s: %s", name, error)
+                            continue
+                        add_output(*write_cached_diploma(payload, name, output_format, folder), name)
+                    return outputs, failed, 'granja'
                 
-                # También guardar en temp_dir para el ZIP
-                temp_path = os.path.join(temp_dir, output_filename)
-                shutil.copy2(output_path, temp_path)
+                if not pending:
+                    return outputs, failed, None  # nada que renderizar: sin motor
                 
-                generated_files.append(output_filename)
-                file_mapping[output_filename] = name
+                # La plantilla decodificada se comparte entre los trabajos; el grupo la retiene
+                # mientras genera todas sus filas
+                try:
+                    template_key, base_template = shared_templates.acquire(group.template_path, timeout,
+                                                                           output_format)
+                except MemoryBudgetTimeout:
+                    raise
+                except Exception as e:
+                    raise TemplateLoadError(str(e)) from e
                 
-                print(f"✓ Generado: {output_filename}")
+                try:
+                    # La fuente es la misma para todo el grupo: cargarla (y registrarla) una sola vez
+                    config = group.config
+                    font = load_font(config['font_name'], config['font_size'], config['font_style'])
+                    group_engine = resolve_engine(engine, base_template, pending, font, config)
+                    
+                    # Lienzo de trabajo, una copia por hilo de codificación y los buffers del lote numpy;
+                    # con el perfilador activo se codifica en este hilo para que cProfile lo vea
+                    threads = 1 if profiler else encode_threads(base_template)
+                    working_bytes = base_template.width * base_template.height * len(base_template.getbands())
+                    working_bytes *= 1 + (threads if threads > 1 else 0)
+                    if group_engine == 'numpy':
+                        working_bytes += app.config['NUMPY_BATCH_MB'] * 1024 * 1024
+                    
+                    with memory_budget.hold(working_bytes, timeout):
+                        rendered = iter_rendered(base_template, pending, font, config, group_engine)
+                        saved = save_rendered(rendered, output_format, folder, output_profile, threads)
+                        for name, output_filename, output_path, error in saved:
+                            try:
+                                if error:
+                                    raise error
+                                
+                                add_output(output_filename, output_path, name)
+                                
+                                if name in cache_keys:
+                                    with open(output_path, 'rb') as f:
+                                        render_cache.put(cache_keys[name], f.read())
+                            
+                            except Exception as e:
+                                failed += 1
+                                logger.warning("Error con %s: %s", name, e)
+                                continue
+                finally:
+                    shared_templates.release(template_key)
+                return outputs, failed, group_engine
             
-            except Exception as e:
-                print(f"⚠ Error con {name}: {e}")
-                continue
-        
-        if not generated_files:
-            return jsonify({'error': 'No se generó ningún diploma'}), 500
-        
-        # Crear archivo ZIP con todos los diplomas
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        zip_filename = f'diplomas_{timestamp}.zip'
-        zip_path = os.path.join(app.config['OUTPUT_FOLDER'], zip_filename)
-        
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for filename in generated_files:
-                file_path = os.path.join(temp_dir, filename)
-                if os.path.exists(file_path):
-                    zipf.write(file_path, filename)
-        
-        # Limpiar archivos temporales
-        try:
-            shutil.rmtree(temp_dir)
-        except:
-            pass
-        
-        # Limpiar archivos individuales (opcional - mantenerlos o eliminarlos)
-        for filename in generated_files:
-            file_path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
-            if os.path.exists(file_path):
+            profiler = start_job_profiler(profile_enabled)
+            # Cualquier salida (también 503/504/500) deja el perfilador detenido en este hilo
+            try:
+                failed_count = 0
+                job_started = time.perf_counter()
+                
+                # Los grupos se generan a la vez, cada uno con su plantilla y su atlas de glifos;
+                # con el perfilador activo, uno tras otro para que cProfile vea todo el trabajo
+                workers = 1 if profiler else min(app.config['TEMPLATE_GROUP_WORKERS'], len(groups))
                 try:
-                    os.remove(file_path)  # Eliminar individuales, solo mantener el ZIP
-                except:
-                    pass
-        
-        return jsonify({
-            'success': True,
-            'zip_file': zip_filename,
-            'count': len(generated_files),
-            'download_url': url_for('download_file', filename=zip_filename),
-            'format': output_format,
-            'files': generated_files[:5]  # Mostrar primeros 5 como ejemplo
-        })
-        
+                    if workers > 1:
+                        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='xonidip-group') as executor:
+                            results = list(executor.map(render_group, groups))
+                    else:
+                        results = [render_group(group) for group in groups]
+                except MemoryBudgetTimeout as e:
+                    return jsonify({'error': f'Servidor ocupado: {str(e)}'}), 503
+                except FarmTimeout as e:
+                    return jsonify({'error': f'La granja de render no terminó a tiempo: {str(e)}'}), 504
+                except TemplateLoadError as e:
+                    return jsonify({'error': f'Error al cargar plantilla: {str(e)}'}), 500
+                
+                # Registro en el orden de los grupos, con la plantilla de cada fila; los copiados
+                # conservan su id de verificación
+                group_counts = []
+                engines = []
+                copies = {}
+                for group, (outputs, failed, group_engine) in zip(groups, results):
+                    for arcname, name, issued_id, source_zip in reused.get(group.key, []):
+                        generated_files.append(arcname)
+                        file_mapping[arcname] = name
+                        issued.reuse(arcname, issued_id)
+                        copies[arcname] = source_zip
+                    for output_filename, output_path, name in outputs:
+                        register_output(output_filename, output_path, name, group.hash)
+                    failed_count += failed
+                    group_counts.append({'template': group.key,
+                                         'count': len(outputs) + len(reused.get(group.key, []))})
+                    if group_engine:
+                        engines.append(group_engine)
+                # Motor solo si se renderizó algo (copias y caché no pasan por ninguno)
+                engine = ','.join(dict.fromkeys(engines))
+                
+                if not generated_files:
+                    logger.error("Trabajo fallido: formato=%s nombres=%d errores=%d", output_format, len(names), failed_count)
+                    return jsonify({'error': 'No se generó ningún diploma'}), 500
+                
+                # Crear archivo ZIP con todos los diplomas
+                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+                zip_filename = f'diplomas_{timestamp}.zip'
+                zip_parts = package_job(job, issued, generated_files, file_mapping, zip_filename, zip_part_mb,
+                                        [group.folder for group in groups if group.folder], signatures, copies)
+                
+                profile_filename = save_job_profile(profiler, timestamp, job.dir) if profiler else None
+                
+                # Una sola línea de resumen por trabajo
+                logger.info(
+                    "Trabajo completado: zip=%s partes=%d formato=%s perfil=%s%s grupos=%d generados=%d errores=%d duracion=%.2fs",
+                    zip_filename, len(zip_parts), output_format, output_profile,
+                    f' motor={engine}' if engine else '', len(groups),
+                    len(generated_files), failed_count,
+                    time.perf_counter() - job_started
+                )
+                
+                result = job_result(job, issued, generated_files, zip_parts, output_format, output_profile)
+                
+                if len(groups) > 1 or groups[0].key is not None:
+                    result['groups'] = group_counts
+                
+                if base_job_id:
+                    result['base_job_id'] = base_job_id
+                    result['reused'] = len(copies)
+                    result['rendered'] = len(generated_files) - len(copies)
+                
+                if profile_filename:
+                    result['profile_file'] = profile_filename
+                    result['profile_url'] = url_for('download_file', filename=job.relpath(profile_filename))
+                
+                return jsonify(result)
+            finally:
+                if profiler:
+                    profiler.disable()
+
     except Exception as e:
-        print(f"❌ Error al generar diplomas: {str(e)}")
+        logger.exception("Error al generar diplomas: %s", e)
         return jsonify({'error': f'Error al generar diplomas: {str(e)}'}), 500
 
-@app.route('/download/<filename>')
+def send_output_file(filepath, filename):
+    """Envía un archivo de salida con soporte de Range/ETag o delegándolo al proxy"""
+    download_name = os.path.basename(filename)
+    offload = app.config['DOWNLOAD_OFFLOAD']
+    
+    if offload == 'x-accel':
+        # nginx sirve el archivo (sendfile, Range, reanudación) desde una location interna
+        response = app.response_class(mimetype='application/octet-stream')
+        response.headers['X-Accel-Redirect'] = app.config['DOWNLOAD_ACCEL_PREFIX'] + filename
+        response.headers['Content-Disposition'] = f'attachment; filename="{secure_filename(download_name)}"'
+        return response
+    
+    # conditional=True: respuestas 206 para Range, 304 para If-None-Match/If-Modified-Since
+    return send_file(os.path.abspath(filepath), as_attachment=True, download_name=download_name,
+                     conditional=True, etag=True, max_age=app.config['DOWNLOAD_MAX_AGE'])
+
+# Lo que un trabajo ofrece para descargar: ZIP, diplomas sueltos, PDF impuesto con su
+# verificacion.csv y el perfil de cProfile. Nunca .part, trabajo.json ni carpetas internas (.cache)
+DOWNLOAD_EXTENSIONS = {'.zip', '.png', '.jpg', '.pdf', '.webp', '.avif', '.csv', '.prof'}
+
+def downloadable(filename):
+    """True si la ruta es un archivo de salida directamente dentro de la carpeta de un trabajo"""
+    parts = filename.split('/')
+    if len(parts) != 2 or not JOB_ID_PATTERN.match(parts[0]):
+        return False
+    name = parts[1]
+    return (not name.startswith('.') and name != JOB_META
+            and os.path.splitext(name)[1].lower() in DOWNLOAD_EXTENSIONS)
+
+@app.route('/download/<path:filename>')
 def download_file(filename):
     try:
-        filepath = os.path.join(app.config['OUTPUT_FOLDER'], filename)
-        if os.path.exists(filepath):
-            return send_file(filepath, as_attachment=True, download_name=filename)
+        if not downloadable(filename):
+            return jsonify({'error': 'Archivo no encontrado'}), 404
+        
+        filepath = safe_join(app.config['OUTPUT_FOLDER'], filename)
+        if filepath and os.path.isfile(filepath):
+            return send_output_file(filepath, filename)
         else:
             return jsonify({'error': 'Archivo no encontrado'}), 404
     except Exception as e:
@@ -591,7 +969,8 @@ def download_file(filename):
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     try:
-        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+        # Ruta absoluta: send_from_directory resolvería una relativa desde la carpeta de la app, no desde cwd
+        return send_from_directory(os.path.abspath(app.config['UPLOAD_FOLDER']), filename)
     except:
         return '', 404
 
@@ -668,12 +1047,252 @@ def get_available_fonts_api():
     
     return jsonify({'fonts': available_fonts})
 
+@app.route('/queue-status', methods=['GET'])
+def queue_status():
+    """Estado del planificador de trabajos"""
+    return jsonify(scheduler.status())
+
+# ===== INGESTA EN STREAMING =====
+@app.route('/ingest', methods=['POST'])
+def open_ingest_batch():
+    """Abre un lote al que el sistema de registro envía los nombres a medida que llegan"""
+    data = request.get_json(silent=True) or {}
+    template_path = data.get('template_path')
+    templates = data.get('templates') or {}
+    output_format = (data.get('output_format') or app.config['DEFAULT_FORMAT']).upper()
+    output_profile = (data.get('output_profile') or app.config['DEFAULT_PROFILE']).lower()
+    
+    if output_profile not in app.config['OUTPUT_PROFILES']:
+        return jsonify({'error': f'Perfil de salida no válido: {output_profile}'}), 400
+    
+    if output_format not in available_formats():
+        return jsonify({'error': f'Formato de salida no disponible: {output_format}'}), 400
+    
+    if not template_path and not templates:
+        return jsonify({'error': 'Plantilla no encontrada'}), 400
+    
+    # Las plantillas se comprueban al abrir, no con la primera fila de cada una
+    roster = Roster(template_path, data.get('text_config', {}), templates)
+    try:
+        for key in ([None] if template_path else []) + list(templates):
+            roster.group(key)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        batch = open_batches.create(roster, output_format, output_profile, bool(data.get('render', True)))
+    except IngestBusy as e:
+        return jsonify({'error': str(e)}), 429
+    
+    logger.info("Lote abierto: %s formato=%s perfil=%s en_vivo=%s", batch.id, output_format,
+                output_profile, batch.render)
+    return jsonify({
+        'success': True,
+        'batch_id': batch.id,
+        'ingest_url': url_for('ingest_names', batch_id=batch.id),
+        'close_url': url_for('close_ingest_batch', batch_id=batch.id)
+    })
+
+def ingest_rows_cost(data):
+    """Filas del envío para el planificador (un cuerpo NDJSON en streaming cuenta como una)"""
+    return len(data) if isinstance(data, list) else 1
+
+@app.route('/ingest/<batch_id>', methods=['POST'])
+@scheduled(ingest_rows_cost)
+def ingest_names(batch_id):
+    """Agrega filas al lote: NDJSON (una por línea, se procesa mientras llega) o un arreglo JSON"""
+    batch = open_batches.get(batch_id)
+    if batch is None:
+        return jsonify({'error': 'Lote no encontrado o ya cerrado'}), 404
+    
+    if request.mimetype == 'application/json':
+        rows = request.get_json(silent=True)
+        if not isinstance(rows, list):
+            return jsonify({'error': 'Se esperaba un arreglo JSON de filas'}), 400
+        lines = ((line_no, row, None) for line_no, row in enumerate(rows, start=1))
+    else:
+        lines = iter_ndjson(request.stream)
+    
+    added = duplicates = 0
+    errors = []
+    try:
+        for line_no, row, error in lines:
+            if error is None:
+                try:
+                    if batch.add(row):
+                        added += 1
+                    else:
+                        duplicates += 1
+                    continue
+                except ValueError as e:
+                    error = str(e)
+                except Exception as e:
+                    logger.warning("Error con la fila %d del lote %s: %s", line_no, batch_id, e)
+                    error = str(e)
+            errors.append({'line': line_no, 'error': error})
+    except IngestClosed as e:
+        return jsonify({'error': str(e), 'added': added, 'duplicates': duplicates}), 409
+    except ValueError as e:
+        errors.append({'line': None, 'error': str(e)})
+    
+    return jsonify({
+        'success': True,
+        'added': added,
+        'duplicates': duplicates,
+        'error_count': len(errors),
+        'errors': errors[:20],
+        'batch': batch.status()
+    })
+
+@app.route('/ingest/<batch_id>', methods=['GET'])
+def ingest_status(batch_id):
+    batch = open_batches.get(batch_id)
+    if batch is None:
+        return jsonify({'error': 'Lote no encontrado o ya cerrado'}), 404
+    return jsonify(batch.status())
+
+def ingest_close_cost(data):
+    """Diplomas que faltan por generar al cerrar el lote (para el planificador)"""
+    batch = open_batches.get(request.view_args.get('batch_id'))
+    return max(1, len(batch.pending)) if batch else 1
+
+@app.route('/ingest/<batch_id>/close', methods=['POST'])
+@scheduled(ingest_close_cost)
+def close_ingest_batch(batch_id):
+    """Genera lo pendiente del lote y arma el ZIP con todo lo recibido"""
+    data = request.get_json(silent=True) or {}
+    try:
+        zip_part_mb = zip_part_setting(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    batch = open_batches.pop(batch_id)
+    if batch is None:
+        return jsonify({'error': 'Lote no encontrado o ya cerrado'}), 404
+    
+    started = time.perf_counter()
+    try:
+        batch.finish()
+        if not batch.outputs:
+            return jsonify({'error': 'No se generó ningún diploma'}), 500
+        
+        generated_files = [filename for filename, _ in batch.outputs]
+        file_mapping = dict(batch.outputs)
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        zip_filename = f'diplomas_{timestamp}.zip'
+        folders = [group.folder for group in batch.roster.groups.values() if group.folder]
+        signatures = {group.folder or '': group_signature(group.hash, group.config,
+                                                          batch.output_format, batch.profile)
+                      for group in batch.roster.groups.values()}
+        zip_parts = package_job(batch.job, batch.issued, generated_files, file_mapping, zip_filename,
+                                zip_part_mb, folders, signatures)
+        
+        logger.info(
+            "Lote cerrado: %s zip=%s partes=%d formato=%s recibidos=%d generados=%d duplicados=%d errores=%d cierre=%.2fs",
+            batch.id, zip_filename, len(zip_parts), batch.output_format, batch.received,
+            len(generated_files), batch.duplicates, batch.failed, time.perf_counter() - started
+        )
+        
+        result = job_result(batch.job, batch.issued, generated_files, zip_parts, batch.output_format,
+                            batch.profile)
+        result['status'] = batch.status()
+        return jsonify(result)
+    
+    except MemoryBudgetTimeout as e:
+        # Lo generado se conserva: el lote vuelve a quedar abierto para reintentar el cierre
+        open_batches.restore(batch)
+        batch = None
+        return jsonify({'error': f'Servidor ocupado: {str(e)}'}), 503
+    except Exception as e:
+        logger.exception("Error al cerrar el lote %s: %s", batch_id, e)
+        return jsonify({'error': f'Error al cerrar el lote: {str(e)}'}), 500
+    finally:
+        if batch is not None:
+            batch.release()
+
+# ===== GRANJA: COLA POR HTTP PARA TRABAJADORES EN OTROS EQUIPOS =====
+def farm_endpoint(view):
+    """Decorador: solo con la granja activa y FARM_TOKEN; exige 'Authorization: Bearer <token>'"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = app.config['FARM_TOKEN']
+        if not token or get_farm() is None:
+            return jsonify({'error': 'La granja no se sirve por HTTP'}), 404
+        supplied = request.headers.get('Authorization', '').encode('utf-8')
+        if not hmac.compare_digest(supplied, f'Bearer {token}'.encode('utf-8')):
+            return jsonify({'error': 'Token de la granja no válido'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/farm/templates/<key>', methods=['GET'])
+@farm_endpoint
+def farm_template(key):
+    data = get_farm().queue.get_template(key)
+    if data is None:
+        return jsonify({'error': 'Plantilla no publicada en la cola'}), 404
+    return send_file(io.BytesIO(data), mimetype='application/octet-stream')
+
+@app.route('/farm/claim', methods=['POST'])
+@farm_endpoint
+def farm_claim():
+    data = request.get_json(silent=True) or {}
+    task = get_farm().queue.claim(str(data.get('worker') or request.remote_addr),
+                                  float(data.get('lease_seconds') or app.config['FARM_LEASE_SECONDS']),
+                                  float(data.get('speculate_factor') or 0))
+    if task is None:
+        return '', 204
+    return jsonify(task)
+
+@app.route('/farm/tasks/<task_id>/touch', methods=['POST'])
+@farm_endpoint
+def farm_touch(task_id):
+    data = request.get_json(silent=True) or {}
+    get_farm().queue.touch(task_id, str(data.get('worker', '')),
+                           float(data.get('lease_seconds') or app.config['FARM_LEASE_SECONDS']))
+    return jsonify({'success': True})
+
+@app.route('/farm/tasks/<task_id>/complete', methods=['POST'])
+@farm_endpoint
+def farm_complete(task_id):
+    """Resultados de una tarea (pack_results); solo cuenta la primera entrega"""
+    # Una tarea puede superar MAX_CONTENT_LENGTH (pensado para subidas): se lee la entrada
+    # directamente, acotada a su Content-Length
+    stream = LimitedStream(request.environ['wsgi.input'], request.content_length or 0)
+    try:
+        results = unpack_results(stream)
+    except ValueError as e:
+        return jsonify({'error': f'Resultados no válidos: {str(e)}'}), 400
+    accepted = get_farm().queue.complete(task_id, request.args.get('worker', ''), results)
+    return jsonify({'accepted': bool(accepted)})
+
+@app.route('/farm/tasks/<task_id>/fail', methods=['POST'])
+@farm_endpoint
+def farm_fail(task_id):
+    data = request.get_json(silent=True) or {}
+    get_farm().queue.fail(task_id, str(data.get('worker', '')), str(data.get('error') or 'error desconocido'))
+    return jsonify({'success': True})
+
+@app.route('/verify/<issued_id>', methods=['GET'])
+def verify_diploma(issued_id):
+    """Consulta de solo lectura: ¿este id corresponde a un diploma emitido?"""
+    issued_id = issued_id.lower()
+    if len(issued_id) != 20 or any(c not in '0123456789abcdef' for c in issued_id):
+        return jsonify({'valid': False, 'error': 'Identificador no válido'}), 400
+    
+    record = registry.lookup(issued_id)
+    if record is None:
+        return jsonify({'valid': False, 'error': 'Diploma no encontrado'}), 404
+    return jsonify({'valid': True, **record})
+
 @app.route('/get-output-formats', methods=['GET'])
 def get_output_formats():
-    """Devuelve los formatos de salida disponibles"""
+    """Devuelve los formatos y perfiles de salida, con el tiempo y tamaño medidos por perfil"""
     return jsonify({
-        'formats': app.config['OUTPUT_FORMATS'],
-        'default': app.config['DEFAULT_FORMAT']
+        'formats': available_formats(),
+        'default': app.config['DEFAULT_FORMAT'],
+        'profiles': list(app.config['OUTPUT_PROFILES']),
+        'default_profile': app.config['DEFAULT_PROFILE'],
+        'profile_stats': encoder_stats.summary()
     })
 
 if __name__ == '__main__':
@@ -701,6 +1320,7 @@ if __name__ == '__main__':
     
     
     try:
+        import qrcode
         qr_ascii = qrcode.QRCode()
         qr_ascii.add_data(server_url)
         print("\nEscanea este código QR desde tu teléfono:")
@@ -710,15 +1330,20 @@ if __name__ == '__main__':
     except:
         pass
     
+    # Limpieza periódica de uploads/ y diplomas_generados/ (TTL y cuota)
+    storage.start()
+    
     print("\n" + "=" * 70)
     print("XONIDU - Darian Alberto Camacho Salas")
     print("Servidor iniciado correctamente")
     print("El navegador se abrirá automáticamente en unos segundos...")
     print("=" * 70)
     
+    # Lanzado en el mismo intérprete por start.py: sin reloader (no duplicar hilos ni procesos)
     app.run(
         debug=True,
         host='0.0.0.0',
         port=5000,
-        threaded=True
+        threaded=True,
+        use_reloader=os.environ.get('XONIDIP_IN_PROCESS') != '1'
     )
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+XONIDIP 2026 - Banco de pruebas de rendimiento
+Mide el render de nombres con el mismo nucleo que el servidor, sin Flask.
+
+Ejemplo:
+    python xonidip_bench.py --names 10000 --size 3508x2480 --font-name arial.ttf
+
+Desarrollado por: Darian Alberto Camacho Salas
+Organizacion: XONIDU
+"""
+
+import argparse
+import io
+import random
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageChops, ImageDraw
+
+import xonidip_core as core
+
+FIRST_NAMES = ['José', 'María', 'Ana', 'Luis', 'Sofía', 'Carlos', 'Lucía', 'Andrés', 'Valentina',
+               'Íñigo', 'Camila', 'Diego', 'Fernanda', 'Ángel', 'Renata', 'Mateo', 'Ximena', 'Raúl']
+LAST_NAMES = ['Rodríguez', 'Camacho', 'Salas', 'Pérez', 'Núñez', 'Gómez', 'Hernández', 'López',
+              'Martínez', 'Ibáñez', 'Vargas', 'Torres', 'Muñoz', 'Ortega', 'Castillo', 'Ávila']
+
+# Nombres en escrituras que necesitan shaping (hebreo, árabe, devanagari)
+COMPLEX_NAMES = ['שרה לוי', 'דוד כהן', 'محمد علي', 'فاطمة الزهراء', 'अर्जुन शर्मा', 'प्रिया पटेल']
+
+def synthetic_names(count, seed=2026):
+    """Nombres de prueba reproducibles (nombre + dos apellidos)"""
+    rng = random.Random(seed)
+    return [f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {rng.choice(LAST_NAMES)}'
+            for _ in range(count)]
+
+def load_bench_template(args):
+    if args.template:
+        return core.load_template(args.template)
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    return Image.new('RGB', (width, height), (250, 248, 240))
+
+def draw_with_imagedraw(img, name, font, config):
+    """Referencia: el camino original con ImageDraw.text"""
+    draw = ImageDraw.Draw(img)
+    x, y = core.get_centered_position(config['x'], config['y'], name, font, draw)
+    draw.text((x, y), name, font=font, fill=config['font_color'])
+
+def bench_layout(template, names, font, config):
+    """Compara ImageDraw.text con el atlas de glifos sobre un mismo lienzo"""
+    results = []
+    canvas = template.copy()
+
+    started = time.perf_counter()
+    for name in names:
+        draw_with_imagedraw(canvas, name, font, config)
+    results.append(('imagedraw', time.perf_counter() - started))
+
+    atlas = core.get_glyph_atlas(font)
+    if atlas is None:
+        print('  (atlas no disponible para esta fuente: se omite)')
+        return results
+
+    canvas = template.copy()
+    started = time.perf_counter()
+    for name in names:
+        atlas.draw_centered(canvas, config['x'], config['y'], name, config['font_color'])
+    results.append(('atlas', time.perf_counter() - started))
+
+    # Diferencia máxima de píxeles frente a la referencia
+    worst = 0
+    for name in names[:200]:
+        reference, candidate = template.copy(), template.copy()
+        draw_with_imagedraw(reference, name, font, config)
+        atlas.draw_centered(candidate, config['x'], config['y'], name, config['font_color'])
+        extrema = ImageChops.difference(reference, candidate).getextrema()
+        worst = max(worst, max(high for _, high in extrema))
+    print(f'  diferencia maxima atlas vs ImageDraw (200 nombres): {worst}')
+    return results
+
+def bench_compositing(template, names, font, config):
+    """Diploma completo por nombre (sin codificar) con cada motor de iter_rendered"""
+    results = []
+    engines = ['pil', 'numpy'] if core.numpy_available() else ['pil']
+    for engine in engines:
+        if core.resolve_engine(engine, template, names, font, config) != engine:
+            print(f'  (motor {engine} no disponible para esta plantilla/fuente: se omite)')
+            continue
+        started = time.perf_counter()
+        for _, _, error in core.iter_rendered(template, names, font, config, engine=engine):
+            if error:
+                raise error
+        results.append((engine, time.perf_counter() - started))
+    
+    if len(results) == len(engines) > 1:
+        worst = 0
+        sample = names[:200]
+        pil = core.iter_rendered(template, sample, font, config, engine='pil')
+        vectorized = core.iter_rendered(template, sample, font, config, engine='numpy')
+        for (_, reference, _), (_, candidate, _) in zip(pil, vectorized):
+            extrema = ImageChops.difference(reference, candidate).getextrema()
+            worst = max(worst, max(high for _, high in extrema))
+        print(f'  diferencia maxima numpy vs pil (200 nombres): {worst}')
+    return results
+
+def bench_shaping(template, names, font, config):
+    """Listado mixto: un nombre de cada diez en escritura compleja, sin y con la caché de trazos"""
+    mixed = [COMPLEX_NAMES[i // 10 % len(COMPLEX_NAMES)] if i % 10 == 0 else name
+             for i, name in enumerate(names)]
+    results = []
+    for label in ('frio', 'cacheado'):
+        if label == 'frio':
+            core.shaped_runs = core.ShapedRuns(core.shaped_runs.max_bytes)
+        started = time.perf_counter()
+        for _, _, error in core.iter_rendered(template, mixed, font, config, engine='pil'):
+            if error:
+                raise error
+        results.append((f'mixto {label}', time.perf_counter() - started))
+    if not core.raqm_available():
+        print('  (libraqm no disponible: los nombres complejos usan la maquetacion basica)')
+    return results
+
+def bench_encoding(template, names, font, config):
+    """Tiempo y tamaño medio por diploma de cada perfil de salida y formato"""
+    results = []
+    for output_format in core.available_formats():
+        pil_format = core.get_encoder(output_format).pil_format
+        base = core.convert_template(template, core.working_mode(template, output_format))
+        rendered = [img.copy() for _, img, _ in core.iter_rendered(base, names, font, config)]
+        for profile in core.CONFIG['OUTPUT_PROFILES']:
+            options = core.encoder_options(output_format, profile)
+            elapsed = total_bytes = 0
+            for img in rendered:
+                buffer = io.BytesIO()
+                started = time.perf_counter()
+                img.save(buffer, pil_format, **options)
+                elapsed += time.perf_counter() - started
+                total_bytes += buffer.tell()
+            results.append((f'{output_format} {profile}', elapsed, total_bytes / len(names)))
+    return results
+
+def bench_parallel_encoding(template, names, font, config, threads):
+    """Lote completo (composición + guardado) con un hilo frente a varios hilos de codificación"""
+    results = []
+    for output_format in core.available_formats():
+        base = core.convert_template(template, core.working_mode(template, output_format))
+        for count in sorted({1, threads}):
+            with tempfile.TemporaryDirectory() as folder:
+                started = time.perf_counter()
+                rendered = core.iter_rendered(base, names, font, config)
+                for _, _, _, error in core.save_rendered(rendered, output_format, folder, threads=count):
+                    if error:
+                        raise error
+                results.append((f'{output_format} x{count}', time.perf_counter() - started))
+    return results
+
+def print_encoding(results, count):
+    print(f'\nCodificacion ({count} diplomas)')
+    print(f"  {'perfil':<16}{'ms/diploma':>12}{'KB/diploma':>14}")
+    for label, elapsed, size in results:
+        print(f'  {label:<16}{elapsed * 1000 / count:>12.1f}{size / 1024:>14.0f}')
+
+def print_results(title, results, count):
+    print(f'\n{title}')
+    print(f"  {'metodo':<14}{'total (s)':>12}{'nombres/s':>14}")
+    for label, elapsed in results:
+        rate = count / elapsed if elapsed else float('inf')
+        print(f'  {label:<14}{elapsed:>12.3f}{rate:>14.0f}')
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='XONIDIP - banco de pruebas de render')
+    parser.add_argument('--names', type=int, default=10000, help='Cantidad de nombres sinteticos')
+    parser.add_argument('--template', help='Plantilla real (por defecto, lienzo sintetico)')
+    parser.add_argument('--size', default='3508x2480', help='Tamano del lienzo sintetico (AxB)')
+    parser.add_argument('--font-name', default='arial.ttf')
+    parser.add_argument('--font-size', type=int, default=64)
+    parser.add_argument('--font-style', default='normal')
+    parser.add_argument('--encode-samples', type=int, default=20,
+                        help='Diplomas codificados por perfil y formato (0 = omitir)')
+    parser.add_argument('--encode-threads', type=int, default=core.CONFIG['ENCODE_THREADS'],
+                        help='Hilos de codificacion para comparar con un solo hilo')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    template = load_bench_template(args)
+    names = synthetic_names(args.names)
+    config = core.parse_text_config({
+        'x': template.width // 2, 'y': template.height // 2,
+        'font_size': args.font_size, 'font_name': args.font_name, 'font_style': args.font_style,
+    })
+    font = core.load_font(config['font_name'], config['font_size'], config['font_style'])
+
+    print(f'Plantilla {template.width}x{template.height}, {len(names)} nombres, '
+          f'fuente {args.font_name} {args.font_size}px')
+    print_results('Maquetacion y dibujo del texto', bench_layout(template, names, font, config), len(names))
+    print_results('Composicion por diploma', bench_compositing(template, names, font, config), len(names))
+    print_results('Listado multilingue (10% con shaping)', bench_shaping(template, names, font, config),
+                  len(names))
+    if args.encode_samples > 0:
+        sample = names[:args.encode_samples]
+        print_encoding(bench_encoding(template, sample, font, config), len(sample))
+        print_results(f'Guardado en paralelo (perfil {core.CONFIG["DEFAULT_PROFILE"]})',
+                      bench_parallel_encoding(template, sample, font, config, args.encode_threads),
+                      len(sample))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
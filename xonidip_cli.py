@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+XONIDIP 2026 - Modo por lotes sin interfaz
+Genera diplomas desde la linea de comandos usando el mismo nucleo que el
+servidor, sin Flask, sin QR y sin abrir el navegador.
+
+Ejemplo:
+    python xonidip_cli.py plantilla.png nombres.xlsx --x 960 --y 540 --format PDF
+
+Desarrollado por: Darian Alberto Camacho Salas
+Organizacion: XONIDU
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from xonidip_core import (
+    CONFIG, logger, setup_logging, extract_names_from_file, load_font, load_template,
+    parse_text_config, iter_rendered, save_diploma, write_zip, publish_template, MappedTemplate,
+    available_formats, imposition_settings, ImposedPDF, impose_names
+)
+
+# ===== ESTADO POR PROCESO TRABAJADOR =====
+# La plantilla se decodifica una sola vez en el proceso principal y se publica como archivo
+# crudo mapeado; cada proceso la envuelve sin copiarla y carga la fuente una sola vez
+_worker = {}
+
+def _load_worker_state(template, template_array, names, config, output_format, output_folder,
+                       engine, profile):
+    """Deja la plantilla, la lista de nombres y la fuente listas para este proceso"""
+    _worker['template'] = template
+    _worker['array'] = template_array
+    _worker['names'] = names
+    _worker['font'] = load_font(config['font_name'], config['font_size'], config['font_style'])
+    _worker['config'] = config
+    _worker['format'] = output_format
+    _worker['folder'] = output_folder
+    _worker['engine'] = engine
+    _worker['profile'] = profile
+
+def _init_worker(template_spec, *state):
+    """Inicializador de ProcessPoolExecutor: registro propio, plantilla mapeada y estado del lote"""
+    setup_logging(force=True)
+    mapped = _worker['mapped'] = MappedTemplate(template_spec)
+    _load_worker_state(mapped.image, mapped.array(), *state)
+
+def _render_chunk(bounds):
+    """Genera los nombres [inicio, fin) de la lista y devuelve (rutas generadas, errores)"""
+    start, stop = bounds
+    names = _worker['names'][start:stop]
+    generated, failed = [], []
+    rendered = iter_rendered(_worker['template'], names, _worker['font'], _worker['config'],
+                             _worker['engine'], _worker['array'])
+    for name, img, error in rendered:
+        try:
+            if error:
+                raise error
+            _, output_path = save_diploma(img, name, _worker['format'], _worker['folder'],
+                                          _worker['profile'])
+            generated.append(output_path)
+        except Exception as e:
+            failed.append((name, str(e)))
+    return generated, failed
+
+def read_names(path):
+    """Lee los nombres de un archivo TXT/CSV/XLSX reutilizando extract_names_from_file"""
+    with open(path, 'rb') as f:
+        names = extract_names_from_file(f, filename=os.path.basename(path))
+    # Igual que /process-names: sin vacíos ni duplicados, conservando el orden
+    return list(dict.fromkeys(name for name in names if name and name.strip()))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='XONIDIP - Generacion masiva de diplomas sin servidor web'
+    )
+    parser.add_argument('template', help='Plantilla del diploma (PNG/JPG)')
+    parser.add_argument('names_file', help='Archivo de nombres (TXT, CSV, XLSX, XLS)')
+    parser.add_argument('--config', help='Archivo JSON con text_config (como en la interfaz web)')
+    parser.add_argument('--x', type=int, help='Centro horizontal del texto')
+    parser.add_argument('--y', type=int, help='Centro vertical del texto')
+    parser.add_argument('--font-size', type=int, help='Tamano de la fuente')
+    parser.add_argument('--font-color', help='Color en formato #RRGGBB')
+    parser.add_argument('--font-name', help='Archivo de fuente (ej. arial.ttf)')
+    parser.add_argument('--font-style', choices=['normal', 'bold', 'italic'], help='Estilo de la fuente')
+    parser.add_argument('--format', default=CONFIG['DEFAULT_FORMAT'], type=str.upper,
+                        choices=available_formats(), help='Formato de salida')
+    parser.add_argument('--profile', default=CONFIG['DEFAULT_PROFILE'], type=str.lower,
+                        choices=list(CONFIG['OUTPUT_PROFILES']),
+                        help='Perfil de salida: draft (rapido), standard o print (maxima calidad)')
+    parser.add_argument('--output', default=CONFIG['OUTPUT_FOLDER'], help='Carpeta de salida')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Procesos en paralelo (por defecto: numero de CPUs)')
+    parser.add_argument('--chunk-size', type=int, default=50, help='Nombres por tarea')
+    parser.add_argument('--engine', default=CONFIG['RENDER_ENGINE'], type=str.lower,
+                        choices=CONFIG['RENDER_ENGINES'],
+                        help='Motor de composicion (auto: numpy en lotes grandes si esta disponible)')
+    parser.add_argument('--impose', type=int, metavar='N',
+                        help='Imposicion para imprenta: un solo PDF con N diplomas por hoja (sin ZIP)')
+    parser.add_argument('--sheet', default=CONFIG['IMPOSITION']['sheet'], type=str.upper,
+                        choices=list(CONFIG['SHEET_SIZES_MM']), help='Hoja de la imposicion')
+    parser.add_argument('--margin-mm', type=float, default=CONFIG['IMPOSITION']['margin_mm'],
+                        help='Margen de la hoja (ahi van las marcas de corte)')
+    parser.add_argument('--gap-mm', type=float, default=CONFIG['IMPOSITION']['gap_mm'],
+                        help='Separacion entre diplomas de una hoja')
+    parser.add_argument('--dpi', type=float, default=CONFIG['IMPOSITION']['dpi'],
+                        help='Resolucion a la que se imprime la plantilla en la hoja')
+    parser.add_argument('--no-crop-marks', action='store_true', help='Imposicion sin marcas de corte')
+    parser.add_argument('--no-zip', action='store_true', help='No crear ZIP, solo archivos sueltos')
+    parser.add_argument('--keep-files', action='store_true', help='Conservar archivos sueltos junto al ZIP')
+    return parser.parse_args(argv)
+
+def build_text_config(args):
+    """Combina --config con las opciones individuales (estas tienen prioridad)"""
+    text_config = {}
+    if args.config:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            text_config = json.load(f)
+
+    overrides = {
+        'x': args.x, 'y': args.y, 'font_size': args.font_size,
+        'font_color': args.font_color, 'font_name': args.font_name,
+        'font_style': args.font_style,
+    }
+    text_config.update({key: value for key, value in overrides.items() if value is not None})
+    return parse_text_config(text_config)
+
+def run_imposition(args, names, config):
+    """Genera un unico PDF impuesto en este proceso (el PDF se escribe en orden)"""
+    try:
+        settings = imposition_settings({'up': args.impose, 'sheet': args.sheet, 'margin_mm': args.margin_mm,
+                                        'gap_mm': args.gap_mm, 'crop_marks': not args.no_crop_marks,
+                                        'dpi': args.dpi})
+    except ValueError as e:
+        logger.error("%s", e)
+        return 1
+
+    started = time.perf_counter()
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    pdf_path = os.path.join(args.output, f'diplomas_{timestamp}_{settings["up"]}up_{settings["sheet"]}.pdf')
+    template = load_template(args.template, 'PDF')
+    font = load_font(config['font_name'], config['font_size'], config['font_style'])
+    writer = ImposedPDF(pdf_path, settings, args.profile)
+    generated = failed = 0
+    try:
+        engine = 'pil' if args.engine == 'auto' and len(names) < CONFIG['NUMPY_MIN_NAMES'] else args.engine
+        for name, _, error in impose_names(writer, template, names, font, config, engine):
+            if error:
+                failed += 1
+                logger.warning("Error con %s: %s", name, error)
+            else:
+                generated += 1
+        if not generated:
+            writer.discard()
+            logger.error("No se genero ningun diploma")
+            return 1
+        writer.close()
+    except BaseException:
+        writer.discard()
+        raise
+
+    logger.info(
+        "Imposicion completada: pdf=%s hojas=%d por_hoja=%d hoja=%s escala=%.3f perfil=%s generados=%d errores=%d duracion=%.2fs",
+        pdf_path, writer.sheets, settings['up'], settings['sheet'], writer.scale, args.profile, generated, failed,
+        time.perf_counter() - started
+    )
+    return 0
+
+def run(args):
+    """Ejecuta el lote completo; devuelve el codigo de salida"""
+    if not os.path.exists(args.template):
+        logger.error("Plantilla no encontrada: %s", args.template)
+        return 1
+
+    names = read_names(args.names_file)
+    if not names:
+        logger.error("No se encontraron nombres validos en %s", args.names_file)
+        return 1
+
+    config = build_text_config(args)
+    os.makedirs(args.output, exist_ok=True)
+    if args.impose:
+        return run_imposition(args, names, config)
+
+    started = time.perf_counter()
+    # Los procesos reciben la lista una vez; cada tarea solo viaja como (inicio, fin)
+    chunks = [(i, min(i + args.chunk_size, len(names))) for i in range(0, len(names), args.chunk_size)]
+    generated, failed = [], []
+
+    # Los bloques son pequeños: 'auto' se decide con el tamaño total del lote
+    engine = args.engine
+    if engine == 'auto':
+        engine = 'numpy' if len(names) >= CONFIG['NUMPY_MIN_NAMES'] else 'pil'
+
+    state = (names, config, args.format, args.output, engine, args.profile)
+    template = load_template(args.template, args.format)
+    if args.workers <= 1:
+        _load_worker_state(template, None, *state)
+        for chunk_generated, chunk_failed in map(_render_chunk, chunks):
+            generated.extend(chunk_generated)
+            failed.extend(chunk_failed)
+    else:
+        raw_path = os.path.join(args.output, f'.plantilla_{os.getpid()}.raw')
+        template_spec = publish_template(template, raw_path)
+        del template
+        try:
+            with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                                     initargs=(template_spec,) + state) as executor:
+                for chunk_generated, chunk_failed in executor.map(_render_chunk, chunks):
+                    generated.extend(chunk_generated)
+                    failed.extend(chunk_failed)
+        finally:
+            os.remove(raw_path)
+
+    for name, error in failed:
+        logger.warning("Error con %s: %s", name, error)
+
+    if not generated:
+        logger.error("No se genero ningun diploma")
+        return 1
+
+    zip_path = None
+    if not args.no_zip:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        zip_path = write_zip(os.path.join(args.output, f'diplomas_{timestamp}.zip'), generated)
+        if not args.keep_files:
+            for file_path in generated:
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+
+    logger.info(
+        "Lote completado: zip=%s formato=%s perfil=%s generados=%d errores=%d workers=%d duracion=%.2fs",
+        zip_path or '-', args.format, args.profile, len(generated), len(failed), args.workers,
+        time.perf_counter() - started
+    )
+    return 0
+
+def main(argv=None):
+    return run(parse_args(argv))
+
+if __name__ == '__main__':
+    sys.exit(main())
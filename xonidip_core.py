@@ -0,0 +1,2304 @@
+"""
+XONIDIP - Núcleo de generación de diplomas
+Funciones de render compartidas por el servidor Flask (xonidip.py) y el modo
+por lotes sin interfaz (xonidip_cli.py). No importa Flask ni qrcode.
+
+Desarrollado por: Darian Alberto Camacho Salas
+Organizacion: XONIDU
+"""
+
+import os
+import shutil
+import tempfile
+import uuid
+import zipfile
+import hashlib
+import json
+import csv
+import io
+import re
+import difflib
+import sqlite3
+import unicodedata
+import math
+import mmap
+from datetime import datetime
+import time
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+# Configuración compartida (xonidip.py la copia en app.config)
+CONFIG = {
+    'UPLOAD_FOLDER': 'uploads',
+    'OUTPUT_FOLDER': 'diplomas_generados',
+    'FONTS_FOLDER': 'fonts',
+    'ALLOWED_EXTENSIONS': {'png', 'jpg', 'jpeg', 'txt', 'csv', 'xlsx', 'xls'},
+    # Formatos registrados en ENCODERS; WEBP y AVIF solo si Pillow se compiló con ellos
+    'OUTPUT_FORMATS': ['PNG', 'PDF', 'JPG', 'WEBP', 'AVIF'],
+    'DEFAULT_FORMAT': 'PNG',
+    # Perfiles de salida: opciones del codificador por formato (ver xonidip_bench.py)
+    'OUTPUT_PROFILES': {
+        # Pruebas rápidas: compresión mínima
+        'draft': {
+            'PNG': {'compress_level': 1},
+            'JPG': {'quality': 75},
+            'PDF': {'resolution': 100.0, 'quality': 60},
+            'WEBP': {'lossless': True, 'quality': 0, 'method': 0},
+            'AVIF': {'quality': 50, 'speed': 10},
+        },
+        'standard': {
+            'PNG': {'optimize': True},
+            'JPG': {'quality': 95, 'optimize': True},
+            'PDF': {'resolution': 100.0},
+            # WebP sin pérdida: los diplomas son gráficos planos (~40% del tamaño de PNG)
+            'WEBP': {'lossless': True, 'quality': 50, 'method': 3},
+            'AVIF': {'quality': 80, 'speed': 8},
+        },
+        # Imprenta: máxima calidad y sin submuestreo de color. El PDF conserva la misma
+        # resolución que los demás perfiles para que la página mida lo mismo
+        'print': {
+            'PNG': {'optimize': True},
+            'JPG': {'quality': 100, 'subsampling': 0, 'optimize': True},
+            'PDF': {'resolution': 100.0, 'quality': 100, 'subsampling': 0},
+            'WEBP': {'lossless': True, 'quality': 80, 'method': 4},
+            'AVIF': {'quality': 90, 'speed': 6, 'subsampling': '4:4:4'},
+        },
+    },
+    'DEFAULT_PROFILE': 'standard',
+    # Hilos que codifican diplomas en paralelo (Pillow libera el GIL al codificar) y
+    # memoria máxima para las copias en vuelo
+    'ENCODE_THREADS': min(4, os.cpu_count() or 1),
+    'ENCODE_MEMORY_MB': 256,
+    # Grupos de plantilla de un mismo lote que se generan a la vez
+    'TEMPLATE_GROUP_WORKERS': 2,
+    # Imposición para imprenta: N diplomas por hoja en un único PDF de varias páginas
+    'SHEET_SIZES_MM': {'A4': (210, 297), 'A3': (297, 420), 'SRA3': (320, 450),
+                       'LETTER': (215.9, 279.4), 'TABLOID': (279.4, 431.8)},
+    # dpi: resolución a la que se imprime la plantilla en la hoja (tamaño físico del diploma)
+    'IMPOSITION': {'sheet': 'A3', 'up': 2, 'margin_mm': 10, 'gap_mm': 0, 'crop_marks': True, 'dpi': 300},
+    'IMPOSITION_MAX_UP': 16,
+    # Lotes abiertos de ingesta en streaming (xonidip_ingest.py)
+    'INGEST_IDLE_SECONDS': 4 * 3600,  # sin filas nuevas en este tiempo, el lote se descarta
+    'INGEST_MAX_OPEN': 20,
+    'INGEST_MAX_LINE_BYTES': 64 * 1024,
+    # Diferencias entre listados: nombres parecidos (0-1) se consideran corregidos, no nuevos
+    'ROSTER_RENAME_SIMILARITY': 0.85,
+    'ROSTER_FUZZY_MAX_PAIRS': 250000,  # por encima, solo se comparan claves normalizadas
+    # Listados guardados (nombres de asistentes): fuera de OUTPUT_FOLDER, que se sirve en /download
+    'ROSTER_FOLDER': 'listados',
+    # Presupuesto global de memoria para plantillas decodificadas y lienzos de trabajo
+    'MEMORY_BUDGET_MB': int(os.environ.get('XONIDIP_MEMORY_BUDGET_MB', 1024)),
+    'MEMORY_WAIT_TIMEOUT': 300,  # segundos que un trabajo espera turno antes de rechazarse
+    # A partir de este tamaño se reutiliza un único lienzo y solo se restaura la franja del texto
+    'BANDED_MIN_PIXELS': 16 * 1000 * 1000,
+    # Caché de resultados renderizados (vistas previas y diplomas sueltos repetidos)
+    'RENDER_CACHE_MB': 64,
+    'RENDER_CACHE_DISK': True,   # segundo nivel en OUTPUT_FOLDER/.cache
+    'RENDER_CACHE_MAX_NAMES': 5, # solo se cachean lotes de hasta N nombres
+    # Ciclo de vida del almacenamiento (uploads/, diplomas_generados/ y listados/)
+    'STORAGE_TTL_HOURS': {'UPLOAD_FOLDER': 24, 'OUTPUT_FOLDER': 72, 'ROSTER_FOLDER': 72},
+    'STORAGE_QUOTA_MB': {'UPLOAD_FOLDER': 2048, 'OUTPUT_FOLDER': 10240, 'ROSTER_FOLDER': 512},
+    'STORAGE_SWEEP_SECONDS': 600,
+    # Descargas: 0 = un solo ZIP; si no, se divide en partes de como máximo N MB
+    'ZIP_PART_MB': 0,
+    # Atlas de glifos: cada (fuente, tamaño, carácter) se rasteriza una sola vez por proceso
+    'GLYPH_ATLAS': True,
+    # Shaping (Raqm) solo para nombres en escrituras complejas; trazos cacheados por (fuente, tamaño, texto)
+    'TEXT_SHAPING': True,
+    'SHAPING_CACHE_MB': 32,
+    # Motor de composición: 'pil', 'numpy' o 'auto' (numpy en lotes de al menos NUMPY_MIN_NAMES)
+    'RENDER_ENGINE': os.environ.get('XONIDIP_RENDER_ENGINE', 'auto'),
+    'RENDER_ENGINES': ['auto', 'pil', 'numpy'],
+    'NUMPY_MIN_NAMES': 200,
+    'NUMPY_BATCH_NAMES': 32,  # diplomas compuestos por llamada
+    'NUMPY_BATCH_MB': 64,     # tope de los buffers de trabajo de un lote
+    # Granja de render (xonidip_farm.py): '' desactivada, 'memory' o 'sqlite:///ruta/cola.db'.
+    # Con FARM_TOKEN el servidor también sirve su cola en /farm a trabajadores de otros equipos
+    'FARM_QUEUE': os.environ.get('XONIDIP_FARM_QUEUE', ''),
+    'FARM_MIN_NAMES': 200,         # lotes menores se generan en el propio servidor
+    'FARM_CHUNK_NAMES': 25,        # nombres por tarea
+    'FARM_LOCAL_WORKERS': 2,       # hilos trabajadores locales con la cola 'memory'
+    'FARM_LEASE_SECONDS': 120,     # una tarea sin señales de vida en este tiempo se reasigna
+    'FARM_MAX_ATTEMPTS': 3,
+    'FARM_SPECULATE_FACTOR': 3.0,  # duplicar tareas que tardan N veces la media (nodos lentos)
+    'FARM_WAIT_TIMEOUT': 3600,
+    'FARM_TOKEN': os.environ.get('XONIDIP_FARM_TOKEN', ''),  # vacío: la cola no se sirve por red
+    # Registro de diplomas emitidos (fuera de OUTPUT_FOLDER: la limpieza no debe borrarlo)
+    'REGISTRY_PATH': os.environ.get('XONIDIP_REGISTRY', 'registro_diplomas.db'),
+    'REGISTRY_FLUSH_ROWS': 1000,    # filas por transacción durante la generación
+    'REGISTRY_CACHE_SIZE': 10000,   # consultas de /verify en memoria
+}
+
+def ensure_folders():
+    """Crea las carpetas de trabajo si no existen"""
+    for folder in [CONFIG['UPLOAD_FOLDER'], CONFIG['OUTPUT_FOLDER'], CONFIG['FONTS_FOLDER']]:
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+# ===== REGISTRO (LOGGING) NO BLOQUEANTE =====
+logger = logging.getLogger('xonidip')
+
+def setup_logging(level=None, force=False):
+    """Configura el registro con una cola para que el render nunca espere a la consola"""
+    if logger.handlers and not force:
+        return None
+    
+    # En procesos hijos (fork) el hilo del listener no existe: reconstruirlo
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    
+    level = level or os.environ.get('XONIDIP_LOG_LEVEL', 'INFO')
+    log_queue = queue.SimpleQueue()
+    
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('%(asctime)s %(levelname)-7s %(message)s', '%H:%M:%S'))
+    
+    # El hilo del listener es el único que escribe en stdout/stderr
+    listener = logging.handlers.QueueListener(log_queue, console, respect_handler_level=True)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(str(level).upper())
+    logger.propagate = False
+    
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+setup_logging()
+
+# ===== FUNCIÓN PARA NORMALIZAR NOMBRES DE ARCHIVO =====
+def normalize_filename(name):
+    """Normaliza un nombre para uso en nombre de archivo"""
+    # Reemplazar caracteres especiales
+    replacements = {
+        'á': 'a', 'é': 'e', 'í': 'i', 'ó': 'o', 'ú': 'u',
+        'Á': 'A', 'É': 'E', 'Í': 'I', 'Ó': 'O', 'Ú': 'U',
+        'ñ': 'n', 'Ñ': 'N', 'ü': 'u', 'Ü': 'U',
+        ' ': '_', ',': '', '.': '', "'": '', '"': '',
+        '¿': '', '?': '', '¡': '', '!': '', ':': '', ';': '',
+        '/': '_', '\\': '_', '*': '', '|': '', '<': '', '>': ''
+    }
+    
+    for special, normal in replacements.items():
+        name = name.replace(special, normal)
+    
+    # Eliminar caracteres no permitidos
+    name = ''.join(c for c in name if c.isalnum() or c in ('_', '-'))
+    
+    # Limitar longitud y evitar nombres vacíos
+    name = name[:50] if name else "participante"
+    
+    return name
+
+# ===== FUNCIÓN PARA GUARDAR EN DIFERENTES FORMATOS =====
+def encoder_options(output_format, profile=None):
+    """Opciones del codificador para el formato en el perfil indicado (o el por defecto)"""
+    profiles = CONFIG['OUTPUT_PROFILES']
+    options = profiles.get(profile) or profiles[CONFIG['DEFAULT_PROFILE']]
+    return options.get(output_format.upper(), options['PNG'])
+
+class EncoderStats:
+    """Tiempo y tamaño medio por (formato, perfil) medidos en las salidas reales"""
+    
+    def __init__(self):
+        self._totals = {}
+        self._lock = threading.Lock()
+    
+    def record(self, output_format, profile, seconds, nbytes):
+        with self._lock:
+            count, total_seconds, total_bytes = self._totals.get((output_format, profile), (0, 0.0, 0))
+            self._totals[(output_format, profile)] = (count + 1, total_seconds + seconds, total_bytes + nbytes)
+    
+    def summary(self):
+        """{perfil: {formato: {'count', 'avg_ms', 'avg_kb'}}}"""
+        result = {}
+        with self._lock:
+            items = list(self._totals.items())
+        for (output_format, profile), (count, seconds, nbytes) in items:
+            result.setdefault(profile, {})[output_format] = {
+                'count': count,
+                'avg_ms': round(seconds * 1000 / count, 1),
+                'avg_kb': round(nbytes / 1024 / count, 1),
+            }
+        return result
+
+encoder_stats = EncoderStats()
+
+# ===== REGISTRO DE CODIFICADORES =====
+class Encoder:
+    """Formato de salida: formato de Pillow, extensión y modos que codifica sin conversión"""
+    
+    def __init__(self, name, pil_format, extension, modes, feature=None):
+        self.name = name
+        self.pil_format = pil_format
+        self.extension = extension
+        self.modes = modes
+        self.feature = feature  # módulo opcional de Pillow ('webp', 'avif')
+        self._available = None if feature else True
+    
+    def available(self):
+        if self._available is None:
+            from PIL import features
+            self._available = bool(features.check(self.feature))
+        return self._available
+
+ENCODERS = OrderedDict()
+
+def register_encoder(encoder):
+    """Agrega (o reemplaza) un formato de salida"""
+    ENCODERS[encoder.name] = encoder
+
+register_encoder(Encoder('PNG', 'PNG', 'png', ('RGB', 'RGBA', 'L')))
+register_encoder(Encoder('JPG', 'JPEG', 'jpg', ('RGB', 'L')))
+register_encoder(Encoder('PDF', 'PDF', 'pdf', ('RGB', 'L')))
+register_encoder(Encoder('WEBP', 'WEBP', 'webp', ('RGB', 'RGBA'), feature='webp'))
+register_encoder(Encoder('AVIF', 'AVIF', 'avif', ('RGB', 'RGBA'), feature='avif'))
+
+def get_encoder(output_format):
+    """Codificador del formato (PNG si no está registrado)"""
+    return ENCODERS.get((output_format or '').upper()) or ENCODERS['PNG']
+
+def available_formats():
+    """Formatos de OUTPUT_FORMATS que este Pillow puede codificar"""
+    return [name for name in CONFIG['OUTPUT_FORMATS'] if name in ENCODERS and ENCODERS[name].available()]
+
+def encode_diploma(image, fp, output_format='PNG', profile=None):
+    """Codifica el diploma en fp (ruta o archivo binario) con las opciones del perfil"""
+    encoder = get_encoder(output_format)
+    profile = profile if profile in CONFIG['OUTPUT_PROFILES'] else CONFIG['DEFAULT_PROFILE']
+    started = time.perf_counter()
+    
+    # Los lotes ya llegan en un modo nativo del formato (convertidos una vez por lote);
+    # esto solo actúa con imágenes sueltas
+    if image.mode not in encoder.modes:
+        image = convert_template(image, working_mode(image, encoder.name))
+    
+    position = 0 if isinstance(fp, str) else fp.tell()
+    image.save(fp, encoder.pil_format, **encoder_options(encoder.name, profile))
+    size = os.path.getsize(fp) if isinstance(fp, str) else fp.tell() - position
+    encoder_stats.record(encoder.name, profile, time.perf_counter() - started, size)
+
+def save_diploma(image, name, output_format='PNG', output_folder=None, profile=None):
+    """Guarda el diploma en el formato y perfil especificados con nombre personalizado"""
+    
+    output_folder = output_folder or CONFIG['OUTPUT_FOLDER']
+    safe_name = normalize_filename(name)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    extension = get_encoder(output_format).extension
+    
+    output_filename = f"diploma_{safe_name}_{timestamp}.{extension}"
+    output_path = os.path.join(output_folder, output_filename)
+    encode_diploma(image, output_path, output_format, profile)
+    return output_filename, output_path
+
+def encode_threads(image):
+    """Hilos de codificación para un lote: ENCODE_THREADS limitado por la memoria de las copias"""
+    image_bytes = image.width * image.height * len(image.getbands())
+    by_memory = CONFIG['ENCODE_MEMORY_MB'] * 1024 * 1024 // max(image_bytes, 1)
+    return max(1, min(CONFIG['ENCODE_THREADS'], by_memory))
+
+def _saved(name, future, error):
+    """Resultado (nombre, archivo, ruta, error) de un diploma encolado en save_rendered"""
+    if error is None:
+        try:
+            return (name,) + future.result() + (None,)
+        except Exception as e:
+            error = e
+    return name, None, None, error
+
+def save_rendered(rendered, output_format='PNG', output_folder=None, profile=None, threads=1):
+    """Guarda lo que produce iter_rendered y devuelve (nombre, archivo, ruta, error) en orden.
+    
+    Con threads > 1 cada diploma se codifica en un hilo (Pillow libera el GIL al comprimir)
+    mientras se compone el siguiente; como mucho hay `threads` copias del lienzo en vuelo.
+    """
+    if threads <= 1:
+        for name, img, error in rendered:
+            saved = (None, None)
+            if error is None:
+                try:
+                    saved = save_diploma(img, name, output_format, output_folder, profile)
+                except Exception as e:
+                    error = e
+            yield (name,) + saved + (error,)
+        return
+    
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='xonidip-encode') as executor:
+        for name, img, error in rendered:
+            future = None
+            if error is None:
+                # iter_rendered reutiliza su lienzo: cada hilo codifica su propia copia
+                future = executor.submit(save_diploma, img.copy(), name, output_format,
+                                         output_folder, profile)
+            pending.append((name, future, error))
+            while len(pending) >= threads:
+                yield _saved(*pending.popleft())
+        while pending:
+            yield _saved(*pending.popleft())
+
+def write_cached_diploma(data, name, output_format='PNG', output_folder=None):
+    """Escribe un diploma ya codificado (desde la caché) con el mismo nombre que save_diploma"""
+    output_folder = output_folder or CONFIG['OUTPUT_FOLDER']
+    extension = get_encoder(output_format).extension
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    output_filename = f"diploma_{normalize_filename(name)}_{timestamp}.{extension}"
+    output_path = os.path.join(output_folder, output_filename)
+    with open(output_path, 'wb') as f:
+        f.write(data)
+    return output_filename, output_path
+
+# ===== PERFILADO OPCIONAL POR TRABAJO =====
+def start_job_profiler(enabled):
+    """Inicia cProfile para un trabajo si se solicitó (devuelve None si no)"""
+    if not enabled:
+        return None
+    
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Otro perfilador activo en el proceso (p. ej. otra petición perfilada)
+        logger.warning("No se pudo iniciar el perfilador: %s", e)
+        return None
+    return profiler
+
+def save_job_profile(profiler, timestamp, output_folder=None):
+    """Detiene el perfilador y guarda las estadísticas (pstats) junto al ZIP"""
+    profiler.disable()
+    profile_filename = f'perfil_{timestamp}.prof'
+    profile_path = os.path.join(output_folder or CONFIG['OUTPUT_FOLDER'], profile_filename)
+    profiler.dump_stats(profile_path)
+    return profile_filename
+
+def allowed_file(filename):
+    return '.' in filename and \
+           filename.rsplit('.', 1)[1].lower() in CONFIG['ALLOWED_EXTENSIONS']
+
+def extract_names_from_file(file, filename=None):
+    """Extrae nombres de diferentes tipos de archivos"""
+    names = []
+    filename = (filename or file.filename).lower()
+    
+    try:
+        if filename.endswith('.txt'):
+            content = file.read().decode('utf-8', errors='ignore')
+            file.seek(0)
+            lines = content.strip().split('\n')
+            names = [line.strip() for line in lines if line.strip()]
+        
+        elif filename.endswith('.csv'):
+            content = file.read().decode('utf-8', errors='ignore')
+            file.seek(0)
+            lines = content.strip().split('\n')
+            for i, line in enumerate(lines):
+                if i == 0 and 'nombre' in line.lower():
+                    continue
+                parts = line.strip().split(',')
+                if parts and parts[0].strip():
+                    names.append(parts[0].strip())
+        
+        elif filename.endswith(('.xlsx', '.xls')):
+            import pandas as pd  # Solo se necesita para Excel
+            df = pd.read_excel(file)
+            file.seek(0)
+            for col in df.columns:
+                if any(keyword in str(col).lower() for keyword in ['nombre', 'name', 'participante', 'alumno']):
+                    names = [str(name).strip() for name in df[col].dropna().tolist() if str(name).strip()]
+                    break
+            if not names and len(df.columns) > 0:
+                names = [str(name).strip() for name in df[df.columns[0]].dropna().tolist() if str(name).strip()]
+    
+    except Exception as e:
+        logger.error("Error procesando archivo %s: %s", filename, e)
+        return []
+    
+    return names
+
+# ===== LISTADOS CON VARIAS PLANTILLAS =====
+# Encabezados reconocidos para el nombre y para la clave de plantilla de cada fila
+NAME_COLUMNS = ['nombre', 'name', 'participante', 'alumno']
+TEMPLATE_COLUMNS = ['plantilla', 'template', 'tipo', 'rol']
+
+def _find_column(header, keywords):
+    for index, column in enumerate(header):
+        if any(keyword in str(column).lower() for keyword in keywords):
+            return index
+    return None
+
+def extract_roster_from_file(file, filename=None):
+    """Como extract_names_from_file, pero devuelve (nombre, clave de plantilla o None) por fila
+    
+    La clave sale de una columna 'plantilla'/'tipo'/'rol' (CSV o Excel); sin ella, todas las
+    filas usan la plantilla por defecto.
+    """
+    filename = (filename or file.filename).lower()
+    rows = None
+    
+    try:
+        if filename.endswith('.csv'):
+            content = file.read().decode('utf-8-sig', errors='ignore')
+            file.seek(0)
+            lines = list(csv.reader(content.strip().splitlines()))
+            template_col = _find_column(lines[0], TEMPLATE_COLUMNS) if lines else None
+            if template_col is not None:
+                name_col = _find_column(lines[0], NAME_COLUMNS) or 0
+                rows = [(line[name_col], line[template_col] if len(line) > template_col else '')
+                        for line in lines[1:] if len(line) > name_col]
+        
+        elif filename.endswith(('.xlsx', '.xls')):
+            import pandas as pd  # Solo se necesita para Excel
+            df = pd.read_excel(file)
+            file.seek(0)
+            template_col = _find_column(df.columns, TEMPLATE_COLUMNS)
+            if template_col is not None:
+                name_col = _find_column(df.columns, NAME_COLUMNS) or 0
+                rows = [(str(name), '' if pd.isna(key) else str(key))
+                        for name, key in zip(df.iloc[:, name_col], df.iloc[:, template_col])
+                        if not pd.isna(name)]
+    
+    except Exception as e:
+        logger.error("Error procesando archivo %s: %s", filename, e)
+        return []
+    
+    if rows is None:
+        return [(name, None) for name in extract_names_from_file(file, filename)]
+    return [(name.strip(), key.strip() or None) for name, key in rows if name.strip()]
+
+class TemplateGroup:
+    """Filas del lote que comparten plantilla y configuración de texto"""
+    
+    def __init__(self, key, template_path, config, folder=None, template_digest=None):
+        self.key = key  # None: plantilla por defecto del lote
+        self.template_path = template_path
+        # Se calcula una vez al crear el grupo: la plantilla puede desaparecer después
+        self.hash = template_digest or template_hash(template_path)
+        self.config = config
+        self.folder = folder  # subcarpeta del grupo en el ZIP (None: raíz)
+        self.names = []
+
+class Roster:
+    """Filas agrupadas por plantilla, sin duplicados dentro de cada grupo
+    
+    Las filas son nombres sueltos (plantilla por defecto) o {'name', 'template'}; templates
+    asocia cada clave con una ruta o con {'template_path', 'text_config'}. Cada fila se
+    comprueba contra un conjunto de las ya vistas, así que se puede ir llenando fila a fila.
+    """
+    
+    def __init__(self, template_path=None, text_config=None, templates=None):
+        self.template_path = template_path
+        self.text_config = text_config or {}
+        self.templates = templates or {}
+        self.groups = OrderedDict()  # clave -> TemplateGroup, en el orden en que aparece
+        self._seen = set()  # (clave, nombre)
+    
+    @staticmethod
+    def parse_row(row):
+        """(nombre, clave de plantilla o None) de una fila"""
+        name, key = (row.get('name'), row.get('template')) if isinstance(row, dict) else (row, None)
+        key = (str(key).strip() or None) if key is not None else None
+        return str(name or '').strip(), key
+    
+    def group(self, key):
+        """Grupo de la clave (lo crea la primera vez); ValueError si la plantilla no existe"""
+        if key in self.groups:
+            return self.groups[key]
+        if key is None:
+            path, text_config = self.template_path, self.text_config
+        elif key in self.templates:
+            spec = self.templates[key]
+            spec = spec if isinstance(spec, dict) else {'template_path': spec}
+            path, text_config = spec.get('template_path'), spec.get('text_config') or self.text_config
+        else:
+            raise ValueError(f'Plantilla desconocida en el listado: {key}')
+        try:
+            digest = template_hash(path) if path else None
+        except OSError:
+            digest = None
+        if not digest:
+            raise ValueError(f'Plantilla no encontrada: {key}' if key else 'Plantilla no encontrada')
+        
+        folder = None
+        if key is not None:
+            folder = base = normalize_filename(key)
+            used = {group.folder for group in self.groups.values()}
+            suffix = 2
+            while folder in used:
+                folder, suffix = f'{base}_{suffix}', suffix + 1
+        group = self.groups[key] = TemplateGroup(key, path, parse_text_config(text_config), folder, digest)
+        return group
+    
+    def template_paths(self):
+        """Rutas de todas las plantillas que el listado puede usar"""
+        paths = [self.template_path] if self.template_path else []
+        for spec in self.templates.values():
+            path = spec.get('template_path') if isinstance(spec, dict) else spec
+            if path:
+                paths.append(path)
+        return paths
+    
+    def add(self, row):
+        """Agrega una fila; devuelve (grupo, nombre), o None si está vacía o repetida"""
+        name, key = self.parse_row(row)
+        if not name or (key, name) in self._seen:
+            return None
+        group = self.group(key)
+        self._seen.add((key, name))
+        group.names.append(name)
+        return group, name
+
+def group_roster(rows, template_path=None, text_config=None, templates=None):
+    """Agrupa las filas por plantilla, en el orden en que aparece cada una
+    
+    Una misma persona puede recibir varios tipos de diploma; ValueError si una fila usa una
+    plantilla desconocida o inexistente.
+    """
+    roster = Roster(template_path, text_config, templates)
+    for row in rows:
+        roster.add(row)
+    return list(roster.groups.values())
+
+def get_text_dimensions(text, font, draw):
+    """Obtiene dimensiones del texto para centrado preciso"""
+    try:
+        if hasattr(draw, 'textbbox'):
+            bbox = draw.textbbox((0, 0), text, font=font)
+            return bbox[2] - bbox[0], bbox[3] - bbox[1]
+        else:
+            return font.getsize(text)
+    except:
+        return len(text) * font.size // 2, font.size
+
+def get_centered_position(x, y, text, font, draw):
+    """Calcula la posición para que (x,y) sea el CENTRO del texto"""
+    ancho, alto = get_text_dimensions(text, font, draw)
+    return x - (ancho // 2), y - (alto // 2)
+
+def get_font_path(font_name, style='normal'):
+    """Obtiene la ruta completa de una fuente con estilo"""
+    font_mappings = {
+        'arial.ttf': {
+            'normal': ['arial.ttf', 'arial.ttf', 'Arial.ttf', 'arial.ttf'],
+            'bold': ['arialbd.ttf', 'arialb.ttf', 'Arial-Bold.ttf', 'arialbd.ttf'],
+            'italic': ['ariali.ttf', 'ariali.ttf', 'Arial-Italic.ttf', 'ariali.ttf']
+        },
+        'times.ttf': {
+            'normal': ['times.ttf', 'times.ttf', 'TimesNewRoman.ttf', 'times.ttf'],
+            'bold': ['timesbd.ttf', 'timesb.ttf', 'TimesNewRomanBold.ttf', 'timesbd.ttf']
+        },
+        'cour.ttf': {
+            'normal': ['cour.ttf', 'cour.ttf', 'CourierNew.ttf', 'cour.ttf'],
+            'bold': ['courbd.ttf', 'courb.ttf', 'CourierNewBold.ttf', 'courbd.ttf']
+        }
+    }
+    
+    font_paths = [
+        CONFIG['FONTS_FOLDER'],
+        os.path.join(os.path.dirname(__file__), 'fonts'),
+        "fonts/",
+        "/usr/share/fonts/",
+        "/usr/local/share/fonts/",
+        "/System/Library/Fonts/",
+        "/Library/Fonts/",
+        "C:\\Windows\\Fonts\\",
+        "C:/Windows/Fonts/"
+    ]
+    
+    base_name = font_name.lower()
+    if base_name in font_mappings and style in font_mappings[base_name]:
+        font_variants = font_mappings[base_name][style]
+    else:
+        font_variants = [font_name]
+    
+    for path in font_paths:
+        if not os.path.exists(path):
+            continue
+        for variant in font_variants:
+            font_path = os.path.join(path, variant)
+            if os.path.exists(font_path):
+                logger.debug("Encontrada fuente: %s", font_path)
+                return font_path
+    
+    return None
+
+def create_fallback_font(font_size):
+    """Crea una fuente por defecto si no hay fuentes disponibles"""
+    try:
+        for path in ['/usr/share/fonts/TTF/DejaVuSans.ttf', 
+                    '/usr/share/fonts/liberation/LiberationSans-Regular.ttf',
+                    '/System/Library/Fonts/Helvetica.ttc']:
+            if os.path.exists(path):
+                return ImageFont.truetype(path, font_size)
+    except:
+        pass
+    
+    try:
+        return ImageFont.load_default().font_variant(size=font_size)
+    except:
+        return ImageFont.load_default()
+
+def load_font(font_name, font_size, font_style='normal'):
+    """Carga una fuente con estilo con manejo de errores mejorado"""
+    try:
+        font_path = get_font_path(font_name, font_style)
+        if font_path and os.path.exists(font_path):
+            return ImageFont.truetype(font_path, font_size)
+        
+        font_path = get_font_path(font_name, 'normal')
+        if font_path and os.path.exists(font_path):
+            font = ImageFont.truetype(font_path, font_size)
+            if font_style == 'bold':
+                return ImageFont.truetype(font_path, int(font_size * 1.1))
+            elif font_style == 'italic':
+                return font
+            return font
+        
+        logger.warning("No se encontró la fuente %s. Usando fuente por defecto.", font_name)
+        return create_fallback_font(font_size)
+        
+    except Exception as e:
+        logger.warning("Error cargando fuente %s: %s", font_name, e)
+        return create_fallback_font(font_size)
+
+# ===== CONFIGURACIÓN DE TEXTO Y RENDER =====
+def parse_font_color(font_color):
+    """Convierte '#RRGGBB', '#RGB', '#RRGGBBAA' o un nombre CSS en tupla RGB/RGBA (negro si no es válido)"""
+    try:
+        return ImageColor.getrgb(font_color)
+    except (ValueError, AttributeError):
+        return (0, 0, 0)
+
+def parse_text_config(text_config):
+    """Normaliza la configuración de texto recibida (x, y son el CENTRO deseado)"""
+    return {
+        'x': int(text_config.get('x', 100)),
+        'y': int(text_config.get('y', 100)),
+        'font_size': int(text_config.get('font_size', 40)),
+        'font_color': parse_font_color(text_config.get('font_color', '#000000')),
+        'font_name': text_config.get('font_name', 'arial.ttf'),
+        'font_style': text_config.get('font_style', 'normal'),
+    }
+
+# ===== MODOS DE COLOR DE LA PLANTILLA =====
+def has_alpha(image):
+    return image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+
+def working_mode(image, output_format='PNG'):
+    """Modo en el que se dibuja y codifica el lote: el nativo de la plantilla si el formato lo admite
+
+    Las plantillas con paleta (P) se expanden: el texto con antialiasing no cabe en una paleta.
+    """
+    if has_alpha(image):
+        mode = 'RGBA'
+    elif image.mode in ('1', 'I', 'I;16', 'F'):
+        mode = 'L'
+    elif image.mode in ('RGB', 'L'):
+        mode = image.mode
+    else:
+        mode = 'RGB'  # P sin transparencia, CMYK, YCbCr, ...
+    
+    # Modos que el formato codifica sin conversión (el resto se convierte una vez por lote)
+    if mode not in get_encoder(output_format).modes:
+        mode = 'RGB'
+    return mode
+
+def convert_template(image, mode):
+    """Convierte al modo de trabajo; la transparencia se aplana sobre blanco si el formato no la admite"""
+    if image.mode == mode:
+        return image
+    if mode in ('RGB', 'L') and has_alpha(image):
+        rgba = image.convert('RGBA')
+        flat = Image.new('RGB', image.size, (255, 255, 255))
+        flat.paste(rgba, mask=rgba.getchannel('A'))
+        return flat if mode == 'RGB' else flat.convert('L')
+    return image.convert(mode)
+
+def color_for_mode(color, mode):
+    """Adapta un color RGB/RGBA al modo de la imagen sobre la que se dibuja"""
+    if isinstance(color, int):
+        return color  # ya adaptado a 'L'
+    if mode == 'L':
+        # Misma luminancia que ImageColor.getcolor(..., 'L')
+        r, g, b = color[:3]
+        return (r * 299 + g * 587 + b * 114) // 1000
+    if mode == 'RGBA':
+        return tuple(color) if len(color) == 4 else tuple(color) + (255,)
+    return tuple(color[:3])
+
+def config_for_mode(config, mode):
+    """Copia de la configuración de texto con el color en el modo de la plantilla"""
+    return dict(config, font_color=color_for_mode(config['font_color'], mode))
+
+def load_template(template_path, output_format='PNG'):
+    """Abre la plantilla y la convierte (una sola vez) al modo de trabajo del formato"""
+    base_template = Image.open(template_path)
+    return convert_template(base_template, working_mode(base_template, output_format))
+
+# ===== SHAPING DE ESCRITURAS COMPLEJAS =====
+# Escrituras que la maquetación básica dibuja mal: hebreo, árabe, siríaco, thaana, N'Ko,
+# índicas, tailandés, lao, tibetano, birmano, jemer, formas de presentación y ZWJ/ZWNJ
+COMPLEX_SCRIPT_PATTERN = re.compile(
+    '[\u0590-\u08ff\u0900-\u0dff\u0e00-\u0fff\u1000-\u109f\u1780-\u17ff'
+    '\u200c\u200d\ufb1d-\ufdff\ufe70-\ufeff]'
+)
+
+def needs_shaping(text):
+    """True si el texto necesita shaping; los nombres ASCII salen por la vía rápida"""
+    if not CONFIG['TEXT_SHAPING'] or text.isascii():
+        return False
+    return COMPLEX_SCRIPT_PATTERN.search(text) is not None
+
+def text_direction(text):
+    """'rtl' o 'ltr' según el primer carácter con dirección fuerte (regla P2 de UAX #9)"""
+    for char in text:
+        bidi = unicodedata.bidirectional(char)
+        if bidi in ('R', 'AL'):
+            return 'rtl'
+        if bidi == 'L':
+            return 'ltr'
+    return 'ltr'
+
+def raqm_available():
+    try:
+        from PIL import features
+        return bool(features.check('raqm'))
+    except Exception:
+        return False
+
+_raqm_fonts = {}
+_raqm_warned = []
+
+def shaping_font(font):
+    """Variante Raqm de la fuente (una por fuente y tamaño), o None si Raqm no está disponible"""
+    if font.layout_engine == ImageFont.Layout.RAQM:
+        return font
+    if not raqm_available():
+        if not _raqm_warned:
+            _raqm_warned.append(True)
+            logger.warning("libraqm no está disponible: los nombres en escrituras complejas "
+                           "se dibujan con la maquetación básica")
+        return None
+    key = (font.path if isinstance(font.path, str) else id(font), font.index, font.size)
+    variant = _raqm_fonts.get(key)
+    if variant is None:
+        variant = _raqm_fonts[key] = font.font_variant(layout_engine=ImageFont.Layout.RAQM)
+    return variant
+
+class ShapedRuns:
+    """LRU limitado por bytes de trazos ya maquetados: (máscara 'L' o None, caja)
+
+    La caja es la de draw.textbbox((0, 0), texto) y la máscara cubre exactamente esa caja,
+    de modo que un nombre repetido (vistas previas, reintentos, varios tipos de diploma)
+    no vuelve a pasar por Raqm ni por FreeType.
+    """
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            run = self._items.get(key)
+            if run is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return run
+    
+    def put(self, key, run):
+        mask = run[0]
+        cost = mask.width * mask.height if mask is not None else 0
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None and previous[0] is not None:
+                self.size -= previous[0].width * previous[0].height
+            self._items[key] = run
+            self.size += cost
+            while self.size > self.max_bytes and self._items:
+                _, (old_mask, _) = self._items.popitem(last=False)
+                if old_mask is not None:
+                    self.size -= old_mask.width * old_mask.height
+
+shaped_runs = ShapedRuns(CONFIG['SHAPING_CACHE_MB'] * 1024 * 1024)
+
+def shaped_run(font, text):
+    """Máscara y caja del texto maquetado con Raqm (dirección detectada por nombre), cacheadas"""
+    path = font.path if isinstance(font.path, str) else id(font)
+    key = (path, font.index, font.size, text)
+    run = shaped_runs.get(key)
+    if run is not None:
+        return run
+    
+    variant = shaping_font(font)
+    options = {'direction': text_direction(text)} if variant is not None else {}
+    variant = variant or font
+    left, top, right, bottom = variant.getbbox(text, **options)
+    mask = None
+    if right > left and bottom > top:
+        mask = Image.new('L', (right - left, bottom - top), 0)
+        ImageDraw.Draw(mask).text((-left, -top), text, font=variant, fill=255, **options)
+    run = (mask, (left, top, right, bottom))
+    shaped_runs.put(key, run)
+    return run
+
+# ===== ATLAS DE GLIFOS (MAQUETACIÓN POR LOTE) =====
+class GlyphAtlas:
+    """Máscaras, avances y kerning cacheados por carácter para una fuente y tamaño
+
+    Reproduce la maquetación básica de FreeType en Pillow: el avance y el kerning
+    se acumulan en coma flotante y cada glifo se coloca en el píxel redondeado.
+    El resultado coincide con ImageDraw.text salvo en píxeles donde dos glifos se
+    solapan (diferencia máxima de 1 nivel). Los nombres que necesitan shaping se
+    maquetan enteros (shaped_run) y entran como un único "glifo".
+    """
+    
+    def __init__(self, font):
+        self.font = font
+        self._glyphs = {}
+        self._glyph_ids = set()
+        self._advances = {}
+        self._kerning = {}
+    
+    def glyph(self, char):
+        """(máscara o None si está vacía, desplazamiento, tamaño) del carácter"""
+        glyph = self._glyphs.get(char)
+        if glyph is None:
+            mask, offset = self.font.getmask2(char, mode='L')
+            image = Image.frombytes('L', mask.size, bytes(mask)) if mask.size[0] and mask.size[1] else None
+            if image is not None:
+                self._glyph_ids.add(id(image))
+            glyph = self._glyphs[char] = (image, offset, mask.size)
+        return glyph
+    
+    def owns(self, mask):
+        """True si la máscara es un glifo del atlas (vive tanto como el atlas)"""
+        return id(mask) in self._glyph_ids
+    
+    def advance(self, char):
+        advance = self._advances.get(char)
+        if advance is None:
+            advance = self._advances[char] = self.font.getlength(char)
+        return advance
+    
+    def kerning(self, left, right):
+        pair = (left, right)
+        kerning = self._kerning.get(pair)
+        if kerning is None:
+            kerning = self.font.getlength(left + right) - self.advance(left) - self.advance(right)
+            self._kerning[pair] = kerning
+        return kerning
+    
+    def layout(self, text):
+        """Posiciones de cada glifo y caja envolvente, igual que draw.textbbox((0, 0), text)"""
+        if needs_shaping(text):
+            mask, bbox = shaped_run(self.font, text)
+            return ([(mask, bbox[0], bbox[1])] if mask is not None else []), bbox
+        
+        positions = []
+        left = top = math.inf
+        right = bottom = -math.inf
+        pen = 0.0
+        previous = None
+        for char in text:
+            if previous is not None:
+                pen += self.kerning(previous, char)
+            px = int(math.floor(pen + 0.5))
+            mask, (ox, oy), (width, height) = self.glyph(char)
+            left = min(left, px + ox)
+            right = max(right, px + ox + width)
+            if height:
+                top = min(top, oy)
+                bottom = max(bottom, oy + height)
+            if mask is not None:
+                positions.append((mask, px + ox, oy))
+            pen += self.advance(char)
+            previous = char
+        
+        if top == math.inf:
+            # Solo espacios: sin tinta, usar la medida de la fuente
+            return positions, self.font.getbbox(text)
+        return positions, (left, top, right, bottom)
+    
+    def draw_centered(self, img, cx, cy, text, fill):
+        """Dibuja el texto con su centro en (cx, cy) y devuelve la caja absoluta"""
+        positions, (left, top, right, bottom) = self.layout(text)
+        x = cx - ((right - left) // 2)
+        y = cy - ((bottom - top) // 2)
+        for mask, gx, gy in positions:
+            px, py = x + gx, y + gy
+            img.paste(fill, (px, py, px + mask.width, py + mask.height), mask)
+        return (x + left, y + top, x + right, y + bottom)
+
+_glyph_atlases = {}
+
+def get_glyph_atlas(font):
+    """Atlas compartido para la fuente, o None si no se puede reproducir su maquetación"""
+    if not CONFIG['GLYPH_ATLAS'] or not isinstance(font, ImageFont.FreeTypeFont):
+        return None
+    # El atlas solo reproduce la maquetación básica: con Raqm (kerning GPOS, ligaduras) cada
+    # nombre se dibuja con draw.text y el motor por defecto de la fuente
+    if font.layout_engine != ImageFont.Layout.BASIC:
+        return None
+    path = font.path if isinstance(font.path, str) else id(font)
+    key = (path, font.index, font.size)
+    atlas = _glyph_atlases.get(key)
+    if atlas is None:
+        atlas = _glyph_atlases[key] = GlyphAtlas(font)
+    return atlas
+
+def draw_shaped_centered(img, cx, cy, text, font, fill):
+    """Pega el trazo maquetado con su centro en (cx, cy) y devuelve la caja absoluta"""
+    mask, (left, top, right, bottom) = shaped_run(font, text)
+    x = cx - ((right - left) // 2)
+    y = cy - ((bottom - top) // 2)
+    if mask is not None:
+        img.paste(fill, (x + left, y + top, x + right, y + bottom), mask)
+    return (x + left, y + top, x + right, y + bottom)
+
+def draw_text_centered(img, text, font, config):
+    """Dibuja el texto centrado en (x, y) de config; devuelve la caja modificada"""
+    atlas = get_glyph_atlas(font)
+    if atlas is not None:
+        return atlas.draw_centered(img, config['x'], config['y'], text, config['font_color'])
+    if isinstance(font, ImageFont.FreeTypeFont) and needs_shaping(text):
+        return draw_shaped_centered(img, config['x'], config['y'], text, font, config['font_color'])
+    
+    draw = ImageDraw.Draw(img)
+    # Calcular posición de esquina para que el centro sea (x, y)
+    x, y = get_centered_position(config['x'], config['y'], text, font, draw)
+    draw.text((x, y), text, font=font, fill=config['font_color'])
+    return draw.textbbox((x, y), text, font=font)
+
+def measure_text_centered(text, font, config):
+    """Caja absoluta que draw_text_centered modificaría, sin dibujar"""
+    atlas = get_glyph_atlas(font)
+    if atlas is not None:
+        _, (left, top, right, bottom) = atlas.layout(text)
+    elif isinstance(font, ImageFont.FreeTypeFont) and needs_shaping(text):
+        _, (left, top, right, bottom) = shaped_run(font, text)
+    else:
+        left, top, right, bottom = ImageDraw.Draw(Image.new('L', (1, 1))).textbbox((0, 0), text, font=font)
+    x = config['x'] - ((right - left) // 2)
+    y = config['y'] - ((bottom - top) // 2)
+    return (x + left, y + top, x + right, y + bottom)
+
+def render_name(base_template, name, font, config):
+    """Dibuja un nombre centrado en (x, y) sobre una copia de la plantilla"""
+    img = writable_copy(base_template)
+    draw_text_centered(img, name, font, config)
+    return img
+
+def copy_zip_entries(zipf, source_path, arcnames):
+    """Copia entradas de otro ZIP con su mismo método, fecha y atributos
+
+    Los diplomas ya están comprimidos (PNG/JPG/PDF), así que descomprimir y volver a
+    escribir cuesta poco; las entradas guardadas sin compresión siguen en ZIP_STORED.
+    """
+    wanted = set(arcnames) - set(zipf.namelist())
+    with zipfile.ZipFile(source_path) as archive:
+        for info in archive.infolist():
+            if info.filename not in wanted:
+                continue
+            wanted.discard(info.filename)
+            copied = zipfile.ZipInfo(info.filename, info.date_time)
+            copied.compress_type = info.compress_type
+            copied.external_attr = info.external_attr
+            copied.create_system = info.create_system
+            force_zip64 = info.file_size >= zipfile.ZIP64_LIMIT
+            with archive.open(info) as entry, zipf.open(copied, 'w', force_zip64=force_zip64) as out:
+                shutil.copyfileobj(entry, out, 1024 * 1024)
+
+def write_zip(zip_path, files, root=None, copies=None):
+    """Crea un ZIP con las rutas indicadas (con su nombre base, o relativas a root)
+
+    copies ({entrada: ZIP de origen}) agrega entradas de otros ZIP sin recomprimirlas.
+    Se escribe como .part y se renombra al terminar, así nunca se sirve ni se
+    limpia un ZIP a medio escribir.
+    """
+    tmp_path = zip_path + '.part'
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            by_source = OrderedDict()
+            for arcname, source_path in (copies or {}).items():
+                by_source.setdefault(source_path, []).append(arcname)
+            for source_path, arcnames in by_source.items():
+                copy_zip_entries(zipf, source_path, arcnames)
+            for file_path in files:
+                if os.path.exists(file_path):
+                    arcname = os.path.relpath(file_path, root) if root else os.path.basename(file_path)
+                    zipf.write(file_path, arcname)
+        os.replace(tmp_path, zip_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return zip_path
+
+# ===== SUBIDA DE PLANTILLAS =====
+# Hash SHA-256 por (ruta, mtime, tamaño) para no releer plantillas ya conocidas
+_template_hashes = {}
+
+def _file_key(filepath):
+    stat = os.stat(filepath)
+    return (os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size)
+
+def save_upload_stream(stream, filepath, chunk_size=1024 * 1024):
+    """Guarda un flujo en disco por bloques calculando su SHA-256 al vuelo"""
+    digest = hashlib.sha256()
+    # Temporal único en la misma carpeta: dos subidas con el mismo nombre no se mezclan
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath) or '.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    
+    file_hash = digest.hexdigest()
+    _template_hashes[_file_key(filepath)] = file_hash
+    return file_hash
+
+def template_hash(filepath, chunk_size=1024 * 1024):
+    """SHA-256 de una plantilla (calculado una sola vez por versión del archivo)"""
+    key = _file_key(filepath)
+    if key not in _template_hashes:
+        digest = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        _template_hashes[key] = digest.hexdigest()
+    return _template_hashes[key]
+
+def create_preview(filepath, preview_path, preview_size=(800, 600)):
+    """Crea la miniatura JPEG sin decodificar la plantilla a resolución completa"""
+    with Image.open(filepath) as img:
+        # Las dimensiones salen de la cabecera, sin decodificar píxeles
+        width, height = img.size
+        
+        # En JPEG, draft() activa el escalado DCT (1/2, 1/4, 1/8) al decodificar
+        img.draft('RGB', preview_size)
+        
+        # Compatibilidad con versiones de Pillow
+        try:
+            img.thumbnail(preview_size, Image.Resampling.LANCZOS)
+        except AttributeError:
+            try:
+                img.thumbnail(preview_size, Image.ANTIALIAS)
+            except AttributeError:
+                img.thumbnail(preview_size)
+        
+        preview = img if img.mode == 'RGB' else img.convert('RGB')
+        preview.save(preview_path, 'JPEG', quality=80)
+    
+    return width, height
+
+def write_zip_parts(zip_path, files, max_part_bytes, root=None, copies=None):
+    """Divide el lote en varios ZIP de tamaño acotado (descargables en paralelo)
+
+    Los diplomas ya están comprimidos (PNG/JPG/PDF), así que el tamaño de los
+    archivos de entrada es una buena estimación del tamaño de cada parte; las copias
+    de otro ZIP (copies, como en write_zip) cuentan con su tamaño comprimido.
+    Devuelve la lista de rutas; con una sola parte se usa zip_path tal cual.
+    """
+    entries = []  # (tamaño, ruta o None, entrada copiada o None, ZIP de origen)
+    by_source = OrderedDict()
+    for arcname, source_path in (copies or {}).items():
+        by_source.setdefault(source_path, []).append(arcname)
+    for source_path, arcnames in by_source.items():
+        with zipfile.ZipFile(source_path) as archive:
+            for arcname in arcnames:
+                entries.append((archive.getinfo(arcname).compress_size, None, arcname, source_path))
+    for file_path in files:
+        if os.path.exists(file_path):
+            entries.append((os.path.getsize(file_path), file_path, None, None))
+    
+    groups, current, current_size = [], [], 0
+    for entry in entries:
+        if current and current_size + entry[0] > max_part_bytes:
+            groups.append(current)
+            current, current_size = [], 0
+        current.append(entry)
+        current_size += entry[0]
+    if current:
+        groups.append(current)
+    
+    if len(groups) <= 1:
+        return [write_zip(zip_path, files, root, copies)]
+    
+    base, extension = os.path.splitext(zip_path)
+    return [write_zip(f'{base}_parte{index}{extension}',
+                      [path for _, path, _, _ in group if path], root,
+                      {arcname: source for _, _, arcname, source in group if arcname})
+            for index, group in enumerate(groups, start=1)]
+
+# ===== PRESUPUESTO DE MEMORIA Y PLANTILLAS COMPARTIDAS =====
+class MemoryBudgetTimeout(Exception):
+    """No hubo memoria disponible dentro del tiempo de espera"""
+
+class MemoryBudget:
+    """Presupuesto global de bytes: los trabajos esperan turno hasta que haya memoria"""
+    
+    def __init__(self, limit_bytes, reclaim=None):
+        self.limit = limit_bytes
+        self.used = 0
+        self.reclaim = reclaim  # función(bytes_necesarios) que libera memoria ociosa
+        self._cond = threading.Condition()
+    
+    def reserve(self, nbytes, timeout=None):
+        # Un trabajo mayor que el presupuesto completo puede correr, pero solo
+        nbytes = min(nbytes, self.limit)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self.used + nbytes > self.limit:
+                if self.reclaim:
+                    self._cond.release()
+                    try:
+                        self.reclaim(self.used + nbytes - self.limit)
+                    finally:
+                        self._cond.acquire()
+                    if self.used + nbytes <= self.limit:
+                        break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise MemoryBudgetTimeout(
+                        f'Sin memoria disponible para {nbytes // (1024 * 1024)} MB '
+                        f'(en uso {self.used // (1024 * 1024)} de {self.limit // (1024 * 1024)} MB)'
+                    )
+                self._cond.wait(remaining)
+            self.used += nbytes
+        return nbytes
+    
+    def release(self, nbytes):
+        with self._cond:
+            self.used = max(0, self.used - nbytes)
+            self._cond.notify_all()
+    
+    @contextmanager
+    def hold(self, nbytes, timeout=None):
+        reserved = self.reserve(nbytes, timeout)
+        try:
+            yield reserved
+        finally:
+            self.release(reserved)
+
+def decoded_size(template_path, output_format='PNG'):
+    """Bytes que ocupará la plantilla decodificada en su modo de trabajo (leído de la cabecera)"""
+    with Image.open(template_path) as img:
+        width, height = img.size
+        bands = Image.getmodebands(working_mode(img, output_format))
+    return width * height * bands
+
+class SharedTemplates:
+    """Una sola copia decodificada por hash de plantilla y modo de trabajo, compartida entre peticiones"""
+    
+    def __init__(self, budget):
+        self.budget = budget
+        self._entries = OrderedDict()  # hash:modo -> {'image', 'bytes', 'refs'}
+        self._loading = {}  # hash:modo -> {'lock', 'waiters'}, solo mientras alguien la carga o espera
+        self._lock = threading.Lock()
+    
+    def acquire(self, template_path, timeout=None, output_format='PNG'):
+        """Devuelve (clave, imagen) y marca la plantilla como en uso"""
+        # Las plantillas RGB comparten entrada entre formatos; las RGBA no (JPG/PDF se aplanan)
+        with Image.open(template_path) as img:
+            mode = working_mode(img, output_format)
+        key = f'{template_hash(template_path)}:{mode}'
+        return key, self._acquire(key, template_path, timeout, output_format)['image']
+    
+    def release(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                entry['refs'] -= 1
+    
+    @contextmanager
+    def use(self, template_path, timeout=None, output_format='PNG'):
+        key, image = self.acquire(template_path, timeout, output_format)
+        try:
+            yield image
+        finally:
+            self.release(key)
+    
+    def _acquire(self, key, template_path, timeout, output_format):
+        with self._lock:
+            loading = self._loading.get(key)
+            if loading is None:
+                loading = self._loading[key] = {'lock': threading.Lock(), 'waiters': 0}
+            loading['waiters'] += 1
+        # Solo un hilo decodifica cada plantilla; los demás esperan y la comparten
+        try:
+            with loading['lock']:
+                with self._lock:
+                    entry = self._entries.get(key)
+                    if entry:
+                        entry['refs'] += 1
+                        self._entries.move_to_end(key)
+                        return entry
+                
+                nbytes = self.budget.reserve(decoded_size(template_path, output_format), timeout)
+                try:
+                    image = load_template(template_path, output_format)
+                    image.load()
+                except Exception:
+                    self.budget.release(nbytes)
+                    raise
+                
+                entry = {'image': image, 'bytes': nbytes, 'refs': 1}
+                with self._lock:
+                    self._entries[key] = entry
+                logger.debug("Plantilla decodificada: %s (%d MB)", template_path, nbytes // (1024 * 1024))
+                return entry
+        finally:
+            # El último en salir (con la plantilla cargada o tras un error) retira el cerrojo
+            with self._lock:
+                loading['waiters'] -= 1
+                if not loading['waiters']:
+                    del self._loading[key]
+    
+    def reclaim(self, needed):
+        """Libera plantillas sin uso (las menos recientes primero)"""
+        freed = 0
+        with self._lock:
+            for key in list(self._entries):
+                if freed >= needed:
+                    break
+                entry = self._entries[key]
+                if entry['refs'] == 0:
+                    del self._entries[key]
+                    freed += entry['bytes']
+        if freed:
+            self.budget.release(freed)
+        return freed
+
+memory_budget = MemoryBudget(CONFIG['MEMORY_BUDGET_MB'] * 1024 * 1024)
+shared_templates = SharedTemplates(memory_budget)
+memory_budget.reclaim = shared_templates.reclaim
+
+def use_banded_rendering(template):
+    """Plantillas enormes: un único lienzo reutilizado en lugar de una copia por nombre"""
+    return template.width * template.height >= CONFIG['BANDED_MIN_PIXELS']
+
+def draw_name_band(canvas, name, font, config):
+    """Dibuja el nombre sobre el lienzo y devuelve la franja modificada"""
+    left, top, right, bottom = draw_text_centered(canvas, name, font, config)
+    # Margen para el antialiasing y recorte a los límites de la imagen
+    return (max(0, left - 2), max(0, top - 2),
+            min(canvas.width, right + 2), min(canvas.height, bottom + 2))
+
+def restore_band(canvas, template, box):
+    """Devuelve la franja del texto a su estado original de la plantilla"""
+    canvas.paste(template.crop(box), box)
+
+def writable_copy(template):
+    """Copia de trabajo de la plantilla en su modo lógico (RGBX mapeado -> RGB)"""
+    if template.mode == 'RGBX':
+        return template.convert('RGB')
+    return template.copy()
+
+# ===== PLANTILLA MAPEADA PARA PROCESOS TRABAJADORES =====
+# Modo crudo en disco: RGB se guarda como RGBX para que Image.frombuffer no tenga que copiar
+RAW_MODES = {'RGB': 'RGBX', 'RGBA': 'RGBA', 'L': 'L'}
+
+def publish_template(image, raw_path):
+    """Escribe la plantilla decodificada como archivo crudo mapeable y devuelve su descripción"""
+    raw_mode = RAW_MODES.get(image.mode)
+    if raw_mode is None:
+        image = image.convert('RGB')
+        raw_mode = RAW_MODES['RGB']
+    
+    part_path = raw_path + '.part'
+    with open(part_path, 'wb') as f:
+        # Por franjas de filas para no duplicar la plantilla completa en memoria
+        rows = max(1, (8 * 1024 * 1024) // (image.width * 4))
+        for top in range(0, image.height, rows):
+            band = image.crop((0, top, image.width, min(image.height, top + rows)))
+            f.write(band.tobytes('raw', raw_mode))
+    os.replace(part_path, raw_path)
+    return {'path': raw_path, 'raw_mode': raw_mode, 'size': image.size}
+
+class MappedTemplate:
+    """Plantilla publicada con publish_template, mapeada en memoria y compartida sin copias
+
+    Todos los procesos que la abren comparten las mismas páginas de la caché del sistema.
+    """
+    
+    def __init__(self, spec):
+        self.spec = spec
+        with open(spec['path'], 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        raw_mode = spec['raw_mode']
+        self.image = Image.frombuffer(raw_mode, tuple(spec['size']), self._map, 'raw', raw_mode, 0, 1)
+    
+    def array(self):
+        """Vista numpy (alto, ancho, canales) del mismo buffer, o None sin numpy"""
+        if not numpy_available():
+            return None
+        import numpy as np
+        width, height = self.spec['size']
+        bands = len(self.spec['raw_mode'])
+        array = np.frombuffer(self._map, dtype=np.uint8).reshape(height, width, bands)
+        return array[..., :3] if self.spec['raw_mode'] == 'RGBX' else array
+
+# ===== COMPOSICIÓN POR LOTES CON NUMPY =====
+def numpy_available():
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def resolve_engine(engine, base_template, names, font, config):
+    """Motor efectivo ('pil' o 'numpy') para el lote según la petición y la configuración"""
+    engine = (engine or CONFIG['RENDER_ENGINE']).lower()
+    if engine not in ('auto', 'numpy'):
+        return 'pil'
+    if engine == 'auto' and len(names) < CONFIG['NUMPY_MIN_NAMES']:
+        return 'pil'
+    # La mezcla vectorizada reproduce la de Pillow en RGB y L; en RGBA Pillow compone el alfa aparte
+    if (base_template.mode not in ('RGB', 'RGBX', 'L')
+            or get_glyph_atlas(font) is None or not numpy_available()):
+        return 'pil'
+    return 'numpy'
+
+class NumpyCompositor:
+    """Compone varios nombres a la vez sobre la franja de texto de la plantilla
+
+    Las máscaras de los glifos del atlas se combinan por máximo (igual que la máscara
+    de texto de FreeType) en un arreglo (k, alto, ancho) y se mezclan con el color
+    usando la misma aritmética entera que Pillow, de modo que el resultado coincide
+    con ImageDraw.text. Los buffers de trabajo y el lienzo de salida se reutilizan.
+    """
+    
+    def __init__(self, template, atlas, color, batch_names=None, batch_bytes=None, template_array=None):
+        import numpy as np
+        self.np = np
+        self.template = template
+        # Una vista ya existente (p. ej. de una plantilla mapeada) evita copiar la plantilla
+        self.template_array = np.asarray(template) if template_array is None else template_array
+        if self.template_array.ndim == 2:
+            self.template_array = self.template_array[..., None]
+        self.channels = self.template_array.shape[2]
+        self.atlas = atlas
+        self.color = np.array(color_for_mode(color, template.mode), dtype=np.int32).reshape(-1)
+        self.batch_names = batch_names or CONFIG['NUMPY_BATCH_NAMES']
+        self.batch_bytes = batch_bytes or CONFIG['NUMPY_BATCH_MB'] * 1024 * 1024
+        self.canvas = writable_copy(template)
+        self._canvas_box = None
+        self._glyph_arrays = {}
+        self._buffers = {}
+    
+    def _buffer(self, key, shape, dtype):
+        """Vista de un buffer reutilizable con la forma pedida (crece si hace falta)"""
+        size = 1
+        for dim in shape:
+            size *= dim
+        buffer = self._buffers.get(key)
+        if buffer is None or buffer.size < size:
+            buffer = self._buffers[key] = self.np.empty(size, dtype=dtype)
+        return buffer[:size].reshape(shape)
+    
+    def _glyph_array(self, mask):
+        array = self._glyph_arrays.get(id(mask))
+        if array is None:
+            array = self.np.asarray(mask)
+            # Los trazos con shaping son de un solo nombre y pueden salir de su caché
+            if self.atlas.owns(mask):
+                self._glyph_arrays[id(mask)] = array
+        return array
+    
+    def _layout(self, names, cx, cy):
+        """Posiciones absolutas de cada nombre y franja común recortada a la plantilla"""
+        layouts = []
+        x0 = y0 = math.inf
+        x1 = y1 = -math.inf
+        for name in names:
+            positions, (left, top, right, bottom) = self.atlas.layout(name)
+            x = cx - ((right - left) // 2)
+            y = cy - ((bottom - top) // 2)
+            layouts.append((positions, x, y))
+            x0, y0 = min(x0, x + left), min(y0, y + top)
+            x1, y1 = max(x1, x + right), max(y1, y + bottom)
+        width, height = self.template.size
+        box = (max(0, x0), max(0, y0), min(width, x1), min(height, y1))
+        return layouts, box
+    
+    def composite(self, names, cx, cy):
+        """Devuelve (franja, arreglo uint8 (k, alto, ancho, canales)) con cada nombre compuesto"""
+        np = self.np
+        layouts, (bx0, by0, bx1, by1) = self._layout(names, cx, cy)
+        if bx1 <= bx0 or by1 <= by0:
+            return None, None
+        bw, bh, k = bx1 - bx0, by1 - by0, len(names)
+        
+        masks = self._buffer('masks', (k, bh, bw), np.uint8)
+        masks.fill(0)
+        for index, (positions, x, y) in enumerate(layouts):
+            for mask, gx, gy in positions:
+                glyph = self._glyph_array(mask)
+                px, py = x + gx - bx0, y + gy - by0
+                # Recortar el glifo a la franja
+                sx, sy = max(0, -px), max(0, -py)
+                ex, ey = min(glyph.shape[1], bw - px), min(glyph.shape[0], bh - py)
+                if sx >= ex or sy >= ey:
+                    continue
+                region = masks[index, py + sy:py + ey, px + sx:px + ex]
+                np.maximum(region, glyph[sy:ey, sx:ex], out=region)
+        
+        # Mezcla de Pillow (BLEND): DIV255(dst * (255 - m) + c * m), reescrita como
+        # (c - dst) * m + (dst * 255 + 128) para reutilizar la franja en todo el lote
+        band = self.template_array[by0:by1, bx0:bx1].astype(np.int32)
+        base = band * 255 + 128
+        shape = (k, bh, bw, self.channels)
+        work = self._buffer('work', shape, np.int32)
+        carry = self._buffer('carry', shape, np.int32)
+        np.subtract(self.color, band, out=work)
+        np.multiply(work, masks[..., None], out=work)
+        np.add(work, base, out=work)
+        np.right_shift(work, 8, out=carry)
+        np.add(work, carry, out=work)
+        np.right_shift(work, 8, out=work)
+        result = self._buffer('result', shape, np.uint8)
+        np.copyto(result, work, casting='unsafe')
+        return (bx0, by0, bx1, by1), result
+    
+    def _batch_size(self, names, cx, cy):
+        """Nombres por llamada sin que los buffers superen el tope configurado"""
+        _, (bx0, by0, bx1, by1) = self._layout(names[:self.batch_names], cx, cy)
+        # Máscara uint8 + dos buffers int32 + resultado uint8 por canal
+        per_name = max(1, (bx1 - bx0) * (by1 - by0)) * (1 + self.channels * (4 * 2 + 1))
+        return max(1, min(self.batch_names, self.batch_bytes // per_name))
+    
+    def iter_rendered(self, names, cx, cy):
+        """Produce (nombre, lienzo) reutilizando el mismo lienzo de salida"""
+        index = 0
+        while index < len(names):
+            batch = names[index:index + self._batch_size(names[index:], cx, cy)]
+            index += len(batch)
+            box, result = self.composite(batch, cx, cy)
+            if self._canvas_box is not None and self._canvas_box != box:
+                restore_band(self.canvas, self.template, self._canvas_box)
+                self._canvas_box = None
+            for offset, name in enumerate(batch):
+                if box is not None:
+                    band = result[offset] if self.channels > 1 else result[offset, ..., 0]
+                    self.canvas.paste(Image.fromarray(band), box[:2])
+                    self._canvas_box = box
+                yield name, self.canvas
+
+def iter_rendered(base_template, names, font, config, engine=None, template_array=None):
+    """Produce (nombre, imagen, error) por nombre; en plantillas enormes trabaja por franjas
+
+    La imagen solo es válida hasta la siguiente iteración. template_array es una vista
+    numpy opcional de la plantilla que el motor numpy usa en lugar de copiarla.
+    """
+    config = config_for_mode(config, base_template.mode)
+    if resolve_engine(engine, base_template, names, font, config) == 'numpy':
+        names = list(names)
+        delivered = 0
+        try:
+            compositor = NumpyCompositor(base_template, get_glyph_atlas(font), config['font_color'],
+                                         template_array=template_array)
+            for name, img in compositor.iter_rendered(names, config['x'], config['y']):
+                yield name, img, None
+                delivered += 1
+            return
+        except Exception as e:
+            # Un fallo de composición no debe tumbar el lote: el resto sigue con Pillow
+            logger.warning("Composición numpy fallida, se continúa con Pillow: %s", e)
+        names = names[delivered:]
+
+    yield from _iter_rendered_pil(base_template, names, font, config)
+
+def _iter_rendered_pil(base_template, names, font, config):
+    if not use_banded_rendering(base_template):
+        for name in names:
+            try:
+                yield name, render_name(base_template, name, font, config), None
+            except Exception as e:
+                yield name, None, e
+        return
+    
+    canvas = writable_copy(base_template)
+    for name in names:
+        try:
+            box = draw_name_band(canvas, name, font, config)
+        except Exception as e:
+            # Sin franja conocida: rehacer el lienzo completo por seguridad
+            canvas = writable_copy(base_template)
+            yield name, None, e
+            continue
+        try:
+            yield name, canvas, None
+        finally:
+            restore_band(canvas, base_template, box)
+
+# ===== CACHÉ DE RESULTADOS RENDERIZADOS =====
+class RenderCache:
+    """LRU en memoria limitado por bytes, con un segundo nivel opcional en disco"""
+    
+    def __init__(self, max_bytes, disk_folder=None):
+        self.max_bytes = max_bytes
+        self.disk_folder = disk_folder
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _disk_path(self, key):
+        return os.path.join(self.disk_folder, key + '.bin')
+    
+    def get(self, key):
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return data
+        
+        if self.disk_folder:
+            try:
+                with open(self._disk_path(key), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                data = None
+            if data is not None:
+                self._remember(key, data)
+                self.hits += 1
+                return data
+        
+        self.misses += 1
+        return None
+    
+    def put(self, key, data):
+        self._remember(key, data)
+        if self.disk_folder:
+            # Escritura atómica: nunca se lee un archivo a medio escribir
+            path = self._disk_path(key)
+            tmp_path = f'{path}.{threading.get_ident()}.part'
+            try:
+                os.makedirs(self.disk_folder, exist_ok=True)
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.debug("No se pudo escribir la caché en disco: %s", e)
+    
+    def _remember(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._items[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+    
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._items), 'bytes': self.size,
+                    'hits': self.hits, 'misses': self.misses}
+
+def render_cache_key(kind, template_path, config, text, extra=None):
+    """Clave: hash de la plantilla + configuración de texto completa + texto + extra"""
+    payload = json.dumps(
+        [kind, template_hash(template_path), config, text, extra],
+        sort_keys=True, ensure_ascii=False, default=list
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+render_cache = RenderCache(
+    CONFIG['RENDER_CACHE_MB'] * 1024 * 1024,
+    os.path.join(CONFIG['OUTPUT_FOLDER'], '.cache') if CONFIG['RENDER_CACHE_DISK'] else None
+)
+
+# ===== CICLO DE VIDA DEL ALMACENAMIENTO =====
+class Job:
+    """Directorio propio de un trabajo de generación dentro de OUTPUT_FOLDER"""
+    
+    def __init__(self, job_id, path):
+        self.id = job_id
+        self.dir = path
+        self.keep = False  # se marca al terminar el ZIP; si no, el directorio se elimina
+    
+    def relpath(self, filename):
+        return f'{self.id}/{filename}'
+
+class StorageManager:
+    """Retención por antigüedad y cuota de tamaño, con un hilo de limpieza en segundo plano"""
+    
+    # Subcarpetas cuyos archivos se gestionan uno a uno (y no como una sola entrada)
+    FLAT_FOLDERS = {'.cache'}
+    
+    def __init__(self, config):
+        self.config = config
+        self._active = set()
+        self._in_use = {}  # ruta absoluta de una plantilla -> trabajos que la usan
+        self.before_sweep = []  # funciones que sueltan lo inactivo (p. ej. lotes abiertos) antes de limpiar
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+    
+    @contextmanager
+    def protect(self, paths):
+        """Protege de la limpieza los archivos indicados (p. ej. plantillas en uso) mientras dure"""
+        paths = [os.path.abspath(path) for path in paths if path]
+        with self._lock:
+            for path in paths:
+                self._in_use[path] = self._in_use.get(path, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                for path in paths:
+                    self._in_use[path] -= 1
+                    if not self._in_use[path]:
+                        del self._in_use[path]
+    
+    @contextmanager
+    def job(self, templates=()):
+        """Crea un directorio por trabajo; él y sus plantillas quedan protegidos mientras está activo"""
+        job_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        job = Job(job_id, os.path.join(self.config['OUTPUT_FOLDER'], job_id))
+        os.makedirs(job.dir)
+        with self._lock:
+            self._active.add(os.path.abspath(job.dir))
+        try:
+            with self.protect(templates):
+                yield job
+        finally:
+            with self._lock:
+                self._active.discard(os.path.abspath(job.dir))
+            if not job.keep:
+                shutil.rmtree(job.dir, ignore_errors=True)
+    
+    def _entries(self, root):
+        """(ruta, mtime, bytes) de cada unidad borrable bajo root"""
+        entries = []
+        try:
+            children = list(os.scandir(root))
+        except OSError:
+            return entries
+        for entry in children:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name in self.FLAT_FOLDERS:
+                        entries.extend(self._entries(entry.path))
+                        continue
+                    size = 0
+                    for dirpath, _, filenames in os.walk(entry.path):
+                        for filename in filenames:
+                            try:
+                                size += os.path.getsize(os.path.join(dirpath, filename))
+                            except OSError:
+                                pass
+                    entries.append((entry.path, entry.stat().st_mtime, size))
+                else:
+                    stat = entry.stat()
+                    entries.append((entry.path, stat.st_mtime, stat.st_size))
+            except OSError:
+                continue
+        return entries
+    
+    def _remove(self, path):
+        with self._lock:
+            if os.path.abspath(path) in self._active or os.path.abspath(path) in self._in_use:
+                return False
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            return True
+        except OSError as e:
+            logger.debug("No se pudo eliminar %s: %s", path, e)
+            return False
+    
+    def sweep(self):
+        """Aplica TTL y cuota a cada carpeta gestionada; devuelve (eliminados, bytes liberados)"""
+        for release_idle in self.before_sweep:
+            try:
+                release_idle()
+            except Exception as e:
+                logger.warning("Error al liberar recursos inactivos antes de la limpieza: %s", e)
+        removed, freed = 0, 0
+        now = time.time()
+        for folder_key, ttl_hours in self.config['STORAGE_TTL_HOURS'].items():
+            root = self.config[folder_key]
+            quota = self.config['STORAGE_QUOTA_MB'].get(folder_key, 0) * 1024 * 1024
+            entries = sorted(self._entries(root), key=lambda item: item[1])  # más antiguos primero
+            total = sum(size for _, _, size in entries)
+            
+            for path, mtime, size in entries:
+                expired = ttl_hours and now - mtime > ttl_hours * 3600
+                over_quota = quota and total > quota
+                if not (expired or over_quota):
+                    continue
+                if self._remove(path):
+                    removed += 1
+                    freed += size
+                    total -= size
+        
+        if removed:
+            logger.info("Limpieza de almacenamiento: eliminados=%d liberados=%.1fMB", removed, freed / (1024 * 1024))
+        return removed, freed
+    
+    def _run(self):
+        while not self._stop.wait(self.config['STORAGE_SWEEP_SECONDS']):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.warning("Error en la limpieza de almacenamiento: %s", e)
+    
+    def start(self):
+        """Inicia el hilo de limpieza (una limpieza inmediata y luego periódica)"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='xonidip-storage', daemon=True)
+        self._thread.start()
+        threading.Thread(target=self.sweep, daemon=True).start()
+    
+    def stop(self):
+        self._stop.set()
+
+storage = StorageManager(CONFIG)
+
+# ===== REGISTRO DE DIPLOMAS EMITIDOS =====
+def name_key(name):
+    """Clave normalizada de un nombre: sin tildes, sin mayúsculas y con espacios simples"""
+    decomposed = unicodedata.normalize('NFKD', name)
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(stripped.casefold().split())
+
+def issuance_id(batch, name, filename):
+    """Identificador de verificación: hash del lote, el nombre y el archivo"""
+    return hashlib.sha256(f'{batch}\0{name}\0{filename}'.encode('utf-8')).hexdigest()[:20]
+
+class IssuanceBatch:
+    """Escritura por bloques de los diplomas de un trabajo; se descarta si no se conserva"""
+    
+    def __init__(self, registry, batch, template_key, output_format):
+        self.registry = registry
+        self.batch = batch
+        self.template_key = template_key
+        self.output_format = output_format
+        self.keep = False
+        self.ids = {}  # archivo -> id
+        self._rows = []
+    
+    def add(self, filename, name, template_key=None):
+        issued_id = issuance_id(self.batch, name, filename)
+        self.ids[filename] = issued_id
+        self._rows.append((issued_id, name, name_key(name), self.batch, filename,
+                           template_key or self.template_key,
+                           self.output_format, datetime.now().isoformat(timespec='seconds')))
+        if len(self._rows) >= self.registry.flush_rows:
+            self.flush()
+        return issued_id
+    
+    def reuse(self, filename, issued_id):
+        """Diploma copiado de un trabajo anterior: conserva el id con el que ya se emitió"""
+        self.ids[filename] = issued_id
+    
+    def flush(self):
+        if self._rows:
+            self.registry.insert(self._rows)
+            self._rows = []
+
+class IssuanceRegistry:
+    """Registro persistente en SQLite con una LRU en memoria para las verificaciones"""
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS issued (
+            id TEXT PRIMARY KEY, name TEXT NOT NULL, name_key TEXT NOT NULL, batch TEXT NOT NULL,
+            filename TEXT, template TEXT, format TEXT, issued_at TEXT
+        );
+        CREATE INDEX IF NOT EXISTS issued_name ON issued (name_key);
+        CREATE INDEX IF NOT EXISTS issued_batch ON issued (batch);
+    """
+    
+    def __init__(self, path, cache_size=10000, flush_rows=1000):
+        self.path = path
+        self.cache_size = cache_size
+        self.flush_rows = flush_rows
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._local = threading.local()
+        self._schema_ready = False
+    
+    def _connection(self):
+        """Una conexión por hilo; el esquema se crea en el primer uso"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')  # las lecturas no esperan a las escrituras
+            if not self._schema_ready:
+                db.executescript(self.SCHEMA)
+                self._schema_ready = True
+        return db
+    
+    @contextmanager
+    def batch(self, batch, template_key, output_format):
+        """Registra los diplomas del trabajo mientras se generan; borra el lote si no se conserva"""
+        issued = IssuanceBatch(self, batch, template_key, output_format)
+        try:
+            yield issued
+        finally:
+            if issued.keep:
+                issued.flush()
+            elif issued.ids:
+                self.discard(batch)
+    
+    def insert(self, rows):
+        """Inserción por bloques en una sola transacción"""
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany('INSERT OR REPLACE INTO issued VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        # Una consulta previa de estos ids pudo quedar en caché como inexistente
+        with self._cache_lock:
+            for row in rows:
+                self._cache.pop(row[0], None)
+    
+    def discard(self, batch):
+        db = self._connection()
+        db.execute('DELETE FROM issued WHERE batch = ?', (batch,))
+        with self._cache_lock:
+            self._cache.clear()
+    
+    def lookup(self, issued_id):
+        """Diploma emitido con ese id (dict) o None; las respuestas se cachean en una LRU"""
+        with self._cache_lock:
+            if issued_id in self._cache:
+                self._cache.move_to_end(issued_id)
+                return self._cache[issued_id]
+        
+        row = self._connection().execute(
+            'SELECT id, name, batch, filename, format, issued_at FROM issued WHERE id = ?', (issued_id,)
+        ).fetchone()
+        record = None
+        if row:
+            record = dict(zip(('id', 'name', 'batch', 'file', 'format', 'issued_at'), row))
+        
+        with self._cache_lock:
+            self._cache[issued_id] = record
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return record
+
+registry = IssuanceRegistry(CONFIG['REGISTRY_PATH'], CONFIG['REGISTRY_CACHE_SIZE'],
+                            CONFIG['REGISTRY_FLUSH_ROWS'])
+
+# ===== LISTADOS GUARDADOS Y DIFERENCIAS =====
+ROSTER_ID_PATTERN = re.compile(r'^[0-9a-f]{16}$')
+
+def _roster_path(roster_id):
+    return os.path.join(CONFIG['ROSTER_FOLDER'], f'{roster_id}.json')
+
+def save_roster(rows):
+    """Guarda un listado [(nombre, clave de plantilla)] y devuelve su id (hash del contenido)"""
+    payload = json.dumps([list(row) for row in rows], ensure_ascii=False)
+    roster_id = hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+    path = _roster_path(roster_id)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.part', 'w', encoding='utf-8') as f:
+            f.write(payload)
+        os.replace(path + '.part', path)
+    return roster_id
+
+def load_roster(roster_id):
+    """Listado guardado [(nombre, clave)] o None si no existe (o ya expiró)"""
+    if not ROSTER_ID_PATTERN.match(roster_id or ''):
+        return None
+    try:
+        with open(_roster_path(roster_id), 'r', encoding='utf-8') as f:
+            return [tuple(row) for row in json.load(f)]
+    except (OSError, ValueError):
+        return None
+
+def diff_rosters(old_rows, new_rows, similarity=None):
+    """Altas, bajas y correcciones entre dos listados [(nombre, clave de plantilla)]
+    
+    Una baja y un alta con la misma plantilla son una corrección si coinciden sus claves
+    normalizadas (tildes, mayúsculas, espacios) o si se parecen al menos `similarity`.
+    """
+    similarity = CONFIG['ROSTER_RENAME_SIMILARITY'] if similarity is None else similarity
+    old_rows, new_rows = list(dict.fromkeys(old_rows)), list(dict.fromkeys(new_rows))
+    old_set, new_set = set(old_rows), set(new_rows)
+    removed = [row for row in old_rows if row not in new_set]
+    added = [row for row in new_rows if row not in old_set]
+    renamed = []
+    
+    # Primero, misma clave normalizada ("Jose  perez" -> "José Pérez")
+    by_key = {}
+    for row in removed:
+        by_key.setdefault((row[1], name_key(row[0])), []).append(row)
+    matched = set()
+    for row in added:
+        candidates = by_key.get((row[1], name_key(row[0])))
+        if candidates:
+            old = candidates.pop(0)
+            renamed.append((old, row))
+            matched.update((old, row))
+    removed = [row for row in removed if row not in matched]
+    added = [row for row in added if row not in matched]
+    
+    # Después, errores de tipeo ("Rodriges" -> "Rodríguez"), solo si quedan pocos pares
+    if removed and added and len(removed) * len(added) <= CONFIG['ROSTER_FUZZY_MAX_PAIRS']:
+        remaining = list(removed)
+        for row in list(added):
+            matcher = difflib.SequenceMatcher(None, b=name_key(row[0]))  # seq2 fija: se indexa una vez
+            best, best_ratio = None, similarity
+            for old in remaining:
+                if old[1] != row[1]:
+                    continue
+                matcher.set_seq1(name_key(old[0]))
+                if matcher.real_quick_ratio() < best_ratio or matcher.quick_ratio() < best_ratio:
+                    continue
+                ratio = matcher.ratio()
+                if ratio >= best_ratio:
+                    best, best_ratio = old, ratio
+            if best is not None:
+                remaining.remove(best)
+                added.remove(row)
+                renamed.append((best, row))
+        removed = remaining
+    
+    as_row = lambda row: {'name': row[0], 'template': row[1]}
+    return {
+        'added': [as_row(row) for row in added],
+        'removed': [as_row(row) for row in removed],
+        'renamed': [{'from': old[0], 'to': new[0], 'template': new[1]} for old, new in renamed],
+        'unchanged': len(old_set & new_set),
+    }
+
+# ===== TRABAJOS ANTERIORES (REGENERAR SOLO LO QUE CAMBIÓ) =====
+JOB_ID_PATTERN = re.compile(r'^\d{8}_\d{6}_[0-9a-f]{8}$')
+JOB_META = 'trabajo.json'
+
+def group_signature(group_hash, config, output_format, profile):
+    """Lo que determina el contenido de un diploma, aparte del nombre (group_hash: SHA-256 de la plantilla)"""
+    return hashlib.sha256(json.dumps(
+        [group_hash, config, output_format.upper(), profile],
+        sort_keys=True, default=list
+    ).encode('utf-8')).hexdigest()
+
+def write_job_meta(job_dir, signatures):
+    """Guarda la firma de cada grupo ({carpeta o '': firma}) junto al ZIP del trabajo"""
+    with open(os.path.join(job_dir, JOB_META), 'w', encoding='utf-8') as f:
+        json.dump({'groups': signatures}, f)
+
+def load_job_outputs(job_id):
+    """Diplomas de un trabajo anterior: ({carpeta: firma}, {(carpeta, nombre): (entrada, id, ZIP)})
+    
+    Devuelve None si el trabajo no existe, ya expiró o es anterior a trabajo.json.
+    """
+    if not JOB_ID_PATTERN.match(job_id or ''):
+        return None
+    job_dir = os.path.join(CONFIG['OUTPUT_FOLDER'], job_id)
+    try:
+        with open(os.path.join(job_dir, JOB_META), 'r', encoding='utf-8') as f:
+            signatures = json.load(f)['groups']
+        zip_paths = sorted(os.path.join(job_dir, name) for name in os.listdir(job_dir)
+                           if name.startswith('diplomas_') and name.endswith('.zip'))
+    except (OSError, ValueError, KeyError):
+        return None
+    
+    located, manifest = {}, []
+    for zip_path in zip_paths:
+        with zipfile.ZipFile(zip_path) as archive:
+            arcnames = archive.namelist()
+            for arcname in arcnames:
+                located[arcname] = zip_path
+            if 'verificacion.csv' in arcnames:
+                with archive.open('verificacion.csv') as f:
+                    manifest = list(csv.DictReader(io.TextIOWrapper(f, encoding='utf-8-sig')))
+    
+    entries = {}
+    for row in manifest:
+        arcname = row['archivo']
+        if arcname in located:
+            entries[(os.path.dirname(arcname), row['nombre'])] = (arcname, row['id'], located[arcname])
+    return signatures, entries
+
+# ===== IMPOSICIÓN PARA IMPRENTA =====
+MM_TO_PT = 72 / 25.4
+IMPOSITION_BLOCK = 16  # franjas alineadas a los bloques JPEG (MCU de 16 px como máximo)
+CROP_MARK_MM = (3, 5)  # separación del corte y largo de cada marca
+
+def imposition_settings(options=None):
+    """Normaliza las opciones de imposición (True o dict sobre CONFIG['IMPOSITION'])
+
+    Lanza ValueError si la hoja o las medidas no son válidas.
+    """
+    settings = dict(CONFIG['IMPOSITION'])
+    if isinstance(options, dict):
+        settings.update({key: value for key, value in options.items() if key in settings})
+    settings['sheet'] = str(settings['sheet']).upper()
+    if settings['sheet'] not in CONFIG['SHEET_SIZES_MM']:
+        raise ValueError(f"Hoja no válida: {settings['sheet']} "
+                         f"(disponibles: {', '.join(CONFIG['SHEET_SIZES_MM'])})")
+    settings['up'] = int(settings['up'])
+    if not 1 <= settings['up'] <= CONFIG['IMPOSITION_MAX_UP']:
+        raise ValueError(f"Diplomas por hoja fuera de rango: {settings['up']} (1-{CONFIG['IMPOSITION_MAX_UP']})")
+    settings['margin_mm'] = float(settings['margin_mm'])
+    settings['gap_mm'] = float(settings['gap_mm'])
+    if settings['margin_mm'] < 0 or settings['gap_mm'] < 0:
+        raise ValueError('Margen y separación no pueden ser negativos')
+    settings['dpi'] = float(settings['dpi'])
+    if settings['dpi'] <= 0:
+        raise ValueError(f"Resolución no válida: {settings['dpi']}")
+    settings['crop_marks'] = bool(settings['crop_marks'])
+    return settings
+
+def imposition_layout(page_size, settings):
+    """Hoja y celdas para diplomas de page_size (ancho, alto en pt)
+
+    Prueba cada reparto columnas x filas en la hoja vertical y apaisada y se queda con el
+    que reduce menos el diploma (nunca se amplía). Devuelve (hoja, celdas, escala, marcas):
+    celdas en pt desde la esquina inferior izquierda y marcas como segmentos de recorte.
+    """
+    up = settings['up']
+    margin, gap = settings['margin_mm'] * MM_TO_PT, settings['gap_mm'] * MM_TO_PT
+    short, long_ = sorted(size * MM_TO_PT for size in CONFIG['SHEET_SIZES_MM'][settings['sheet']])
+    width, height = page_size
+    best = None
+    for sheet in ((short, long_), (long_, short)):
+        for cols in range(1, up + 1):
+            if up % cols:
+                continue
+            rows = up // cols
+            usable_w = sheet[0] - 2 * margin - (cols - 1) * gap
+            usable_h = sheet[1] - 2 * margin - (rows - 1) * gap
+            scale = min(1.0, usable_w / (cols * width), usable_h / (rows * height))
+            if scale > 0 and (best is None or scale > best[0] + 1e-9):
+                best = (scale, sheet, cols, rows)
+    if best is None:
+        raise ValueError('Los márgenes no dejan espacio para los diplomas en la hoja')
+    scale, sheet, cols, rows = best
+    
+    cell_w, cell_h = width * scale, height * scale
+    grid_w, grid_h = cols * cell_w + (cols - 1) * gap, rows * cell_h + (rows - 1) * gap
+    x0, y0 = (sheet[0] - grid_w) / 2, (sheet[1] - grid_h) / 2
+    # De izquierda a derecha y de arriba abajo
+    cells = [(x0 + col * (cell_w + gap), y0 + (rows - 1 - row) * (cell_h + gap), cell_w, cell_h)
+             for row in range(rows) for col in range(cols)]
+    
+    marks = []
+    offset, length = (value * MM_TO_PT for value in CROP_MARK_MM)
+    length = min(length, min(x0, y0) - offset)
+    if settings['crop_marks'] and length > 0:
+        # Marcas solo fuera de la rejilla: en los márgenes, una por cada línea de corte
+        xs = sorted({round(x, 3) for x, _, w, _ in cells} | {round(x + w, 3) for x, _, w, _ in cells})
+        ys = sorted({round(y, 3) for _, y, _, h in cells} | {round(y + h, 3) for _, y, _, h in cells})
+        for x in xs:
+            marks.append((x, y0 - offset, x, y0 - offset - length))
+            marks.append((x, y0 + grid_h + offset, x, y0 + grid_h + offset + length))
+        for y in ys:
+            marks.append((x0 - offset, y, x0 - offset - length, y))
+            marks.append((x0 + grid_w + offset, y, x0 + grid_w + offset + length, y))
+    return sheet, cells, scale, marks
+
+def _pdf_number(value):
+    return f'{value:.3f}'.rstrip('0').rstrip('.')
+
+class ImposedPDF:
+    """PDF de varias páginas con N diplomas por hoja, escrito a medida que llegan
+
+    La plantilla de cada grupo se incrusta una sola vez como imagen compartida por todas
+    las páginas; cada diploma solo aporta la franja de su nombre, colocada encima. Las
+    franjas se alinean a los bloques JPEG y usan la misma calidad que la plantilla, así que
+    sus bordes decodifican igual que la plantilla de debajo. En memoria solo quedan los
+    desplazamientos de los objetos ya escritos.
+    """
+    
+    def __init__(self, path, settings, profile=None):
+        self.path = path
+        self.settings = settings
+        options = encoder_options('PDF', profile)
+        self.resolution = settings['dpi']
+        self.quality = options.get('quality', 75)
+        self.count = 0
+        self._groups = 0
+        self._file = open(path + '.part', 'wb')
+        self._offsets = [None, None, None]  # 1 catálogo, 2 árbol de páginas
+        self._pages = []
+        self._template = None  # (nombre del recurso, número de objeto, tamaño, disposición)
+        self._slots = []       # franjas de la hoja en curso
+        self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        self._object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+    
+    def _write(self, data):
+        self._file.write(data)
+    
+    def _new_object(self):
+        self._offsets.append(None)
+        return len(self._offsets) - 1
+    
+    def _object(self, number, body, stream=None):
+        self._offsets[number] = self._file.tell()
+        self._write(f'{number} 0 obj\n'.encode('ascii') + body)
+        if stream is not None:
+            self._write(b'\nstream\n' + stream + b'\nendstream')
+        self._write(b'\nendobj\n')
+    
+    def _image(self, image):
+        """Escribe la imagen como XObject JPEG y devuelve su número de objeto"""
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=self.quality, subsampling=0)
+        data = buffer.getvalue()
+        colorspace = '/DeviceGray' if image.mode == 'L' else '/DeviceRGB'
+        number = self._new_object()
+        self._object(number, (f'<< /Type /XObject /Subtype /Image /Width {image.width} '
+                              f'/Height {image.height} /ColorSpace {colorspace} /BitsPerComponent 8 '
+                              f'/Filter /DCTDecode /Length {len(data)} >>').encode('ascii'), data)
+        return number
+    
+    def start_group(self, template):
+        """Nueva plantilla: se incrusta una vez y sus diplomas empiezan en hoja nueva"""
+        self._flush_sheet()
+        image = writable_copy(template) if template.mode == 'RGBX' else template
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        px_to_pt = 72.0 / self.resolution
+        layout = imposition_layout((image.width * px_to_pt, image.height * px_to_pt), self.settings)
+        self._groups += 1
+        name = f'T{self._groups}'
+        self._template = (name, self._image(image), image.size, layout)
+        return layout
+    
+    def add(self, img, box):
+        """Coloca el diploma (renderizado sobre la plantilla del grupo) en la siguiente celda
+
+        box es la caja del texto en píxeles; devuelve (hoja, celda) empezando en 1.
+        """
+        _, _, (width, height), (_, cells, _, _) = self._template
+        band = None
+        if box is not None:
+            block = IMPOSITION_BLOCK
+            left, top, right, bottom = box
+            left, top = max(0, (left - 2) // block * block), max(0, (top - 2) // block * block)
+            right = min(width, -(-(right + 2) // block) * block)
+            bottom = min(height, -(-(bottom + 2) // block) * block)
+            if right > left and bottom > top:
+                crop = img.crop((left, top, right, bottom))
+                if crop.mode not in ('RGB', 'L'):
+                    crop = crop.convert('RGB')
+                band = ((left, top, right, bottom), self._image(crop))
+        self._slots.append(band)
+        self.count += 1
+        position = (len(self._pages) + 1, len(self._slots))
+        if len(self._slots) == len(cells):
+            self._flush_sheet()
+        return position
+    
+    def _flush_sheet(self):
+        if not self._slots:
+            return
+        name, template_number, (width, height), (sheet, cells, _, marks) = self._template
+        resources = [f'/{name} {template_number} 0 R']
+        content = []
+        for index, (band, (x, y, cell_w, cell_h)) in enumerate(zip(self._slots, cells)):
+            content.append(f'q {_pdf_number(cell_w)} 0 0 {_pdf_number(cell_h)} {_pdf_number(x)} '
+                           f'{_pdf_number(y)} cm /{name} Do Q')
+            if band is None:
+                continue
+            (left, top, right, bottom), band_number = band
+            scale_x, scale_y = cell_w / width, cell_h / height
+            band_name = f'N{index + 1}'
+            resources.append(f'/{band_name} {band_number} 0 R')
+            content.append(f'q {_pdf_number((right - left) * scale_x)} 0 0 {_pdf_number((bottom - top) * scale_y)} '
+                           f'{_pdf_number(x + left * scale_x)} {_pdf_number(y + (height - bottom) * scale_y)} '
+                           f'cm /{band_name} Do Q')
+        if marks:
+            content.append('q 0 G 0.25 w')
+            content.extend(f'{_pdf_number(x1)} {_pdf_number(y1)} m {_pdf_number(x2)} {_pdf_number(y2)} l S'
+                           for x1, y1, x2, y2 in marks)
+            content.append('Q')
+        
+        stream = '\n'.join(content).encode('ascii')
+        content_number = self._new_object()
+        self._object(content_number, f'<< /Length {len(stream)} >>'.encode('ascii'), stream)
+        page_number = self._new_object()
+        self._object(page_number, (
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {_pdf_number(sheet[0])} {_pdf_number(sheet[1])}] '
+            f'/Resources << /XObject << {" ".join(resources)} >> >> /Contents {content_number} 0 R >>'
+        ).encode('ascii'))
+        self._pages.append(page_number)
+        self._slots = []
+    
+    @property
+    def scale(self):
+        """Reducción aplicada a los diplomas del grupo en curso para que quepan en la hoja"""
+        return self._template[3][2] if self._template else 1.0
+    
+    @property
+    def sheets(self):
+        return len(self._pages) + (1 if self._slots else 0)
+    
+    def close(self):
+        """Cierra la última hoja, escribe el árbol de páginas y la tabla xref; devuelve la ruta"""
+        self._flush_sheet()
+        kids = ' '.join(f'{number} 0 R' for number in self._pages)
+        self._object(2, f'<< /Type /Pages /Kids [{kids}] /Count {len(self._pages)} >>'.encode('ascii'))
+        xref = self._file.tell()
+        self._write(f'xref\n0 {len(self._offsets)}\n0000000000 65535 f \n'.encode('ascii'))
+        self._write(''.join(f'{offset:010d} 00000 n \n' for offset in self._offsets[1:]).encode('ascii'))
+        self._write(f'trailer\n<< /Size {len(self._offsets)} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'
+                    .encode('ascii'))
+        self._file.close()
+        os.replace(self.path + '.part', self.path)
+        return self.path
+    
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self.path + '.part')
+        except OSError:
+            pass
+
+def impose_names(writer, template, names, font, config, engine=None):
+    """Agrega al PDF los diplomas de un grupo; produce (nombre, (hoja, celda) o None, error)"""
+    writer.start_group(template)
+    for name, img, error in iter_rendered(template, names, font, config, engine):
+        if error:
+            yield name, None, error
+            continue
+        try:
+            position = writer.add(img, measure_text_centered(name, font, config))
+        except Exception as e:
+            yield name, None, e
+            continue
+        yield name, position, None
@@ -0,0 +1,741 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+XONIDIP 2026 - Granja de render
+El servidor Flask actúa como coordinador: divide el lote en tareas (plantilla por
+hash, configuración del texto y un bloque de nombres) y las publica en una cola.
+Los trabajadores, en este u otros equipos, las toman, generan los diplomas con el
+mismo núcleo y devuelven los archivos ya codificados; el coordinador arma el ZIP.
+
+Colas disponibles:
+    memory                      en el mismo proceso (hilos trabajadores locales)
+    sqlite:///ruta/cola.db      archivo local, para trabajadores en el mismo equipo
+                                (WAL no funciona en carpetas de red)
+    http://servidor:5000/farm   solo trabajadores: la cola del coordinador por HTTP,
+                                para trabajadores en otros equipos (requiere FARM_TOKEN)
+
+Ejemplo de trabajador en otro equipo:
+    XONIDIP_FARM_TOKEN=secreto python xonidip_farm.py --queue http://servidor:5000/farm
+
+Desarrollado por: Darian Alberto Camacho Salas
+Organizacion: XONIDU
+"""
+
+import argparse
+import io
+import json
+import math
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from contextlib import contextmanager
+
+from xonidip_core import (
+    CONFIG, logger, setup_logging, load_font, iter_rendered, encode_diploma,
+    template_hash, shared_templates, memory_budget
+)
+
+class FarmTimeout(Exception):
+    """El trabajo no terminó dentro del tiempo de espera"""
+
+def _chunks(names, size):
+    return [names[i:i + size] for i in range(0, len(names), size)]
+
+def _unfinished(payload, error):
+    """Resultados de una tarea fallida: cada nombre con el error"""
+    return [(name, None, error or 'tarea no completada') for name in payload['names']]
+
+def pack_results(results):
+    """Serializa [(nombre, datos, error)]: por resultado, una línea JSON y después los bytes"""
+    parts = []
+    for name, data, error in results:
+        header = {'name': name, 'error': error, 'size': None if data is None else len(data)}
+        parts.append(json.dumps(header, ensure_ascii=False).encode('utf-8') + b'\n')
+        if data is not None:
+            parts.append(data)
+    return b''.join(parts)
+
+def unpack_results(stream, max_line=64 * 1024):
+    """Inverso de pack_results, leyendo de un flujo; ValueError si está truncado"""
+    results = []
+    while True:
+        line = stream.readline(max_line)
+        if not line:
+            return results
+        header = json.loads(line.decode('utf-8'))
+        data = None
+        if header['size'] is not None:
+            chunks, remaining = [], header['size']
+            while remaining:
+                chunk = stream.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    raise ValueError(f"Resultado de {header['name']} truncado")
+                chunks.append(chunk)
+                remaining -= len(chunk)
+            data = b''.join(chunks)
+        results.append((header['name'], data, header['error']))
+
+# ===== COLA EN MEMORIA =====
+class MemoryQueue:
+    """Cola en el mismo proceso, para un solo equipo y para pruebas"""
+
+    def __init__(self):
+        self._templates = {}
+        self._tasks = {}    # id -> tarea
+        self._results = {}  # id -> [(nombre, datos, error)]
+        self._lock = threading.Lock()
+
+    def has_template(self, key):
+        return key in self._templates
+
+    def put_template(self, key, data):
+        self._templates[key] = data
+
+    def get_template(self, key):
+        return self._templates.get(key)
+
+    def drop_template(self, key):
+        self._templates.pop(key, None)
+
+    def submit(self, job_id, payloads, max_attempts):
+        now = time.time()
+        with self._lock:
+            for seq, payload in enumerate(payloads):
+                task_id = f'{job_id}:{seq}'
+                self._tasks[task_id] = {
+                    'id': task_id, 'job_id': job_id, 'seq': seq, 'payload': payload,
+                    'state': 'pending', 'attempts': 0, 'max_attempts': max_attempts,
+                    'worker': None, 'leased_at': None, 'lease_until': 0.0,
+                    'finished_at': None, 'speculated': False, 'error': None, 'created': now,
+                }
+
+    def claim(self, worker_id, lease_seconds, speculate_factor=0):
+        now = time.time()
+        with self._lock:
+            for task in sorted(self._tasks.values(), key=lambda t: (t['created'], t['seq'])):
+                expired = task['state'] == 'leased' and task['lease_until'] < now
+                if (task['state'] == 'pending' or expired) and task['attempts'] < task['max_attempts']:
+                    task.update(state='leased', worker=worker_id, leased_at=now,
+                                lease_until=now + lease_seconds, attempts=task['attempts'] + 1)
+                    return dict(task)
+
+            # Sin tareas libres: duplicar la más atrasada de un nodo lento
+            if speculate_factor:
+                for task in self._tasks.values():
+                    if (task['state'] != 'leased' or task['speculated'] or task['worker'] == worker_id):
+                        continue
+                    average = self._average_duration(task['job_id'])
+                    if average and now - task['leased_at'] > speculate_factor * average:
+                        task['speculated'] = True
+                        return dict(task)
+        return None
+
+    def _average_duration(self, job_id):
+        durations = [t['finished_at'] - t['leased_at'] for t in self._tasks.values()
+                     if t['job_id'] == job_id and t['state'] == 'done']
+        return sum(durations) / len(durations) if durations else None
+
+    def touch(self, task_id, worker_id, lease_seconds):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task and task['state'] == 'leased' and task['worker'] == worker_id:
+                task['lease_until'] = time.time() + lease_seconds
+
+    def complete(self, task_id, worker_id, results):
+        """Guarda los resultados; solo cuenta la primera entrega de cada tarea"""
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if not task or task['state'] == 'done':
+                return False
+            task.update(state='done', worker=worker_id, finished_at=time.time())
+            self._results[task_id] = list(results)
+            return True
+
+    def fail(self, task_id, worker_id, error):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if not task or task['state'] != 'leased' or task['worker'] != worker_id:
+                return
+            task['error'] = error
+            task['state'] = 'failed' if task['attempts'] >= task['max_attempts'] else 'pending'
+
+    @staticmethod
+    def _expire(task, now):
+        """Una tarea con el plazo vencido y sin intentos pasa a fallida"""
+        if (task['state'] == 'leased' and task['lease_until'] < now
+                and task['attempts'] >= task['max_attempts']):
+            task['state'] = 'failed'
+            task['error'] = task['error'] or 'plazo vencido'
+
+    def status(self, job_id):
+        """Conteo por estado; las tareas con el plazo vencido y sin intentos pasan a fallidas"""
+        now = time.time()
+        counts = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+        with self._lock:
+            for task in self._tasks.values():
+                if task['job_id'] != job_id:
+                    continue
+                self._expire(task, now)
+                counts[task['state']] += 1
+        return counts
+
+    def take(self, job_id, seq):
+        """Resultados de la tarea si ya terminó (y los suelta de la cola), o None si sigue en curso"""
+        with self._lock:
+            task = self._tasks.get(f'{job_id}:{seq}')
+            if task is None:
+                return None
+            self._expire(task, time.time())
+            if task['state'] == 'done':
+                return self._results.pop(task['id'], [])
+            if task['state'] == 'failed':
+                return _unfinished(task['payload'], task['error'])
+        return None
+
+    def workers(self, job_id):
+        """Tareas completadas por cada trabajador"""
+        done = {}
+        with self._lock:
+            for task in self._tasks.values():
+                if task['job_id'] == job_id and task['state'] == 'done':
+                    done[task['worker']] = done.get(task['worker'], 0) + 1
+        return done
+
+    def purge(self, job_id):
+        with self._lock:
+            for task_id in [t for t, task in self._tasks.items() if task['job_id'] == job_id]:
+                del self._tasks[task_id]
+                self._results.pop(task_id, None)
+
+# ===== COLA EN SQLITE =====
+class SQLiteQueue:
+    """Cola en un archivo SQLite compartido por el coordinador y los trabajadores del mismo equipo
+
+    Usa WAL, que necesita memoria compartida entre procesos: el archivo no puede estar en
+    una carpeta de red. Los trabajadores de otros equipos usan HTTPQueue.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS templates (key TEXT PRIMARY KEY, data BLOB);
+        CREATE TABLE IF NOT EXISTS tasks (
+            id TEXT PRIMARY KEY, job_id TEXT, seq INTEGER, payload TEXT,
+            state TEXT, attempts INTEGER, max_attempts INTEGER, worker TEXT,
+            leased_at REAL, lease_until REAL, finished_at REAL,
+            speculated INTEGER DEFAULT 0, error TEXT, created REAL
+        );
+        CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, created, seq);
+        CREATE INDEX IF NOT EXISTS tasks_job ON tasks (job_id, seq);
+        CREATE TABLE IF NOT EXISTS results (
+            task_id TEXT, job_id TEXT, seq INTEGER, position INTEGER,
+            name TEXT, data BLOB, error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS results_job ON results (job_id, seq, position);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        self._connection().executescript(self.SCHEMA)
+
+    def _connection(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        """Transacción con bloqueo de escritura desde el inicio (evita carreras al reclamar)"""
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def has_template(self, key):
+        row = self._connection().execute('SELECT 1 FROM templates WHERE key = ?', (key,)).fetchone()
+        return row is not None
+
+    def put_template(self, key, data):
+        with self._transaction() as db:
+            db.execute('INSERT OR IGNORE INTO templates (key, data) VALUES (?, ?)', (key, data))
+
+    def get_template(self, key):
+        row = self._connection().execute('SELECT data FROM templates WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def drop_template(self, key):
+        with self._transaction() as db:
+            db.execute('DELETE FROM templates WHERE key = ?', (key,))
+
+    def submit(self, job_id, payloads, max_attempts):
+        now = time.time()
+        rows = [(f'{job_id}:{seq}', job_id, seq, json.dumps(payload), 'pending', 0, max_attempts, now)
+                for seq, payload in enumerate(payloads)]
+        with self._transaction() as db:
+            db.executemany(
+                'INSERT INTO tasks (id, job_id, seq, payload, state, attempts, max_attempts, created)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows
+            )
+
+    def _task(self, row):
+        task_id, job_id, seq, payload, attempts = row
+        return {'id': task_id, 'job_id': job_id, 'seq': seq, 'payload': json.loads(payload),
+                'attempts': attempts}
+
+    def claim(self, worker_id, lease_seconds, speculate_factor=0):
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT id, job_id, seq, payload, attempts FROM tasks"
+                " WHERE (state = 'pending' OR (state = 'leased' AND lease_until < ?))"
+                " AND attempts < max_attempts ORDER BY created, seq LIMIT 1", (now,)
+            ).fetchone()
+            if row:
+                db.execute(
+                    "UPDATE tasks SET state = 'leased', worker = ?, leased_at = ?, lease_until = ?,"
+                    " attempts = attempts + 1 WHERE id = ?",
+                    (worker_id, now, now + lease_seconds, row[0])
+                )
+                task = self._task(row)
+                task['attempts'] += 1
+                return task
+
+            if not speculate_factor:
+                return None
+            # Sin tareas libres: duplicar la más atrasada de un nodo lento
+            row = db.execute(
+                "SELECT t.id, t.job_id, t.seq, t.payload, t.attempts FROM tasks t"
+                " JOIN (SELECT job_id, AVG(finished_at - leased_at) AS average FROM tasks"
+                "       WHERE state = 'done' GROUP BY job_id) d ON d.job_id = t.job_id"
+                " WHERE t.state = 'leased' AND t.speculated = 0 AND t.worker != ?"
+                " AND ? - t.leased_at > ? * d.average ORDER BY t.leased_at LIMIT 1",
+                (worker_id, now, speculate_factor)
+            ).fetchone()
+            if row:
+                db.execute('UPDATE tasks SET speculated = 1 WHERE id = ?', (row[0],))
+                return self._task(row)
+        return None
+
+    def touch(self, task_id, worker_id, lease_seconds):
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE tasks SET lease_until = ? WHERE id = ? AND state = 'leased' AND worker = ?",
+                (time.time() + lease_seconds, task_id, worker_id)
+            )
+
+    def complete(self, task_id, worker_id, results):
+        """Guarda los resultados; solo cuenta la primera entrega de cada tarea"""
+        with self._transaction() as db:
+            updated = db.execute(
+                "UPDATE tasks SET state = 'done', worker = ?, finished_at = ? WHERE id = ? AND state != 'done'",
+                (worker_id, time.time(), task_id)
+            ).rowcount
+            if not updated:
+                return False
+            job_id, seq = db.execute('SELECT job_id, seq FROM tasks WHERE id = ?', (task_id,)).fetchone()
+            db.executemany(
+                'INSERT INTO results (task_id, job_id, seq, position, name, data, error)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(task_id, job_id, seq, position, name, data, error)
+                 for position, (name, data, error) in enumerate(results)]
+            )
+            return True
+
+    def fail(self, task_id, worker_id, error):
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE tasks SET error = ?, state = CASE WHEN attempts >= max_attempts"
+                " THEN 'failed' ELSE 'pending' END"
+                " WHERE id = ? AND state = 'leased' AND worker = ?",
+                (error, task_id, worker_id)
+            )
+
+    def status(self, job_id):
+        """Conteo por estado; las tareas con el plazo vencido y sin intentos pasan a fallidas"""
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE tasks SET state = 'failed', error = COALESCE(error, 'plazo vencido')"
+                " WHERE job_id = ? AND state = 'leased' AND lease_until < ? AND attempts >= max_attempts",
+                (job_id, time.time())
+            )
+            counts = dict(db.execute(
+                'SELECT state, COUNT(*) FROM tasks WHERE job_id = ? GROUP BY state', (job_id,)
+            ).fetchall())
+        return {state: counts.get(state, 0) for state in ('pending', 'leased', 'done', 'failed')}
+
+    def workers(self, job_id):
+        """Tareas completadas por cada trabajador"""
+        return dict(self._connection().execute(
+            "SELECT worker, COUNT(*) FROM tasks WHERE job_id = ? AND state = 'done' GROUP BY worker",
+            (job_id,)
+        ).fetchall())
+
+    def take(self, job_id, seq):
+        """Resultados de la tarea si ya terminó (y los borra de la cola), o None si sigue en curso"""
+        task_id = f'{job_id}:{seq}'
+        row = self._connection().execute(
+            'SELECT state, lease_until, attempts, max_attempts FROM tasks WHERE id = ?', (task_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        state, lease_until, attempts, max_attempts = row
+        # Consulta sin bloqueo de escritura mientras la tarea sigue en curso
+        expired = lease_until is not None and lease_until < time.time() and attempts >= max_attempts
+        if state == 'pending' or (state == 'leased' and not expired):
+            return None
+
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE tasks SET state = 'failed', error = COALESCE(error, 'plazo vencido')"
+                " WHERE id = ? AND state = 'leased' AND lease_until < ? AND attempts >= max_attempts",
+                (task_id, time.time())
+            )
+            state, payload, error = db.execute(
+                'SELECT state, payload, error FROM tasks WHERE id = ?', (task_id,)
+            ).fetchone()
+            if state == 'failed':
+                return _unfinished(json.loads(payload), error)
+            if state != 'done':
+                return None
+            results = db.execute(
+                'SELECT name, data, error FROM results WHERE task_id = ? ORDER BY position', (task_id,)
+            ).fetchall()
+            db.execute('DELETE FROM results WHERE task_id = ?', (task_id,))
+            return results
+
+    def purge(self, job_id):
+        with self._transaction() as db:
+            db.execute('DELETE FROM results WHERE job_id = ?', (job_id,))
+            db.execute('DELETE FROM tasks WHERE job_id = ?', (job_id,))
+
+# ===== COLA POR HTTP =====
+class HTTPQueue:
+    """Cola del coordinador vista por HTTP, para trabajadores en otros equipos
+
+    Solo tiene las operaciones del trabajador: el coordinador publica su propia cola
+    (memory o sqlite) en /farm, protegida con FARM_TOKEN. Los resultados de cada tarea
+    viajan en una sola petición con pack_results.
+    """
+
+    def __init__(self, url, token=None, timeout=60):
+        self.url = url.rstrip('/')
+        self.token = token if token is not None else CONFIG['FARM_TOKEN']
+        self.timeout = timeout
+
+    def _request(self, path, body=None, content_type='application/json'):
+        """(código, cuerpo) de la petición; los errores de red se propagan como OSError"""
+        headers = {'Authorization': f'Bearer {self.token}'}
+        if body is not None:
+            headers['Content-Type'] = content_type
+        request = urllib.request.Request(self.url + path, data=body, headers=headers,
+                                         method='GET' if body is None else 'POST')
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return e.code, b''
+            raise
+
+    def _post_json(self, path, data):
+        return self._request(path, json.dumps(data).encode('utf-8'))
+
+    @staticmethod
+    def _task_path(task_id, action):
+        return f"/tasks/{urllib.parse.quote(task_id, safe='')}/{action}"
+
+    def get_template(self, key):
+        status, body = self._request(f"/templates/{urllib.parse.quote(key, safe='')}")
+        return body if status == 200 else None
+
+    def claim(self, worker_id, lease_seconds, speculate_factor=0):
+        status, body = self._post_json('/claim', {'worker': worker_id, 'lease_seconds': lease_seconds,
+                                                  'speculate_factor': speculate_factor})
+        return json.loads(body) if status == 200 else None
+
+    def touch(self, task_id, worker_id, lease_seconds):
+        self._post_json(self._task_path(task_id, 'touch'),
+                        {'worker': worker_id, 'lease_seconds': lease_seconds})
+
+    def complete(self, task_id, worker_id, results):
+        """Entrega los resultados; False si otro trabajador ya la había entregado"""
+        path = self._task_path(task_id, 'complete') + '?' + urllib.parse.urlencode({'worker': worker_id})
+        status, body = self._request(path, pack_results(results), 'application/octet-stream')
+        return status == 200 and json.loads(body).get('accepted', False)
+
+    def fail(self, task_id, worker_id, error):
+        self._post_json(self._task_path(task_id, 'fail'), {'worker': worker_id, 'error': error})
+
+def open_queue(url, token=None):
+    """Cola a partir de su URL ('memory', 'sqlite:///ruta/cola.db' o 'http://servidor:5000/farm')"""
+    if url == 'memory':
+        return MemoryQueue()
+    if url.startswith('sqlite:///'):
+        return SQLiteQueue(url[len('sqlite:///'):])
+    if url.startswith(('http://', 'https://')):
+        return HTTPQueue(url, token)
+    raise ValueError(f'Cola de la granja no soportada: {url}')
+
+# ===== TRABAJADOR =====
+class FarmWorker:
+    """Toma tareas de la cola, genera los diplomas y devuelve los archivos codificados"""
+
+    def __init__(self, queue, worker_id=None, cache_folder=None, lease_seconds=None,
+                 speculate_factor=None):
+        self.queue = queue
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}'
+        self.cache_folder = cache_folder or os.path.join(CONFIG['UPLOAD_FOLDER'], '.farm')
+        self.lease_seconds = lease_seconds or CONFIG['FARM_LEASE_SECONDS']
+        self.speculate_factor = (CONFIG['FARM_SPECULATE_FACTOR'] if speculate_factor is None
+                                 else speculate_factor)
+
+    def _template_path(self, key):
+        """Plantilla descargada de la cola y guardada localmente por hash"""
+        path = os.path.join(self.cache_folder, key)
+        if not os.path.exists(path):
+            data = self.queue.get_template(key)
+            if data is None:
+                raise LookupError(f'Plantilla {key[:12]} no publicada en la cola')
+            os.makedirs(self.cache_folder, exist_ok=True)
+            part_path = f'{path}.{self.worker_id}.part'
+            with open(part_path, 'wb') as f:
+                f.write(data)
+            os.replace(part_path, path)
+        return path
+
+    @contextmanager
+    def _lease(self, task):
+        """Renueva el plazo de la tarea cada tercio de FARM_LEASE_SECONDS mientras se genera"""
+        finished = threading.Event()
+
+        def renew():
+            while not finished.wait(self.lease_seconds / 3):
+                try:
+                    self.queue.touch(task['id'], self.worker_id, self.lease_seconds)
+                except Exception as e:
+                    logger.warning("No se pudo renovar la tarea %s: %s", task['id'], e)
+
+        thread = threading.Thread(target=renew, name=f"xonidip-lease-{task['id']}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            finished.set()
+            thread.join()
+
+    def process(self, task):
+        """Genera los nombres de la tarea; devuelve [(nombre, datos, error)]"""
+        payload = task['payload']
+        config = dict(payload['config'], font_color=tuple(payload['config']['font_color']))
+        output_format, profile = payload['output_format'], payload['profile']
+        timeout = CONFIG['MEMORY_WAIT_TIMEOUT']
+        results = []
+
+        with shared_templates.use(self._template_path(payload['template_hash']), timeout,
+                                  output_format) as template, \
+             memory_budget.hold(template.width * template.height * len(template.getbands()), timeout):
+            font = load_font(config['font_name'], config['font_size'], config['font_style'])
+            rendered = iter_rendered(template, payload['names'], font, config, payload.get('engine'))
+            for name, img, error in rendered:
+                if error:
+                    results.append((name, None, str(error)))
+                    continue
+                buffer = io.BytesIO()
+                encode_diploma(img, buffer, output_format, profile)
+                results.append((name, buffer.getvalue(), None))
+        return results
+
+    def run_once(self):
+        """Procesa una tarea si hay; devuelve False si la cola estaba vacía"""
+        task = self.queue.claim(self.worker_id, self.lease_seconds, self.speculate_factor)
+        if task is None:
+            return False
+        try:
+            # Señal de vida por temporizador, no por diploma: la tarea sigue asignada a este trabajador
+            with self._lease(task):
+                results = self.process(task)
+        except Exception as e:
+            logger.warning("Tarea %s fallida en %s: %s", task['id'], self.worker_id, e)
+            self.queue.fail(task['id'], self.worker_id, str(e))
+        else:
+            self.queue.complete(task['id'], self.worker_id, results)
+        return True
+
+    def run(self, stop_event=None, poll_interval=1.0, idle_exit=None):
+        """Bucle del trabajador hasta stop_event o idle_exit segundos sin tareas"""
+        idle_since = time.monotonic()
+        while not (stop_event and stop_event.is_set()):
+            try:
+                worked = self.run_once()
+            except OSError as e:
+                # Coordinador caído o red cortada: la tarea en curso se reasigna al vencer su plazo
+                logger.warning("Cola no disponible para %s: %s", self.worker_id, e)
+                worked = False
+            if worked:
+                idle_since = time.monotonic()
+                continue
+            if idle_exit is not None and time.monotonic() - idle_since >= idle_exit:
+                break
+            if stop_event:
+                stop_event.wait(poll_interval)
+            else:
+                time.sleep(poll_interval)
+
+# ===== COORDINADOR =====
+class FarmCoordinator:
+    """Divide el lote en tareas y entrega los resultados en orden a medida que terminan"""
+
+    def __init__(self, queue, chunk_names=None, max_attempts=None, local_workers=0):
+        self.queue = queue
+        self.chunk_names = chunk_names or CONFIG['FARM_CHUNK_NAMES']
+        self.max_attempts = max_attempts or CONFIG['FARM_MAX_ATTEMPTS']
+        self.local_workers = local_workers
+        self._threads = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._template_jobs = {}  # hash de plantilla -> trabajos en curso que la usan
+        self._job_templates = {}  # id de trabajo -> hash de su plantilla
+
+    def _start_local_workers(self):
+        """Hilos trabajadores en este proceso (cola 'memory'), arrancados al primer trabajo"""
+        with self._lock:
+            if self._threads or not self.local_workers:
+                return
+            for index in range(self.local_workers):
+                worker = FarmWorker(self.queue, worker_id=f'local-{index}')
+                thread = threading.Thread(target=worker.run, args=(self._stop, 0.2),
+                                          name=f'xonidip-farm-{index}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+
+    def submit(self, template_path, config, output_format, profile, engine, names):
+        """Publica la plantilla (una vez por hash) y las tareas; devuelve el id del trabajo
+
+        La plantilla sigue en la cola mientras algún trabajo la use; finish() la retira.
+        """
+        key = template_hash(template_path)
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._template_jobs[key] = self._template_jobs.get(key, 0) + 1
+            self._job_templates[job_id] = key
+            published = self.queue.has_template(key)
+        try:
+            if not published:
+                with open(template_path, 'rb') as f:
+                    self.queue.put_template(key, f.read())
+
+            payloads = [{
+                'template_hash': key, 'config': config, 'output_format': output_format,
+                'profile': profile, 'engine': engine, 'names': chunk,
+            } for chunk in _chunks(list(names), self.chunk_names)]
+            self.queue.submit(job_id, payloads, self.max_attempts)
+        except BaseException:
+            self.finish(job_id)
+            raise
+        self._start_local_workers()
+        return job_id
+
+    def finish(self, job_id):
+        """Borra las tareas del trabajo y, si ningún otro la usa, su plantilla"""
+        self.queue.purge(job_id)
+        with self._lock:
+            key = self._job_templates.pop(job_id, None)
+            if key is None:
+                return
+            self._template_jobs[key] -= 1
+            if not self._template_jobs[key]:
+                del self._template_jobs[key]
+                self.queue.drop_template(key)
+
+    def run(self, template_path, config, output_format, profile, engine, names, timeout=None,
+            poll_interval=0.5):
+        """Genera el lote en la granja; produce (nombre, datos, error) en el orden de names
+
+        Cada tarea se entrega (y se borra de la cola) en cuanto terminan ella y las
+        anteriores: en la cola solo esperan las que terminaron fuera de orden.
+        """
+        started = time.perf_counter()
+        names = list(names)
+        job_id = self.submit(template_path, config, output_format, profile, engine, names)
+        deadline = time.monotonic() + (timeout or CONFIG['FARM_WAIT_TIMEOUT'])
+        try:
+            for seq in range(math.ceil(len(names) / self.chunk_names)):
+                results = self.queue.take(job_id, seq)
+                while results is None:
+                    if time.monotonic() > deadline:
+                        counts = self.queue.status(job_id)
+                        raise FarmTimeout(f"{counts['pending'] + counts['leased']} tareas sin terminar")
+                    time.sleep(poll_interval)
+                    results = self.queue.take(job_id, seq)
+                yield from results
+            counts = self.queue.status(job_id)
+            logger.info(
+                "Granja: trabajo=%s tareas=%d fallidas=%d trabajadores=%s duracion=%.2fs",
+                job_id[:8], counts['done'] + counts['failed'], counts['failed'],
+                self.queue.workers(job_id), time.perf_counter() - started
+            )
+        finally:
+            self.finish(job_id)
+
+def open_farm(config=CONFIG):
+    """Coordinador según FARM_QUEUE, o None si la granja está desactivada"""
+    if not config['FARM_QUEUE']:
+        return None
+    queue = open_queue(config['FARM_QUEUE'])
+    if isinstance(queue, HTTPQueue):
+        raise ValueError('La cola http:// es para los trabajadores; el coordinador usa memory o sqlite')
+    # Con la cola en memoria no hay trabajadores externos: los hilos locales hacen el trabajo
+    local_workers = config['FARM_LOCAL_WORKERS'] if isinstance(queue, MemoryQueue) else 0
+    return FarmCoordinator(queue, config['FARM_CHUNK_NAMES'], config['FARM_MAX_ATTEMPTS'], local_workers)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='XONIDIP - trabajador de la granja de render')
+    parser.add_argument('--queue', default=CONFIG['FARM_QUEUE'] or None, required=not CONFIG['FARM_QUEUE'],
+                        help='Cola del coordinador (http://servidor:5000/farm, o sqlite:///ruta/cola.db '
+                             'en el mismo equipo)')
+    parser.add_argument('--token', default=CONFIG['FARM_TOKEN'],
+                        help='Token de la granja para la cola http (por defecto XONIDIP_FARM_TOKEN)')
+    parser.add_argument('--id', help='Identificador del trabajador (por defecto: equipo-pid)')
+    parser.add_argument('--cache-folder', help='Carpeta local para las plantillas descargadas')
+    parser.add_argument('--poll', type=float, default=1.0, help='Segundos entre consultas con la cola vacía')
+    parser.add_argument('--idle-exit', type=float, help='Terminar tras N segundos sin tareas')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging()
+    queue = open_queue(args.queue, args.token)
+    if isinstance(queue, MemoryQueue):
+        logger.error("La cola 'memory' solo existe dentro del servidor; usa http://servidor:5000/farm")
+        return 1
+    if isinstance(queue, HTTPQueue) and not queue.token:
+        logger.error("La cola http necesita el token de la granja (--token o XONIDIP_FARM_TOKEN)")
+        return 1
+    worker = FarmWorker(queue, worker_id=args.id, cache_folder=args.cache_folder)
+    logger.info("Trabajador %s esperando tareas en %s", worker.worker_id, args.queue)
+    try:
+        worker.run(poll_interval=args.poll, idle_exit=args.idle_exit)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
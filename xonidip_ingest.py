@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+XONIDIP 2026 - Ingesta de nombres en streaming
+El sistema de registro abre un lote y le envía los asistentes a medida que llegan
+(NDJSON, una fila por línea, en un cuerpo chunked). Cada fila se compara con el
+listado del lote en O(1) y, si el lote genera en vivo, el diploma se crea en ese
+momento; al cerrar el lote solo falta generar lo pendiente y armar el ZIP.
+
+Filas aceptadas (una por línea):
+    "Ana López"
+    {"name": "Ana López", "template": "ponente"}
+
+Desarrollado por: Darian Alberto Camacho Salas
+Organizacion: XONIDU
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import ExitStack
+
+from xonidip_core import (
+    CONFIG, logger, Roster, storage, registry, shared_templates, memory_budget,
+    load_font, resolve_engine, iter_rendered, save_rendered, encode_threads, MemoryBudgetTimeout
+)
+
+class IngestBusy(Exception):
+    """Se alcanzó el máximo de lotes abiertos"""
+
+class IngestClosed(Exception):
+    """El lote ya se cerró (o expiró) y no admite más filas"""
+
+def _parse_line(line_no, line):
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        return line_no, json.loads(line.decode('utf-8')), None
+    except (UnicodeDecodeError, ValueError) as e:
+        return line_no, None, f'JSON no válido: {e}'
+
+def iter_ndjson(stream, max_line=None):
+    """Filas de un cuerpo NDJSON: (número de línea, objeto, error)
+
+    Se lee línea a línea, así que cada fila se entrega en cuanto llega su salto de
+    línea, sin esperar al final de un cuerpo chunked. Lanza ValueError si una línea
+    supera max_line bytes.
+    """
+    max_line = max_line or CONFIG['INGEST_MAX_LINE_BYTES']
+    line_no = 0
+    while True:
+        line = stream.readline(max_line + 1)
+        if not line:
+            break
+        line_no += 1
+        if len(line) > max_line and not line.endswith(b'\n'):
+            raise ValueError(f'La línea {line_no} supera {max_line} bytes')
+        parsed = _parse_line(line_no, line)
+        if parsed:
+            yield parsed
+
+# ===== LOTE ABIERTO =====
+class OpenBatch:
+    """Trabajo de generación que recibe filas durante su vida y se empaqueta al cerrarlo
+
+    Mantiene abiertos el directorio del trabajo y su registro de emisión; si se descarta
+    sin cerrarlo, ambos se eliminan como en un trabajo fallido.
+    """
+
+    def __init__(self, roster, output_format, profile, render=True):
+        self.roster = roster
+        self.output_format = output_format
+        self.profile = profile
+        self.render = render
+        self.received = self.duplicates = self.failed = 0
+        self.outputs = []  # (archivo relativo al trabajo, nombre)
+        self.pending = []  # (grupo, nombre) aún sin generar
+        self.created = self.touched = time.time()
+        self.closed = False
+        self.lock = threading.Lock()
+        self._warm = {}  # clave de grupo -> (clave compartida, plantilla, fuente, carpeta, hash)
+        self._stack = ExitStack()
+        # Las plantillas del listado quedan protegidas de la limpieza mientras el lote siga abierto
+        self.job = self._stack.enter_context(storage.job(roster.template_paths()))
+        self.issued = self._stack.enter_context(registry.batch(self.job.id, None, output_format))
+        self.id = self.job.id
+
+    def _group_state(self, group):
+        """Plantilla decodificada y fuente del grupo, retenidas mientras el lote siga abierto"""
+        state = self._warm.get(group.key)
+        if state is None:
+            template_key, template = shared_templates.acquire(
+                group.template_path, CONFIG['MEMORY_WAIT_TIMEOUT'], self.output_format)
+            config = group.config
+            font = load_font(config['font_name'], config['font_size'], config['font_style'])
+            folder = os.path.join(self.job.dir, group.folder) if group.folder else self.job.dir
+            os.makedirs(folder, exist_ok=True)
+            state = (template_key, template, font, folder, group.hash)
+            self._warm[group.key] = state
+        return state
+
+    def _render(self, group, names, engine='pil', threads=1):
+        _, template, font, folder, group_hash = self._group_state(group)
+        working_bytes = template.width * template.height * len(template.getbands())
+        working_bytes *= 1 + (threads if threads > 1 else 0)
+        if engine == 'numpy':
+            working_bytes += CONFIG['NUMPY_BATCH_MB'] * 1024 * 1024
+
+        with memory_budget.hold(working_bytes, CONFIG['MEMORY_WAIT_TIMEOUT']):
+            rendered = iter_rendered(template, names, font, group.config, engine)
+            for name, _, output_path, error in save_rendered(rendered, self.output_format, folder,
+                                                             self.profile, threads):
+                if error:
+                    self.failed += 1
+                    logger.warning("Error con %s: %s", name, error)
+                    continue
+                filename = os.path.relpath(output_path, self.job.dir)
+                self.outputs.append((filename, name))
+                self.issued.add(filename, name, group_hash)
+
+    def add(self, row):
+        """Agrega una fila; True si es nueva, False si ya estaba en el listado
+
+        Lanza ValueError si la fila no es válida e IngestClosed si el lote ya se cerró.
+        """
+        name, _ = Roster.parse_row(row)
+        if not name:
+            raise ValueError('Fila sin nombre')
+        with self.lock:
+            if self.closed:
+                raise IngestClosed(f'El lote {self.id} ya está cerrado')
+            self.touched = time.time()
+            self.received += 1
+            added = self.roster.add(row)
+            if added is None:
+                self.duplicates += 1
+                return False
+            if not self.render:
+                self.pending.append(added)
+                return True
+            group, name = added
+            try:
+                self._render(group, [name])
+            except MemoryBudgetTimeout:
+                # Sin memoria ahora: se genera al cerrar el lote
+                self.pending.append(added)
+            except Exception as e:
+                # La fila ya está en el listado: queda pendiente para no perderla ni contarla como repetida
+                logger.warning("Error al generar %s en el lote %s (queda pendiente): %s", name, self.id, e)
+                self.pending.append(added)
+            return True
+
+    def finish(self):
+        """Cierra el lote a nuevas filas y genera lo pendiente, agrupado por plantilla"""
+        with self.lock:
+            self.closed = True
+            by_group = OrderedDict()
+            for group, name in self.pending:
+                by_group.setdefault(group.key, (group, []))[1].append(name)
+            for group, names in by_group.values():
+                _, template, font, _, _ = self._group_state(group)
+                engine = resolve_engine(CONFIG['RENDER_ENGINE'], template, names, font, group.config)
+                self._render(group, names, engine, encode_threads(template))
+                # Si el siguiente grupo no consigue memoria, el lote se puede reabrir sin repetir este
+                self.pending = [item for item in self.pending if item[0] is not group]
+
+    def reopen(self):
+        """Vuelve a admitir filas tras un cierre que no pudo terminar"""
+        with self.lock:
+            self.closed = False
+
+    def release(self):
+        """Suelta las plantillas retenidas y cierra el trabajo (se conserva solo si se empaquetó)"""
+        for template_key, *_ in self._warm.values():
+            shared_templates.release(template_key)
+        self._warm = {}
+        self._stack.close()
+
+    def status(self):
+        with self.lock:
+            counts = OrderedDict((group.key, len(group.names)) for group in self.roster.groups.values())
+            return {
+                'batch_id': self.id,
+                'received': self.received,
+                'names': sum(counts.values()),
+                'rendered': len(self.outputs),
+                'pending': len(self.pending),
+                'duplicates': self.duplicates,
+                'failed': self.failed,
+                'groups': [{'template': key, 'count': count} for key, count in counts.items()],
+                'render': self.render,
+                'closed': self.closed,
+                'idle_seconds': round(time.time() - self.touched, 1),
+            }
+
+class OpenBatches:
+    """Lotes abiertos del servidor; los inactivos más de INGEST_IDLE_SECONDS se descartan"""
+
+    def __init__(self, config=CONFIG):
+        self.config = config
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def expire(self):
+        now = time.time()
+        with self._lock:
+            expired = [batch for batch in self._batches.values()
+                       if now - batch.touched > self.config['INGEST_IDLE_SECONDS']]
+            for batch in expired:
+                del self._batches[batch.id]
+        for batch in expired:
+            with batch.lock:
+                batch.closed = True
+            batch.release()
+            logger.info("Lote abierto descartado por inactividad: %s (%d nombres)", batch.id, batch.received)
+        return len(expired)
+
+    def create(self, roster, output_format, profile, render=True):
+        self.expire()
+        with self._lock:
+            if len(self._batches) >= self.config['INGEST_MAX_OPEN']:
+                raise IngestBusy(f"Hay {len(self._batches)} lotes abiertos; cierra alguno antes de abrir otro")
+        batch = OpenBatch(roster, output_format, profile, render)
+        with self._lock:
+            self._batches[batch.id] = batch
+        return batch
+
+    def get(self, batch_id):
+        self.expire()
+        with self._lock:
+            return self._batches.get(batch_id)
+
+    def pop(self, batch_id):
+        with self._lock:
+            return self._batches.pop(batch_id, None)
+
+    def restore(self, batch):
+        batch.reopen()
+        with self._lock:
+            self._batches[batch.id] = batch
+
+open_batches = OpenBatches()
+# Sin peticiones nuevas, la limpieza periódica también descarta los lotes inactivos
+storage.before_sweep.append(open_batches.expire)
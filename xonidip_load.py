@@ -0,0 +1,574 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+XONIDIP 2026 - Prueba de carga del servidor web
+Reproduce la secuencia de llamadas de la interfaz (index.html) con muchos clientes
+a la vez: teléfonos que suben la plantilla y mueven el texto (/preview-position)
+mientras corren lotes masivos (/generate-diplomas y descarga del ZIP). Informa los
+percentiles de latencia por endpoint, la tasa de errores y la CPU/RSS del servidor.
+
+Solo apunta a servidores locales (127.0.0.1, ::1 o localhost). Sin dependencias:
+asyncio y un cliente HTTP/1.1 mínimo; psutil se usa si está instalado.
+
+Ejemplos:
+    python xonidip_load.py --spawn
+    python xonidip_load.py --url http://127.0.0.1:5000 --server-pid 12345 --scenario evento
+
+Desarrollado por: Darian Alberto Camacho Salas
+Organizacion: XONIDU
+"""
+
+import argparse
+import asyncio
+import errno
+import io
+import ipaddress
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from PIL import Image
+
+from xonidip_bench import synthetic_names
+
+# Escenarios: teléfonos con vistas previas y lotes masivos en paralelo
+SCENARIOS = {
+    'evento': {'phones': 50, 'previews': 20, 'bulk': 2, 'bulk_names': 2000},
+    'vistas_previas': {'phones': 50, 'previews': 30, 'bulk': 0, 'bulk_names': 0},
+    'masivo': {'phones': 0, 'previews': 0, 'bulk': 4, 'bulk_names': 1000},
+}
+
+# Rutas con parámetros agrupadas en un solo endpoint del informe
+ROUTE_PATTERNS = [
+    (re.compile(r'^/download/'), '/download/<archivo>'),
+    (re.compile(r'^/uploads/'), '/uploads/<archivo>'),
+]
+
+LOOPBACK_NAMES = ('localhost',)
+
+# ===== CLIENTE HTTP MÍNIMO =====
+class HTTPError(Exception):
+    """Respuesta que no se pudo leer (conexión cortada, cabeceras inválidas)"""
+
+def is_loopback(host):
+    if host in LOOPBACK_NAMES:
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+async def _read_body(reader, headers, keep):
+    """Cuerpo de la respuesta (b'' si no se conserva) y número de bytes leídos"""
+    chunks = []
+    size = 0
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            line = await reader.readline()
+            length = int(line.split(b';')[0].strip() or b'0', 16)
+            if not length:
+                await reader.readline()
+                break
+            data = await reader.readexactly(length)
+            await reader.readline()
+            size += length
+            if keep:
+                chunks.append(data)
+    else:
+        remaining = int(headers['content-length']) if 'content-length' in headers else None
+        while remaining is None or remaining > 0:
+            data = await reader.read(65536 if remaining is None else min(65536, remaining))
+            if not data:
+                break
+            size += len(data)
+            if remaining is not None:
+                remaining -= len(data)
+            if keep:
+                chunks.append(data)
+    return b''.join(chunks), size
+
+async def http_request(host, port, method, path, body=b'', headers=None, local_addr=None, keep_body=True):
+    """Petición HTTP/1.1 con Connection: close; devuelve (estado, cabeceras, cuerpo, bytes)"""
+    reader, writer = await asyncio.open_connection(host, port, local_addr=local_addr)
+    try:
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {host}:{port}', 'Connection: close',
+                 f'Content-Length: {len(body)}']
+        lines += [f'{key}: {value}' for key, value in (headers or {}).items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        parts = status_line.split(None, 2)
+        if len(parts) < 2 or not parts[1].isdigit():
+            raise HTTPError(f'Respuesta no válida: {status_line[:80]!r}')
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            response_headers[key.strip().lower()] = value.strip()
+        data, size = await _read_body(reader, response_headers, keep_body)
+        return int(parts[1]), response_headers, data, size
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+def multipart(fields, files=()):
+    """Cuerpo multipart/form-data como el de FormData: (cuerpo, content-type)"""
+    boundary = uuid.uuid4().hex
+    out = io.BytesIO()
+    for name, value in fields.items():
+        out.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode('utf-8'))
+        out.write(value.encode('utf-8') + b'\r\n')
+    for name, filename, content_type, data in files:
+        out.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                  f'filename="{filename}"\r\nContent-Type: {content_type}\r\n\r\n'.encode('utf-8'))
+        out.write(data + b'\r\n')
+    out.write(f'--{boundary}--\r\n'.encode('ascii'))
+    return out.getvalue(), f'multipart/form-data; boundary={boundary}'
+
+# ===== MÉTRICAS =====
+def percentile(values, fraction):
+    """Percentil por el rango más cercano sobre una lista ya ordenada"""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+class Recorder:
+    """Latencias y códigos de estado por endpoint"""
+
+    def __init__(self):
+        self.endpoints = OrderedDict()
+
+    def endpoint(self, method, path):
+        path = path.split('?')[0]
+        for pattern, label in ROUTE_PATTERNS:
+            if pattern.match(path):
+                path = label
+                break
+        return self.endpoints.setdefault(f'{method} {path}', {'latencies': [], 'statuses': {}, 'errors': 0})
+
+    def record(self, method, path, elapsed, status=None):
+        stats = self.endpoint(method, path)
+        stats['latencies'].append(elapsed)
+        if status is None:
+            stats['errors'] += 1
+            stats['statuses']['exc'] = stats['statuses'].get('exc', 0) + 1
+            return
+        stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+        if status >= 500 or (status >= 400 and status != 429):
+            stats['errors'] += 1
+
+    def summary(self):
+        rows = []
+        for label, stats in self.endpoints.items():
+            latencies = sorted(stats['latencies'])
+            count = len(latencies)
+            rows.append({
+                'endpoint': label,
+                'requests': count,
+                'errors': stats['errors'],
+                'error_rate': stats['errors'] / count if count else 0.0,
+                'rejected': stats['statuses'].get(429, 0),
+                'statuses': {str(key): value for key, value in stats['statuses'].items()},
+                'p50_ms': percentile(latencies, 0.50) * 1000,
+                'p90_ms': percentile(latencies, 0.90) * 1000,
+                'p95_ms': percentile(latencies, 0.95) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000,
+                'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+            })
+        return rows
+
+# ===== MUESTREO DEL SERVIDOR =====
+class ProcessSampler:
+    """CPU (% de un núcleo) y RSS del proceso del servidor; psutil si está, si no /proc"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self._process = None
+        try:
+            import psutil
+            self._process = psutil.Process(pid)
+            self._process.cpu_percent(None)
+        except ImportError:
+            if not os.path.exists(f'/proc/{pid}/stat'):
+                raise RuntimeError('Sin psutil solo se puede medir el servidor en Linux (/proc)')
+        self._clock = os.sysconf('SC_CLK_TCK') if self._process is None else None
+        self._page = os.sysconf('SC_PAGE_SIZE') if self._process is None else None
+        self._last = None
+
+    def _proc_times(self):
+        with open(f'/proc/{self.pid}/stat', 'rb') as f:
+            # El nombre del proceso va entre paréntesis y puede contener espacios
+            fields = f.read().rsplit(b')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self._clock
+
+    def sample(self):
+        """(cpu %, rss en MB) desde la muestra anterior"""
+        if self._process is not None:
+            return self._process.cpu_percent(None), self._process.memory_info().rss / 1048576
+        now, cpu_time = time.monotonic(), self._proc_times()
+        with open(f'/proc/{self.pid}/statm', 'rb') as f:
+            rss = int(f.read().split()[1]) * self._page / 1048576
+        cpu = 0.0
+        if self._last is not None:
+            elapsed = now - self._last[0]
+            cpu = 100.0 * (cpu_time - self._last[1]) / elapsed if elapsed > 0 else 0.0
+        self._last = (now, cpu_time)
+        return cpu, rss
+
+async def sample_server(target, sampler, interval, samples, started, stop):
+    """Cada intervalo: CPU/RSS del proceso y estado de la cola del planificador"""
+    if sampler is not None:
+        sampler.sample()
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        row = {'t': time.monotonic() - started}
+        if sampler is not None:
+            try:
+                row['cpu'], row['rss_mb'] = sampler.sample()
+            except (OSError, RuntimeError):
+                sampler = None
+        try:
+            status, _, body, _ = await http_request(target.host, target.port, 'GET', '/queue-status')
+            if status == 200:
+                queue = json.loads(body)
+                row['running'], row['queued'] = queue.get('running'), queue.get('queued')
+        except (OSError, ValueError, HTTPError, asyncio.IncompleteReadError):
+            pass
+        samples.append(row)
+
+# ===== CLIENTES VIRTUALES =====
+class Target:
+    """Servidor bajo prueba y dirección de origen de cada cliente virtual"""
+
+    def __init__(self, url, distinct_clients):
+        parts = urlsplit(url)
+        if parts.scheme != 'http':
+            raise ValueError('Solo se admite http://')
+        self.host = parts.hostname or '127.0.0.1'
+        self.port = parts.port or 80
+        if not is_loopback(self.host):
+            raise ValueError(f'La prueba de carga solo se ejecuta contra el equipo local, no contra {self.host}')
+        # El planificador limita trabajos por IP: cada teléfono sale de su propia 127.0.0.x
+        self.distinct_clients = distinct_clients and sys.platform.startswith('linux') and ':' not in self.host
+
+    def local_addr(self, index):
+        if not self.distinct_clients:
+            return None
+        return (f'127.0.{index // 250 % 256}.{index % 250 + 2}', 0)
+
+class VirtualClient:
+    """Un navegador con index.html abierto: cada llamada se registra por endpoint"""
+
+    def __init__(self, index, target, recorder, template_png, retries):
+        self.index = index
+        self.target = target
+        self.recorder = recorder
+        self.template_png = template_png
+        self.retries = retries
+        self.local_addr = target.local_addr(index)
+
+    async def call(self, method, path, body=b'', content_type=None, keep_body=True):
+        headers = {'Content-Type': content_type} if content_type else None
+        started = time.perf_counter()
+        try:
+            status, response_headers, data, _ = await http_request(
+                self.target.host, self.target.port, method, path, body, headers,
+                self.local_addr, keep_body)
+        except OSError as e:
+            if self.local_addr is not None and e.errno == errno.EADDRNOTAVAIL:
+                # Sin direcciones 127.0.0.x extra: este cliente sale de 127.0.0.1
+                self.local_addr = None
+                return await self.call(method, path, body, content_type, keep_body)
+            self.recorder.record(method, path, time.perf_counter() - started)
+            return None, {}, b''
+        except (HTTPError, asyncio.IncompleteReadError):
+            self.recorder.record(method, path, time.perf_counter() - started)
+            return None, {}, b''
+        self.recorder.record(method, path, time.perf_counter() - started, status)
+        return status, response_headers, data
+
+    async def call_json(self, method, path, payload=None, retry=False):
+        """POST/GET con JSON; con retry, respeta Retry-After ante un 429"""
+        body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        for attempt in range(self.retries + 1 if retry else 1):
+            status, headers, data = await self.call(method, path, body,
+                                                    'application/json' if payload is not None else None)
+            if status != 429 or attempt == self.retries:
+                break
+            await asyncio.sleep(float(headers.get('retry-after', 5)))
+        try:
+            return status, json.loads(data) if data else {}
+        except ValueError:
+            return status, {}
+
+    async def open_page(self):
+        await self.call('GET', '/', keep_body=False)
+        await self.call_json('GET', '/get-output-formats')
+
+    async def upload_template(self):
+        body, content_type = multipart({}, [('template', f'plantilla_carga_{self.index}.png',
+                                             'image/png', self.template_png)])
+        status, _, data = await self.call('POST', '/upload-template', body, content_type)
+        if status != 200:
+            return None
+        template = json.loads(data)
+        if template.get('url'):
+            await self.call('GET', template['url'], keep_body=False)
+        return template
+
+    async def process_names(self, names):
+        body, content_type = multipart({'source_type': 'text', 'names_text': '\n'.join(names)})
+        status, _, data = await self.call('POST', '/process-names', body, content_type)
+        return json.loads(data).get('names', names) if status == 200 else names
+
+    async def preview(self, template, text_config):
+        payload = {'template_path': template['filepath'],
+                   'text_config': dict(text_config, sample_text='José María Rodríguez')}
+        await self.call_json('POST', '/preview-position', payload)
+
+def text_config_for(template, rng):
+    """Posición al azar, como al arrastrar el texto sobre la plantilla"""
+    width, height = template['dimensions']['width'], template['dimensions']['height']
+    return {'x': rng.randint(width // 4, width * 3 // 4), 'y': rng.randint(height // 4, height * 3 // 4),
+            'font_size': rng.choice([36, 48, 64]), 'font_color': '#1a1a1a',
+            'font_name': 'arial.ttf', 'font_style': 'normal'}
+
+async def phone_session(client, previews, think, rng):
+    """Teléfono: abre la página, sube la plantilla, escribe unos nombres y mueve el texto"""
+    await client.open_page()
+    template = await client.upload_template()
+    if template is None:
+        return
+    await client.process_names(synthetic_names(rng.randint(3, 15), seed=client.index))
+    for _ in range(previews):
+        await client.preview(template, text_config_for(template, rng))
+        await asyncio.sleep(rng.uniform(0, think * 2))
+
+async def bulk_session(client, names, output_format, profile, rng, zip_part_mb=0):
+    """Lote masivo: el mismo recorrido, generación completa y descarga de cada parte del ZIP"""
+    await client.open_page()
+    template = await client.upload_template()
+    if template is None:
+        return
+    names = await client.process_names(names)
+    text_config = text_config_for(template, rng)
+    await client.preview(template, text_config)
+    request = {
+        'template_path': template['filepath'], 'names': names, 'text_config': text_config,
+        'output_format': output_format, 'output_profile': profile,
+    }
+    if zip_part_mb:
+        request['zip_part_mb'] = zip_part_mb
+    status, result = await client.call_json('POST', '/generate-diplomas', request, retry=True)
+    if status != 200:
+        return
+    # Con el ZIP dividido, job_result lista cada parte en 'parts' (download_url es solo la primera)
+    urls = [part['download_url'] for part in result.get('parts', [])] or [result.get('download_url')]
+    for url in filter(None, urls):
+        await client.call('GET', url, keep_body=False)
+
+def template_png(size):
+    width, height = size
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), (250, 248, 240)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+async def run_scenario(target, scenario, args, sampler):
+    recorder = Recorder()
+    samples = []
+    stop = asyncio.Event()
+    started = time.monotonic()
+    sampling = asyncio.ensure_future(sample_server(target, sampler, args.sample_interval, samples, started, stop))
+
+    png = template_png(args.template_size)
+    rng = random.Random(args.seed)
+    sessions = []
+    for index in range(scenario['bulk']):
+        client = VirtualClient(index, target, recorder, png, args.retries)
+        names = synthetic_names(scenario['bulk_names'], seed=args.seed + index)
+        sessions.append(bulk_session(client, names, args.format, args.profile, random.Random(rng.random()),
+                                     args.zip_part_mb))
+
+    async def delayed(coroutine, delay):
+        await asyncio.sleep(delay)
+        await coroutine
+
+    for index in range(scenario['phones']):
+        client = VirtualClient(scenario['bulk'] + index, target, recorder, png, args.retries)
+        delay = args.ramp * index / max(1, scenario['phones'])
+        session = phone_session(client, scenario['previews'], args.think, random.Random(rng.random()))
+        sessions.append(delayed(session, delay))
+
+    try:
+        await asyncio.gather(*sessions)
+    finally:
+        stop.set()
+        await sampling
+    return recorder, samples, time.monotonic() - started
+
+# ===== SERVIDOR LOCAL =====
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def spawn_server(workdir, port):
+    """Arranca xonidip.py en un proceso aparte (sin navegador) con carpetas de trabajo propias"""
+    code = (f"import xonidip; xonidip.storage.start(); "
+            f"xonidip.app.run(host='127.0.0.1', port={port}, threaded=True)")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.dirname(os.path.abspath(__file__)), os.environ.get('PYTHONPATH', '')]))
+    log = open(os.path.join(workdir, 'servidor.log'), 'wb')
+    return subprocess.Popen([sys.executable, '-c', code], cwd=workdir, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+async def wait_ready(target, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            status, _, _, _ = await http_request(target.host, target.port, 'GET', '/get-output-formats')
+            if status == 200:
+                return True
+        except (OSError, HTTPError, asyncio.IncompleteReadError):
+            pass
+        await asyncio.sleep(0.2)
+    return False
+
+# ===== INFORME =====
+def print_latencies(rows, elapsed):
+    total = sum(row['requests'] for row in rows)
+    errors = sum(row['errors'] for row in rows)
+    print(f'\nLatencia por endpoint ({total} peticiones en {elapsed:.1f}s, '
+          f'{total / elapsed if elapsed else 0:.1f} pet/s, errores {errors} '
+          f'({100.0 * errors / total if total else 0:.1f}%))')
+    print(f"  {'endpoint':<28}{'pet':>6}{'err%':>7}{'429':>6}{'p50':>9}{'p90':>9}{'p95':>9}"
+          f"{'p99':>9}{'max':>9}  (ms)")
+    for row in rows:
+        print(f"  {row['endpoint']:<28}{row['requests']:>6}{100 * row['error_rate']:>7.1f}{row['rejected']:>6}"
+              f"{row['p50_ms']:>9.0f}{row['p90_ms']:>9.0f}{row['p95_ms']:>9.0f}"
+              f"{row['p99_ms']:>9.0f}{row['max_ms']:>9.0f}")
+        other = {key: value for key, value in row['statuses'].items() if key not in ('200', '429')}
+        if other:
+            print(f"  {'':<28}estados: {', '.join(f'{k}={v}' for k, v in sorted(other.items()))}")
+
+def print_samples(samples):
+    if not samples:
+        return
+    print('\nServidor en el tiempo')
+    print(f"  {'t (s)':>7}{'cpu %':>8}{'rss MB':>9}{'en curso':>10}{'en cola':>9}")
+    for row in samples:
+        cpu = f"{row['cpu']:>8.0f}" if 'cpu' in row else f"{'-':>8}"
+        rss = f"{row['rss_mb']:>9.0f}" if 'rss_mb' in row else f"{'-':>9}"
+        print(f"  {row['t']:>7.1f}{cpu}{rss}{row.get('running', '-'):>10}{row.get('queued', '-'):>9}")
+    cpus = [row['cpu'] for row in samples if 'cpu' in row]
+    rss = [row['rss_mb'] for row in samples if 'rss_mb' in row]
+    if cpus:
+        print(f'  cpu media {sum(cpus) / len(cpus):.0f}%  maxima {max(cpus):.0f}%  '
+              f'rss maxima {max(rss):.0f} MB')
+
+def parse_size(value):
+    width, height = (int(v) for v in value.lower().split('x'))
+    return width, height
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='XONIDIP - prueba de carga del servidor web (solo local)')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='Servidor local bajo prueba')
+    parser.add_argument('--spawn', action='store_true',
+                        help='Arrancar un servidor propio en un puerto libre y carpeta temporal')
+    parser.add_argument('--server-pid', type=int, help='PID del servidor para medir CPU/RSS')
+    parser.add_argument('--scenario', default='evento', choices=list(SCENARIOS))
+    parser.add_argument('--phones', type=int, help='Telefonos simultaneos (vistas previas)')
+    parser.add_argument('--previews', type=int, help='Vistas previas por telefono')
+    parser.add_argument('--bulk', type=int, help='Lotes masivos simultaneos')
+    parser.add_argument('--bulk-names', type=int, help='Nombres por lote masivo')
+    parser.add_argument('--format', default='PNG', type=str.upper, help='Formato de los lotes masivos')
+    parser.add_argument('--profile', default='draft', type=str.lower, help='Perfil de los lotes masivos')
+    parser.add_argument('--zip-part-mb', type=float, default=0,
+                        help='Dividir el ZIP de los lotes masivos en partes de este tamaño (y descargarlas todas)')
+    parser.add_argument('--template-size', default='1754x1240', type=parse_size,
+                        help='Tamano de la plantilla sintetica (AxB)')
+    parser.add_argument('--ramp', type=float, default=5.0, help='Segundos para incorporar a todos los telefonos')
+    parser.add_argument('--think', type=float, default=0.3, help='Pausa media entre vistas previas (s)')
+    parser.add_argument('--retries', type=int, default=3, help='Reintentos de un lote ante 429')
+    parser.add_argument('--sample-interval', type=float, default=1.0, help='Segundos entre muestras del servidor')
+    parser.add_argument('--no-distinct-clients', dest='distinct_clients', action='store_false',
+                        help='Todos los clientes desde 127.0.0.1 (comparten el limite por dispositivo)')
+    parser.add_argument('--seed', type=int, default=2026)
+    parser.add_argument('--json', help='Guardar el informe completo en este archivo JSON')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenario = dict(SCENARIOS[args.scenario])
+    for key in ('phones', 'previews', 'bulk', 'bulk_names'):
+        if getattr(args, key) is not None:
+            scenario[key] = getattr(args, key)
+
+    server = workdir = None
+    if args.spawn:
+        workdir = tempfile.mkdtemp(prefix='xonidip_carga_')
+        args.url = f'http://127.0.0.1:{free_port()}'
+        server = spawn_server(workdir, urlsplit(args.url).port)
+        args.server_pid = server.pid
+
+    try:
+        try:
+            target = Target(args.url, args.distinct_clients)
+        except ValueError as e:
+            print(f'Error: {e}', file=sys.stderr)
+            return 2
+        if not asyncio.run(wait_ready(target, 30 if server else 3)):
+            print(f'Error: el servidor {args.url} no responde', file=sys.stderr)
+            return 1
+
+        sampler = None
+        if args.server_pid:
+            try:
+                sampler = ProcessSampler(args.server_pid)
+            except Exception as e:
+                print(f'  (sin medicion de CPU/RSS: {e})')
+
+        print(f"Escenario {args.scenario}: {scenario['phones']} telefonos x {scenario['previews']} vistas previas, "
+              f"{scenario['bulk']} lotes de {scenario['bulk_names']} nombres ({args.format} {args.profile}) "
+              f"contra {args.url}")
+        recorder, samples, elapsed = asyncio.run(run_scenario(target, scenario, args, sampler))
+        rows = recorder.summary()
+        print_latencies(rows, elapsed)
+        print_samples(samples)
+
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump({'scenario': dict(scenario, name=args.scenario), 'url': args.url,
+                           'elapsed': elapsed, 'endpoints': rows, 'server': samples}, f, indent=2)
+        return 0
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+            print(f'\nServidor temporal detenido (registro y archivos en {workdir})')
+
+if __name__ == '__main__':
+    sys.exit(main())